@@ -9,10 +9,12 @@ IFS=";" read -r -a RES_PATHS <<< "$RESULT_PATH_LIST"
 
 SUGAR=${SUGARS[$PBS_ARRAY_INDEX]}
 RES_PATH=${RES_PATHS[$PBS_ARRAY_INDEX]}
+# CPUs granted by PBS (ncpus above), used by the alignment workers and the PQ processes
+NCPUS=${PBS_NCPUS:-1}
 
 echo "$(date "+%Y-%m-%dT%H-%M") running analyze surroundings for sugar $SUGAR, saving result path to $RES_PATH" >> "$PIPELINE_RUN_LOG"
 
-singularity exec -B $PDB_MIRROR_ROOT:/app/pdb-mirror -B $INIT_PQ:/app/init-pq-dir -B $PIPELINE_RUN:/app/workdir-volume $PROJECT_ROOT/workflow-singularity.sif bash -c "cd /app/src; python surrounding_analysis.py -s $SUGAR -a -c -d --store_result_path $RES_PATH"
+singularity exec -B $PDB_MIRROR_ROOT:/app/pdb-mirror -B $INIT_PQ:/app/init-pq-dir -B $PIPELINE_RUN:/app/workdir-volume $PROJECT_ROOT/workflow-singularity.sif bash -c "cd /app/src; python surrounding_analysis.py -s $SUGAR -a -c -d --workers $NCPUS --pq_workers $NCPUS --pq_cpus $NCPUS --store_result_path $RES_PATH"
 
 RETURN_CODE="$?"
 echo "$(date "+%Y-%m-%dT%H-%M") analysis for $SUGAR ended $RETURN_CODE" >> "$PIPELINE_RUN_LOG"
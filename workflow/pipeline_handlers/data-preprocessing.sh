@@ -4,6 +4,9 @@
 #PBS -l walltime=40:00:00
 
 
+# CPUs granted by PBS (ncpus above)
+NCPUS=${PBS_NCPUS:-1}
+
 echo "$(date "+%Y-%m-%dT%H-%M") running data-preprocessing" >> "$PIPELINE_RUN_LOG"
 
-singularity exec -B $PDB_MIRROR_ROOT:/app/pdb-mirror -B $INIT_PQ:/app/init-pq-dir -B $PIPELINE_RUN:/app/workdir-volume $PROJECT_ROOT/workflow-singularity.sif bash -c "cd /app/src; python data_preprocessing.py"
+singularity exec -B $PDB_MIRROR_ROOT:/app/pdb-mirror -B $INIT_PQ:/app/init-pq-dir -B $PIPELINE_RUN:/app/workdir-volume $PROJECT_ROOT/workflow-singularity.sif bash -c "cd /app/src; python data_preprocessing.py --workers $NCPUS"
@@ -0,0 +1,58 @@
+"""
+Compare run time and RMSD values of pair by pair alignment and of alignment with preloaded structures
+(a new PyMOL session per tile, or one session reused by consecutive tiles as in the serial path of
+all_against_all_alignment) on a folder of refined surroundings.
+
+Usage (from workflow/src): python ../scripts/alignment/benchmark_preload.py -s NAG -f <surroundings> -p <sugar cif dir> -n 60
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+import sys
+import time
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src"))
+
+from process_handlers.perform_alignment import PreloadedStructures, align_tile, split_into_tiles, tile_pairs
+
+
+def run(mode: str, sugar: str, folder: Path, structures: List[str], save_path: Path, block_size: int) -> Tuple[float, Dict[Tuple[str, str], float]]:
+    tiles = split_into_tiles(len(structures), 1, block_size)
+    preloaded = PreloadedStructures(sugar, folder, save_path) if mode == "shared_session" else None
+
+    start = time.perf_counter()
+    values = {}
+    for tile in tiles:
+        pairs = list(tile_pairs(structures, tile))
+        aligned, failed = align_tile(sugar, folder, pairs, False, save_path, mode != "per_pair", preloaded)
+        if failed:
+            print(f"{mode}: {len(failed)} pairs failed, e.g. {failed[0]}")
+        values.update({(s1, s2): rmsd_values["super"] for s1, s2, rmsd_values in aligned})
+    elapsed = time.perf_counter() - start
+
+    if preloaded is not None:
+        preloaded.close()
+
+    return elapsed, values
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-s", "--sugar", required=True)
+    parser.add_argument("-f", "--folder", type=Path, required=True, help="Folder with refined surroundings")
+    parser.add_argument("-p", "--save_path", type=Path, required=True, help="Folder with (or to fetch) the sugar cif file")
+    parser.add_argument("-n", "--number", type=int, default=60, help="Number of surroundings to use")
+    parser.add_argument("-b", "--block_size", type=int, default=100, help="Maximum number of surroundings on one side of a tile")
+    args = parser.parse_args()
+
+    structures = sorted(p.name for p in args.folder.iterdir())[:args.number]
+    print(f"{len(structures)} surroundings, {len(structures) * (len(structures) - 1) // 2} pairs, tiles of at most {args.block_size}")
+
+    reference = None
+    for mode in ["per_pair", "tile_sessions", "shared_session"]:
+        elapsed, values = run(mode, args.sugar, args.folder, structures, args.save_path, args.block_size)
+        if reference is None:
+            reference = values
+        difference = max((abs(values[pair] - rms) for pair, rms in reference.items() if pair in values), default=0.0)
+        print(f"{mode:15s} {elapsed:8.2f} s  {len(values)} pairs  max |RMSD - per_pair| {difference:.2e}")
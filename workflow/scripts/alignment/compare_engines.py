@@ -0,0 +1,52 @@
+"""
+Compare RMSD values of the NumPy engine with the PyMOL alignment (super, and align with -a) on all pairs
+of the first <number> refined surroundings. Reports correlation of the values and their differences.
+
+Usage (from workflow/src): python ../scripts/alignment/compare_engines.py -s NAG -f <surroundings> -p <sugar cif dir> -n 60
+"""
+
+from argparse import ArgumentParser
+import itertools
+from pathlib import Path
+import sys
+
+import numpy as np
+from scipy.stats import pearsonr, spearmanr
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src"))
+
+from process_handlers.perform_alignment import align_tile, load_reference_sugar
+from process_handlers.rmsd_engine import parse_surroundings, rmsd_of_pairs, superpose_on_reference
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-s", "--sugar", required=True)
+    parser.add_argument("-f", "--folder", type=Path, required=True, help="Folder with refined surroundings")
+    parser.add_argument("-p", "--save_path", type=Path, required=True, help="Folder with (or to fetch) the sugar cif file")
+    parser.add_argument("-n", "--number", type=int, default=60, help="Number of surroundings to use")
+    parser.add_argument("-a", "--align", action="store_true", help="Compare align (sequence dependent) as well")
+    args = parser.parse_args()
+
+    structures = sorted((p.name for p in args.folder.glob("*.pdb")), key=lambda name: int(name.split("_")[0]))[:args.number]
+
+    aligned, failed = align_tile(args.sugar, args.folder, list(itertools.combinations(structures, 2)), args.align, args.save_path, preload=True)
+    pymol_values = {(s1, s2): rmsd_values for s1, s2, rmsd_values in aligned}
+
+    surroundings, not_parsed = parse_surroundings([args.folder / structure for structure in structures])
+    not_parsed.update(superpose_on_reference(surroundings, load_reference_sugar(args.sugar, args.save_path)))
+    surroundings = [surrounding for surrounding in surroundings if surrounding.name not in not_parsed]
+    positions = {f"{surrounding.name}.pdb": i for i, surrounding in enumerate(surroundings)}
+    pairs = [pair for pair in pymol_values if pair[0] in positions and pair[1] in positions]
+
+    print(f"{len(structures)} surroundings, {len(pairs)} pairs compared, {len(failed)} failed in PyMOL, {len(not_parsed)} failed in NumPy")
+    for method, match_names in [("super", False), ("align", True)]:
+        if method == "align" and not args.align:
+            continue
+        numpy_rmsd = rmsd_of_pairs(surroundings, [(positions[s1], positions[s2]) for s1, s2 in pairs], match_names)
+        pymol_rmsd = np.array([pymol_values[pair][method] for pair in pairs])
+        valid = ~np.isnan(numpy_rmsd)
+        difference = np.abs(numpy_rmsd[valid] - pymol_rmsd[valid])
+        print(f"{method}: {valid.sum()} pairs with a value, NumPy/PyMOL mean {numpy_rmsd[valid].mean():.3f}/{pymol_rmsd[valid].mean():.3f} A, "
+              f"Pearson {pearsonr(numpy_rmsd[valid], pymol_rmsd[valid])[0]:.3f}, Spearman {spearmanr(numpy_rmsd[valid], pymol_rmsd[valid])[0]:.3f}, "
+              f"|difference| median {np.median(difference):.3f} A, 95th percentile {np.percentile(difference, 95):.3f} A, max {difference.max():.3f} A")
@@ -0,0 +1,65 @@
+"""
+Capture PatternQuery surroundings of the sugar residues of the given structures as test fixtures,
+so the gemmi surroundings backend can be compared with actual PQ output (tests/test_ambient_residues.py).
+The structures and the patterns found by PQ are copied to <output>/structures and <output>/patterns.
+
+Usage (from workflow/src, in an environment with PQ and mono):
+python ../scripts/pq/capture_pq_fixtures.py --pq_dir <PatternQuery dir> --mmcif_dir <data run>/modified_mmcif_files
+    --ligands <data run>/categorization/filtered_modified_ligands.json -s NAG GLC --ids 7khu
+"""
+
+from argparse import ArgumentParser
+import json
+from pathlib import Path
+from platform import system
+import shutil
+import sys
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src"))
+
+from logger import setup_logger
+from process_handlers.run_pq import create_pq_config, create_queries, extract_results, query_residues, run_pq_process
+from utils.mmcif_files import index_mmcif_files
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--pq_dir", type=Path, required=True, help="Directory with WebChemistry.Queries.Service.exe")
+    parser.add_argument("--mmcif_dir", type=Path, required=True, help="Directory with the (modified) mmCIF files searched by PQ")
+    parser.add_argument("--ligands", type=Path, required=True, help="filtered_modified_ligands.json of the data run")
+    parser.add_argument("-s", "--sugars", nargs="+", required=True)
+    parser.add_argument("--ids", nargs="+", default=["7khu"], help="PDB IDs of the structures (default: IDs of test-config.json)")
+    parser.add_argument("--output", type=Path, default=Path(__file__).resolve().parents[2] / "tests" / "data" / "pq")
+    args = parser.parse_args()
+
+    (args.output / "structures").mkdir(exist_ok=True, parents=True)
+    (args.output / "patterns").mkdir(exist_ok=True, parents=True)
+    setup_logger(args.output / "capture.log")
+
+    with open(args.ligands, "r") as f:
+        ligands = json.load(f)
+    mmcif_files = index_mmcif_files(args.mmcif_dir)
+    ids = {pdb_id.lower() for pdb_id in args.ids}
+
+    with TemporaryDirectory() as run_dir:
+        run_dir = Path(run_dir)
+        (run_dir / "structures").mkdir()
+        (run_dir / "results").mkdir()
+        for structure, residues in ligands.items():
+            prefix, pdb_id = structure.split("_", 1)
+            structure = f"{prefix}_{pdb_id.lower()}"
+            queries = query_residues(structure, residues, args.sugars)
+            if pdb_id.lower() not in ids or not queries or structure not in mmcif_files:
+                continue
+
+            source = mmcif_files[structure]
+            shutil.copy(source, run_dir / "structures" / source.name)
+            create_pq_config(run_dir, create_queries(queries))
+            run_pq_process(run_dir, args.pq_dir, system() != "Windows")
+            extract_results(run_dir / "results" / "result" / "result.zip", [(query_id, structure, args.output / "patterns") for query_id, _ in queries])
+
+            shutil.copy(source, args.output / "structures" / source.name)
+            shutil.rmtree(run_dir / "results" / "result")
+            (run_dir / "structures" / source.name).unlink()
+            print(f"Captured {structure}: {len(queries)} queries")
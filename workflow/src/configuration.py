@@ -67,6 +67,7 @@ class Config():
     filtered_surroundings_dir: Path
     clusters_dir: Path
     structure_motif_search_dir: Path
+    rmsd_pair_store_path: Path
     dendrograms_dir: Path
     tanglegrams_dir: Path
 
@@ -118,6 +119,8 @@ class Config():
             self.filtered_surroundings_dir = self.user_cfg.results_dir / f"motif_based_search/{sugar}/{current_run}/filtered_surroundings"
             self.clusters_dir = self.user_cfg.results_dir / f"motif_based_search/{sugar}/{current_run}/clusters"
             self.structure_motif_search_dir = self.user_cfg.results_dir / f"motif_based_search/{sugar}/{current_run}/structure_motif_search"
+            # Shared by all runs of the sugar
+            self.rmsd_pair_store_path = self.user_cfg.results_dir / f"motif_based_search/{sugar}/rmsd_pair_store.sqlite"
             self.dendrograms_dir = self.user_cfg.images_dir / f"surroundings/{sugar}/{current_run}/dendrograms"
             self.tanglegrams_dir = self.user_cfg.images_dir / f"surroundings/{sugar}/{current_run}/tanglegrams"
 
@@ -25,24 +25,24 @@ from process_handlers.run_mv import run_mv
 from process_handlers.filter_ligands import filter_ligands
 
 
-def main(config: Config, is_unix: bool, res: float, rscc: float, rmsd: float, test_mode: bool) -> None:
+def main(config: Config, is_unix: bool, res: float, rscc: float, rmsd: float, test_mode: bool, workers: int = 1, download_missing: bool = False) -> None:
 
     with tqdm(total=6) as pbar: 
         pbar.set_description("Downloading files")
-        download_files(config, test_mode)
+        download_files(config, test_mode, download_missing)
         pbar.update(1)
 
         pbar.set_description("Categorizing sugars")
-        categorize(config)
+        categorize(config, workers)
         pbar.update(1)
 
         pbar.set_description("Separating alternative conformations")
-        create_separate_mmcifs(config)
+        create_separate_mmcifs(config, workers)
         # mock_altloc_separation(config)
         pbar.update(1)
 
         pbar.set_description("Extracting RSCC and resolution")
-        extract_rscc_and_resolution(config)
+        extract_rscc_and_resolution(config, workers)
         pbar.update(1)
 
         pbar.set_description("Running MotiveValidator")
@@ -68,6 +68,8 @@ if __name__ == "__main__":
                         type=float, default=0.8)
     parser.add_argument("--rmsd", help="Value of maximum RMSD of residue",
                         type=float, default=2.0)
+    parser.add_argument("--workers", help="Number of worker processes used for processing of structures", type=int, default=1)
+    parser.add_argument("--download_missing", action="store_true", help="Download files missing in the data source from RCSB, structures whose files could not be downloaded are left out")
     parser.add_argument("--keep_current_run", help="Don't end the current run (won't delete .current_run file)", action="store_true")
 
     args = parser.parse_args()
@@ -80,7 +82,7 @@ if __name__ == "__main__":
     is_unix = system() != "Windows"
 
     with logging_redirect_tqdm():
-        main(config, is_unix, args.res, args.rscc, args.rmsd, args.test_mode)
+        main(config, is_unix, args.res, args.rscc, args.rmsd, args.test_mode, args.workers, args.download_missing)
 
         if not args.keep_current_run:
             config.clear_current_run()
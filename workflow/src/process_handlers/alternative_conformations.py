@@ -5,17 +5,20 @@ Author: Kateřina Nazarčuková
 """
 
 
+from dataclasses import dataclass, field
 from enum import Enum
+from functools import partial
 import json
 import gemmi
 from pathlib import Path
-from typing import List, Dict, Set, Tuple
-from shutil import copy2
+from typing import List, Dict, Optional, Set, Tuple
 
 from tqdm import tqdm
 
 from logger import logger, setup_logger
 from configuration import Config
+from utils.mmcif_files import index_mmcif_files, link_mmcif_file, list_mmcif_files, mmcif_stem
+from utils.parallel import ordered_map
 
 
 class AltlocCase(Enum):
@@ -78,12 +81,14 @@ def delete_alternative_conformations(structure: gemmi.Structure, residues_to_kee
     return [{"name": t[0], "num": t[1], "chain": t[2]} for t in new_values]
 
 
-def save_files(structure: gemmi.Structure, input_file: Path, conformation_type: str, config: Config) -> None:
+def save_files(structure: gemmi.Structure, doc: gemmi.cif.Document, input_file: Path, conformation_type: str, config: Config) -> None:
     """
     Save new structure with no sugar altlocs to a file.
 
     :param structure: Structure to be saved
-    :param input_file: Path to the original file
+    :param doc: Document of the original file, its block is updated in place (only the categories
+                written from the structure are replaced, so it can be reused for the next conformation)
+    :param input_file: Path to the original file (.cif or .cif.gz)
     :param conformation_type: Type of conformation A or B
     :param config: Config object
     """
@@ -91,8 +96,6 @@ def save_files(structure: gemmi.Structure, input_file: Path, conformation_type:
     groups = gemmi.MmcifOutputGroups(True, chem_comp=False, entity=False, auth_all=True)
     groups.atoms = True
 
-    doc = gemmi.cif.read(str(input_file))
-
     block = doc.sole_block()
     structure.update_mmcif_block(block, groups)
 
@@ -101,30 +104,30 @@ def save_files(structure: gemmi.Structure, input_file: Path, conformation_type:
     options.align_pairs = 48
     options.align_loops = 20
 
-    new_path = config.modified_mmcif_files_dir / f"{conformation_type}_{input_file.name}"
+    new_path = config.modified_mmcif_files_dir / f"{conformation_type}_{mmcif_stem(input_file)}.cif"
     doc.write_file(str(new_path), options)
 
 
-def separate_alternative_conformations(input_file: Path, ligands: Tuple[str, List[Dict]], config: Config) -> Tuple[AltlocKind, Dict[str, List[Dict]]]:
+def separate_alternative_conformations(input_file: Path, ligands: Tuple[str, List[Dict]], config: Config, sugar_names: Set[str]) -> Tuple[AltlocKind, Dict[str, List[Dict]]]:
     """
-    Separate alternative sugar conformations.
+    Separate alternative sugar conformations. The file is read only once, the B conformation
+    is separated from an in-memory copy of the structure and written through the same document,
+    whose model categories are rewritten for each conformation.
 
-    :param input_file: Input structure for sugar conformation separation
+    :param input_file: Input structure for sugar conformation separation (.cif or .cif.gz)
     :param ligands: Sugar ligands of said structure - to update ligands.json
     :param config: Config object
+    :param sugar_names: Names of all sugar residues
     :return: Type of altloc with the new updated structure ligands
     :raises AltlocError: If the altloc type is not supported
     """
 
     logger.debug(f"Processing {input_file.name}")
-    with open(config.run_data_dir / "sugar_names.json") as f:
-        sugar_names = set(json.load(f)) # Set for optimalization
 
-    global files_support_altloc
-    global files_unsupport_altloc
-    global files_single_conform_only
-
-    structure_a = gemmi.read_structure(str(input_file))
+    doc = gemmi.cif.read(str(input_file))
+    structure_a = gemmi.make_structure_from_block(doc.sole_block())
+    # Done by gemmi.read_structure, but not by make_structure_from_block
+    structure_a.merge_chain_parts()
     structure_a.setup_entities()
 
     # Lists of alternative conformations
@@ -187,51 +190,101 @@ def separate_alternative_conformations(input_file: Path, ligands: Tuple[str, Lis
 
     ligand_values: List[Tuple[str, str, str]] = [(residue["name"], residue["num"], residue["chain"]) for residue in ligands[1]] 
 
+    if altloc_b:
+        # Copy of the original, before the A conformation is separated
+        structure_b = structure_a.clone()
+
     if altloc_a:
         # File with only A conformers
         new_values = delete_alternative_conformations(structure_a, altloc_a, altloc_b, ligand_values)
         new_dict[f"A_{old_key}"] = new_values
-        save_files(structure_a, input_file, "A", config)
+        save_files(structure_a, doc, input_file, "A", config)
 
     if altloc_b:
         # File with only B conformers
-        structure_b = gemmi.read_structure(str(input_file))
-        structure_b.setup_entities()
         new_values = delete_alternative_conformations(structure_b, altloc_b, altloc_a, ligand_values)
         new_dict[f"B_{old_key}"] = new_values
-        save_files(structure_b, input_file, "B", config)
+        save_files(structure_b, doc, input_file, "B", config)
 
     return AltlocKind.NORMAL_ALTLOC if not single_altloc_kind else AltlocKind.SINGLE_KIND_ALTLOC, new_dict     
 
 
-def create_separate_mmcifs(config: Config) -> None:
+@dataclass
+class SeparationResult:
+    """
+    Result of alternative conformation separation of one file.
+    """
+
+    altloc_kind: Optional[AltlocKind]
+    new_ligands: Dict[str, List[Dict]] = field(default_factory=dict)
+    error: Optional[str] = None
+
+
+def separate_file(item: Tuple[Path, str, List[Dict]], config: Config, sugar_names: Set[str]) -> SeparationResult:
+    """
+    Separate alternative conformations of one file and write the resulting A, B or 0 files.
+
+    :param item: Path to the input file, its PDB ID and its sugar ligands
+    :param config: Config object
+    :param sugar_names: Names of all sugar residues
+    :return: Type of altloc and the new ligands, or the error if the altloc type is not supported
+    """
+
+    file, pdb_id, structure_ligands = item
+    try:
+        altloc_kind, new_ligands = separate_alternative_conformations(file, (pdb_id, structure_ligands), config, sugar_names)
+    except AltlocError as e:
+        return SeparationResult(None, error=str(e))
+
+    if altloc_kind == AltlocKind.NO_ALTLOC:
+        link_mmcif_file(file, config.modified_mmcif_files_dir, f"0_{mmcif_stem(file)}")
+
+    return SeparationResult(altloc_kind, new_ligands)
+
+
+def create_separate_mmcifs(config: Config, workers: int = 1) -> None:
+    """
+    Separate alternative conformations of sugars in all structures with ligands.
+
+    :param config: Config object
+    :param workers: Number of worker processes
+    """
+
     config.modified_mmcif_files_dir.mkdir(exist_ok=True, parents=True)
 
     with open(config.categorization_dir / "ligands.json", "r") as f:
         ligands: Dict[str, List[Dict]] = json.load(f)
+    with open(config.run_data_dir / "sugar_names.json") as f:
+        sugar_names = set(json.load(f)) # Set for optimalization
 
     unsupported_altloc = 0
     supported_altloc = 0
     one_altloc_kind = 0
 
-    ids = [id.lower() for id in ligands.keys()]
+    # Look up only the files of structures with ligands, in the order of their file names
+    mmcif_files = index_mmcif_files(config.mmcif_files_dir)
+    items: List[Tuple[Path, str, List[Dict]]] = []
+    for pdb_id in sorted(ligands, key=str.lower):
+        if pdb_id.lower() not in mmcif_files:
+            logger.warning(f"No mmCIF file of {pdb_id} found in {config.mmcif_files_dir}")
+            continue
+        items.append((mmcif_files[pdb_id.lower()], pdb_id, ligands[pdb_id]))
+
+    results = ordered_map(partial(separate_file, config=config, sugar_names=sugar_names), items, workers, desc="Processing mmCIF files")
+
     modified_ligands: Dict[str, List[Dict]] = {}
-    for file in tqdm(sorted(config.mmcif_files_dir.glob("*.cif")), desc="Processing mmCIF files"):
-        if file.stem in ids:
-            try:
-                altloc_kind, new_ligands = separate_alternative_conformations(file, (file.stem.upper(), ligands[file.stem.upper()]), config)
-                modified_ligands.update(new_ligands)
-                if altloc_kind == AltlocKind.NO_ALTLOC:
-                    copy2(file, config.modified_mmcif_files_dir / f"0_{file.name}")
-                elif altloc_kind == AltlocKind.NORMAL_ALTLOC:
-                    supported_altloc += 1
-                elif altloc_kind == AltlocKind.SINGLE_KIND_ALTLOC:
-                    supported_altloc += 1
-                    one_altloc_kind += 1
-                
-            except AltlocError as e:
-                unsupported_altloc += 1
-                logger.error(f"Exception caught: {e}")
+    for result in results:
+        if result.error is not None:
+            unsupported_altloc += 1
+            logger.error(f"Exception caught: {result.error}")
+            continue
+
+        modified_ligands.update(result.new_ligands)
+        if result.altloc_kind == AltlocKind.NORMAL_ALTLOC:
+            supported_altloc += 1
+        elif result.altloc_kind == AltlocKind.SINGLE_KIND_ALTLOC:
+            supported_altloc += 1
+            one_altloc_kind += 1
 
     with open(config.categorization_dir / "modified_ligands.json", "w", encoding="utf8") as f:
         json.dump(modified_ligands, f, indent=4)
@@ -257,10 +310,11 @@ def mock_altloc_separation(config: Config) -> None:
 
     ids = [id.lower() for id in ligands.keys()]
     modified_ligands: Dict[str, List[Dict]] = {}
-    for file in tqdm(sorted(config.mmcif_files_dir.glob("*.cif")), desc="Processing mmCIF files"):
-        if file.stem in ids:
-            modified_ligands.update({f"0_{file.stem.upper()}": ligands[file.stem.upper()]})
-            copy2(file, config.modified_mmcif_files_dir / f"0_{file.name}")
+    for file in tqdm(list_mmcif_files(config.mmcif_files_dir), desc="Processing mmCIF files"):
+        stem = mmcif_stem(file)
+        if stem in ids:
+            modified_ligands.update({f"0_{stem.upper()}": ligands[stem.upper()]})
+            link_mmcif_file(file, config.modified_mmcif_files_dir, f"0_{stem}")
 
 
     with open(config.categorization_dir / "modified_ligands.json", "w", encoding="utf8") as f:
@@ -0,0 +1,137 @@
+"""
+Script Name: ambient_residues.py
+Description: Extract sugar surroundings (residues within a distance of the sugar) with gemmi,
+             an in-process alternative to PatternQuery AmbientResidues queries.
+Author: Kateřina Nazarčuková
+"""
+
+
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+import gemmi
+
+
+AMBIENT_RADIUS = 5.0
+
+
+def parse_seqid(num: str) -> gemmi.SeqId:
+    """
+    Parse (author) residue number with an optional insertion code, e.g. 12 or 12A.
+
+    :param num: Residue number
+    :return: Sequence ID of the residue
+    """
+
+    num = num.strip()
+    if num[-1:].isalpha():
+        return gemmi.SeqId(int(num[:-1]), num[-1])
+
+    return gemmi.SeqId(int(num), " ")
+
+
+def find_residue(model: gemmi.Model, residue: Dict[str, str]) -> Tuple[int, int]:
+    """
+    Find the residue in the model by its name, (author) sequence ID and chain. The insertion code
+    must match too, a residue number without it matches only the residue without an insertion code.
+
+    :param model: Model to search in
+    :param residue: Residue with name, num (optionally with an insertion code) and chain
+    :return: Index of the chain and of the residue in the chain
+    :raises ValueError: If the residue is not found
+    """
+
+    seqid = parse_seqid(residue["num"])
+    for chain_idx, chain in enumerate(model):
+        if chain.name != residue["chain"]:
+            continue
+        for residue_idx, res in enumerate(chain):
+            if res.seqid.num == seqid.num and res.seqid.icode == seqid.icode and res.name == residue["name"]:
+                return chain_idx, residue_idx
+
+    raise ValueError(f"Residue {residue['name']} {residue['num']} {residue['chain']} not found")
+
+
+def ambient_residues(model: gemmi.Model, search: gemmi.NeighborSearch, chain_idx: int, residue_idx: int, radius: float = AMBIENT_RADIUS) -> Set[Tuple[int, int]]:
+    """
+    Find residues with at least one atom within <radius> of any atom of the given residue,
+    the residue itself included (same as PQ AmbientResidues). Symmetry mates are not considered.
+
+    :param model: Model the residue is in
+    :param search: Populated neighbor search of the model
+    :param chain_idx: Index of the chain of the residue
+    :param residue_idx: Index of the residue in the chain
+    :param radius: Maximal distance of atoms in angstroms
+    :return: Indices of the chains and residues of the surrounding
+    """
+
+    found = {(chain_idx, residue_idx)}
+    for atom in model[chain_idx][residue_idx]:
+        for mark in search.find_atoms(atom.pos, "\0", radius=radius):
+            if (mark.chain_idx, mark.residue_idx) in found:
+                continue
+            cra = mark.to_cra(model)
+            if cra.atom.pos.dist(atom.pos) <= radius:
+                found.add((mark.chain_idx, mark.residue_idx))
+
+    return found
+
+
+def surrounding_structure(structure: gemmi.Structure, model: gemmi.Model, residues: Set[Tuple[int, int]]) -> gemmi.Structure:
+    """
+    Create a new structure with only the given residues of the model, in their original order.
+    Chain names are shortened to their first character, as they are in PQ patterns in PDB format.
+
+    :param structure: The original structure
+    :param model: Model the residues are in
+    :param residues: Indices of the chains and residues to keep
+    :return: Structure of the surrounding
+    """
+
+    surrounding = gemmi.Structure()
+    surrounding.name = structure.name
+    surrounding.cell = structure.cell
+    surrounding.spacegroup_hm = structure.spacegroup_hm
+
+    new_model = gemmi.Model(model.num)
+    for chain_idx, chain in enumerate(model):
+        kept = [residue_idx for residue_idx in range(len(chain)) if (chain_idx, residue_idx) in residues]
+        if not kept:
+            continue
+        new_chain = gemmi.Chain(chain.name[0])
+        for residue_idx in kept:
+            new_chain.add_residue(chain[residue_idx])
+        new_model.add_chain(new_chain, unique_name=False)
+    surrounding.add_model(new_model)
+
+    return surrounding
+
+
+def extract_surroundings(item: Tuple[Path, List[Tuple[str, Dict[str, str]]]], targets: Dict[str, Path], radius: float = AMBIENT_RADIUS) -> List[str]:
+    """
+    Extract surroundings of all given residues of one structure, the structure is read only once.
+    Every surrounding is saved as <query id>.pdb to the folder of its sugar, the same as surroundings found by PQ.
+
+    :param item: Path to the mmCIF file and the residues with their query IDs
+    :param targets: The common folders to save the surroundings to, keyed by sugar
+    :param radius: Maximal distance of atoms in angstroms
+    :return: Query IDs of the residues that could not be found
+    """
+
+    path, queries = item
+
+    structure = gemmi.read_structure(str(path))
+    model = structure[0]
+    search = gemmi.NeighborSearch(model, gemmi.UnitCell(), radius).populate()
+
+    not_found = []
+    for query_id, residue in queries:
+        try:
+            chain_idx, residue_idx = find_residue(model, residue)
+        except ValueError:
+            not_found.append(query_id)
+            continue
+        surrounding = surrounding_structure(structure, model, ambient_residues(model, search, chain_idx, residue_idx, radius))
+        surrounding.write_pdb(str(targets[residue["name"]] / f"{query_id}.pdb"))
+
+    return not_found
@@ -6,53 +6,46 @@ Credits: Original concept by Daniela Repelová, modifications by Kateřina Nazar
 """
 
 
+from dataclasses import dataclass, field
+from functools import partial
 import json
-from typing import List, Dict, Set, Union
+from pathlib import Path
+from typing import List, Dict, Set, Tuple, Union
 
 import gemmi
 from gemmi.cif import Block, Table  # type: ignore
-import gzip
 
-from tqdm import tqdm
 from logger import logger, setup_logger
 
 from configuration import Config
+from utils.mmcif_files import index_mmcif_files
+from utils.parallel import ordered_map
+from utils.residue_index import residue_key
 
-ligands = {}  # all ligands from all structures
-glycosylated = {}  # all glycosylated residues according to conn category from all structures
-close_contacts = {}  # all sugar residues from close contacts which are not in conn
-
-all_residues = {}  # all sugar residues from all structures
-
-# The sum of all residues from ligands, glycosylated and close_contacts
-# should be equal to number of residues in all_residues
-# but this does not work for the sum of the pdb structures because
-# there can be ligand and also glycosylation and close_contact in one structure.
-# To make sure the script works properly, here are the control lists of pdb structures
-# for every group, to check whether the sum is right.
-
-pdb_only_ligands = []
-pdb_only_glycosylated = []
-pdb_only_close_contacts = []
-
-pdb_ligand_glycosylated = []
-pdb_ligand_close_contacts = []
-pdb_glycosylated_close_contacts = []
-pdb_lig_glyc_close = []
 
+@dataclass
+class CategorizedStructure:
+    """
+    Sugar residues of one structure sorted into categories, with the irregularities found.
+    """
 
-res_gycosyl_residue_not_1 = []
+    name: str
+    all_residues: List[Dict[str, str]] = field(default_factory=list)
+    ligands: List[Dict[str, str]] = field(default_factory=list)
+    glycosylated: List[Dict[str, str]] = field(default_factory=list)
+    close_contacts: List[Dict[str, str]] = field(default_factory=list)
 
-# some structures have sugars, but they are listed in the wrong category
-# so it is not possible to automatize the search - they are excluded
-pdb_sugars_in_wrong_category = set()
+    # residues that exist in different conformations
+    conformers: List[str] = field(default_factory=list)
+    gycosyl_residue_not_1: List[str] = field(default_factory=list)
 
-# after remediation of PDB database, all glycosylations should be anotated
-# in struct_conn.pdbx_role but some are still missing
-pdb_not_anotated_glycosylation = set()
+    # some structures have sugars, but they are listed in the wrong category
+    # so it is not possible to automatize the search - they are excluded
+    sugars_in_wrong_category: bool = False
 
-# how many residues exists in different conformations
-overall_conformers = []
+    # after remediation of PDB database, all glycosylations should be anotated
+    # in struct_conn.pdbx_role but some are still missing
+    not_anotated_glycosylation: bool = False
 
 
 AMINO_ACIDS = [
@@ -62,16 +55,44 @@ AMINO_ACIDS = [
     "Ser","Thr", "Val", "Trp", "Tyr",
 ]
 
-SUGAR_NAMES = []
+
+def remove_residues(residues: List[Dict[str, str]], keys: Set[Tuple[str, str, str]]) -> None:
+    """
+    Remove residues with the given keys from the list in place, keeping the order of the rest.
+
+    :param residues: List of residues
+    :param keys: Keys of the residues to remove
+    """
+
+    if keys:
+        residues[:] = [residue for residue in residues if residue_key(residue) not in keys]
 
 
-def extract_sugars(table: Table) -> List[Dict[str, str]]:
+def remove_oligo_chains(oligo: List[Dict[str, str]], chains: Set[str]) -> List[Dict[str, str]]:
+    """
+    Remove all residues of the given chains from oligo in place.
+
+    :param oligo: List of oligosaccharides
+    :param chains: Chains of the oligosaccharides to remove
+    :return: Removed residues, from the last to the first one
+    """
+
+    removed = [residue for residue in reversed(oligo) if residue["chain"] in chains]
+    if removed:
+        oligo[:] = [residue for residue in oligo if residue["chain"] not in chains]
+
+    return removed
+
+
+def extract_sugars(table: Table, sugar_names: Set[str], result: CategorizedStructure) -> List[Dict[str, str]]:
     """
     Gets a list of dictionaries, in which one dictionary represents single
     sugar residue present in the given table (either monosacharide or one
     residue form oligosaccharide).
 
     :param table: Monosaccharide or oligosaccharide table to extract sugars from
+    :param sugar_names: Names of all sugar residues
+    :param result: Categorization of the structure, to record residues with more conformers
     :return: List of sugars extracted from monosaccharide or oligosaccharide table
     """
 
@@ -81,7 +102,7 @@ def extract_sugars(table: Table) -> List[Dict[str, str]]:
     # but different name listed in the mmCIF file. PQ can find only the first one.
     conformers = []
     for row in table:
-        if row[0] in SUGAR_NAMES:
+        if row[0] in sugar_names:
             res = f"{row[1]} {row[2]}"
             if res not in conformers:
                 conformers.append(res)
@@ -89,12 +110,12 @@ def extract_sugars(table: Table) -> List[Dict[str, str]]:
                     {"name": row[0], "num": row[1], "chain": row[2]}
                 )
             else:
-                overall_conformers.append(res)
+                result.conformers.append(res)
 
     return extracted_sugars
 
 
-def remove_connections(block: Block, mono: List[Dict[str, str]], oligo: List[Dict[str, str]]) -> List[Dict[str, str]]:
+def remove_connections(block: Block, mono: List[Dict[str, str]], oligo: List[Dict[str, str]], sugar_names: Set[str], result: CategorizedStructure) -> List[Dict[str, str]]:
     """
     Remove glycosylated residues from mono and oligo (modify the lists in place)
     and return list of glycosylated residues (according to conn).
@@ -102,6 +123,8 @@ def remove_connections(block: Block, mono: List[Dict[str, str]], oligo: List[Dic
     :param block: mmCIF file block
     :param mono: List of monosaccharides
     :param oligo: List of oligosaccharides
+    :param sugar_names: Names of all sugar residues
+    :param result: Categorization of the structure, to record irregularities
     :return: List of glycosylated residues
     """
 
@@ -111,6 +134,11 @@ def remove_connections(block: Block, mono: List[Dict[str, str]], oligo: List[Dic
     # so it is possible to remove all residues from that chain
     glycosylated_oligo_chains = set()
 
+    # keys of the residues still present in mono and of all residues in oligo
+    mono_keys = {residue_key(residue) for residue in mono}
+    oligo_keys = {residue_key(residue) for residue in oligo}
+    removed_mono_keys = set()
+
     conn = block.find(
         "_struct_conn.",
         [
@@ -124,43 +152,44 @@ def remove_connections(block: Block, mono: List[Dict[str, str]], oligo: List[Dic
     )
     has_role = conn.has_column(5)
     if not has_role:
-        pdb_not_anotated_glycosylation.add(block.name)
+        result.not_anotated_glycosylation = True
     for row in conn:
         # only covalent connection between AK and sugar are relevant
-        if (row[0] == "covale" and row[1].capitalize() in AMINO_ACIDS and row[3] in SUGAR_NAMES):
+        if (row[0] == "covale" and row[1].capitalize() in AMINO_ACIDS and row[3] in sugar_names):
             res = {"name": row[3], "num": row[4], "chain": row[2]}
+            key = residue_key(res)
 
-            if res in mono:
+            if key in mono_keys:
                 glycosylated_residues.append(res)  # save the glycosylated mono
-                mono.remove(res)  # remove it from the original list where we want only ligands
+                # remove it from the original list where we want only ligands
+                mono_keys.remove(key)
+                removed_mono_keys.add(key)
 
                 if has_role and "glycosyl" not in row[5].lower():
-                    pdb_not_anotated_glycosylation.add(block.name)
+                    result.not_anotated_glycosylation = True
 
-            elif res in oligo:
+            elif key in oligo_keys:
                 glycosylated_oligo_chains.add(res["chain"])  # save the letter of the chain
 
                 if res["num"] != "1":
-                    res_gycosyl_residue_not_1.append(f"{block.name}_{res['name']}_{res['num']}_{res['chain']}")
+                    result.gycosyl_residue_not_1.append(f"{block.name}_{res['name']}_{res['num']}_{res['chain']}")
 
                 if not has_role:
-                    pdb_not_anotated_glycosylation.add(block.name)
+                    result.not_anotated_glycosylation = True
                 else:
                     if "glycosyl" not in row[5].lower():
-                        pdb_not_anotated_glycosylation.add(block.name)
+                        result.not_anotated_glycosylation = True
 
+    remove_residues(mono, removed_mono_keys)
 
     # add the whole glycosylated oligosacharide to glycosylated_residues
     # and remove it from the original list where we want only ligands
-    for i in range(len(oligo) - 1, -1, -1):
-        if oligo[i]["chain"] in glycosylated_oligo_chains:
-            glycosylated_residues.append(oligo[i])
-            del oligo[i]
+    glycosylated_residues.extend(remove_oligo_chains(oligo, glycosylated_oligo_chains))
 
     return glycosylated_residues
 
 
-def remove_close_contacts(block: Block, mono: List[Dict[str, str]], oligo: List[Dict[str, str]]) -> List[Dict[str, str]]:
+def remove_close_contacts(block: Block, mono: List[Dict[str, str]], oligo: List[Dict[str, str]], sugar_names: Set[str]) -> List[Dict[str, str]]:
     """
     Close contacts category lists pairs of atoms from all residues, which are in so close proximity
     we cannot be sure whether there is or is not a bond. Sometimes the residues from which the pair is
@@ -170,12 +199,17 @@ def remove_close_contacts(block: Block, mono: List[Dict[str, str]], oligo: List[
     :param block: mmCIF file block
     :param mono: List of monosaccharides
     :param oligo: List of oligosaccharides
+    :param sugar_names: Names of all sugar residues
     :return: List of residues that are in close contact
     """
 
     close_contact_residues = []
     close_contact_oligo_chains = set()  # Chain to be deleted from ligands
 
+    mono_keys = {residue_key(residue) for residue in mono}
+    oligo_keys = {residue_key(residue) for residue in oligo}
+    close_contact_keys = set()
+
     close_contact = block.find(
         "_pdbx_validate_close_contact.",
         [
@@ -187,22 +221,22 @@ def remove_close_contacts(block: Block, mono: List[Dict[str, str]], oligo: List[
         ]
     )
     for row in close_contact:
-        if row[0].capitalize() in AMINO_ACIDS and row[2] in SUGAR_NAMES:
+        if row[0].capitalize() in AMINO_ACIDS and row[2] in sugar_names:
             res = {"name": row[2], "num": row[3], "chain": row[1]}
+            key = residue_key(res)
             # one residue can be listed more than once in case more than one atom from it
-            # is in the close proximity of some atom from AA. Since it is not possible to create a set
-            # of dictionaries, it is nessessary to check if there already is the residue.
-            if res in mono and res not in close_contact_residues:
+            # is in the close proximity of some atom from AA, so its key is removed from mono keys
+            # when it is found for the first time.
+            if key in mono_keys:
                 close_contact_residues.append(res)
-                mono.remove(res)
-            elif res in oligo:
+                mono_keys.remove(key)
+                close_contact_keys.add(key)
+            elif key in oligo_keys:
                 # Save the chain to remove the whole oligosaccharide
                 close_contact_oligo_chains.add(res["chain"])
 
-    for i in range(len(oligo) - 1, -1, -1):
-        if oligo[i]["chain"] in close_contact_oligo_chains:
-            close_contact_residues.append(oligo[i])
-            del oligo[i]
+    remove_residues(mono, close_contact_keys)
+    close_contact_residues.extend(remove_oligo_chains(oligo, close_contact_oligo_chains))
 
     return close_contact_residues
 
@@ -235,83 +269,148 @@ def count_num_residues(res_in_whole_struct: Dict) -> int:
     return sum([len(residues) for residues in res_in_whole_struct.values()])
 
 
-def categorize(config: Config) -> None:
+def categorize_structure(mmcif_file: Path, sugar_names: Set[str]) -> CategorizedStructure:
+    """
+    Categorize sugar residues of a single structure into ligands, glycosylated residues and close contacts.
+
+    :param mmcif_file: Path to the mmCIF file of the structure (.cif or .cif.gz)
+    :param sugar_names: Names of all sugar residues
+    :return: Categorization of the structure
+    """
+
+    monosacharides = []
+    oligosacharides = []
+
+    # gemmi reads the gzipped file directly, plain copy is made only if a later stage needs it
+    doc = gemmi.cif.read(str(mmcif_file))
+    block = doc.sole_block()
+    result = CategorizedStructure(block.name)
+    entities: List[str] = list(block.find_values("_entity.type"))
+    if "branched" in entities:
+        oligo_table = block.find("_pdbx_branch_scheme.", ["pdb_mon_id", "pdb_seq_num", "pdb_asym_id"])
+        oligosacharides = extract_sugars(oligo_table, sugar_names, result)
+
+    if "non-polymer" in entities:
+        mono_table = block.find("_pdbx_nonpoly_scheme.", ["pdb_mon_id", "pdb_seq_num", "pdb_strand_id"])
+        monosacharides = extract_sugars(mono_table, sugar_names, result)
+
+    result.all_residues = oligosacharides.copy()
+    result.all_residues.extend(monosacharides)
+
+    # If no sugar residues were found, skip to the next structure
+    if not result.all_residues:
+        result.sugars_in_wrong_category = True
+        return result
+
+    # Remove glycosylations and close contacts from mono and oligosaccharides.
+    # Dictionaries are modified in place.
+    result.glycosylated = remove_connections(block, monosacharides, oligosacharides, sugar_names, result)
+    result.close_contacts = remove_close_contacts(block, monosacharides, oligosacharides, sugar_names)
+
+    # What is left in mono and oligosaccharides are only ligands
+    result.ligands = monosacharides.copy()
+    result.ligands.extend(oligosacharides)
+
+    return result
+
+
+def categorize(config: Config, workers: int = 1) -> None:
+    """
+    Categorize sugar residues from all structures and save the categories into JSON files.
+    Structures are categorized independently and merged in the input order, so the output
+    does not depend on the number of workers.
+
+    :param config: Config object
+    :param workers: Number of worker processes
+    """
+
     config.categorization_dir.mkdir(exist_ok=True, parents=True)
 
-    global SUGAR_NAMES
     with (config.run_data_dir / "sugar_names.json").open() as f: 
-        SUGAR_NAMES = json.load(f)
+        sugar_names: Set[str] = set(json.load(f))
 
     logger.info(config.run_data_dir)
     with (config.run_data_dir / "pdb_ids_intersection_pq_ccd.json").open() as f:
         pdb_files: List[str] = json.load(f)
 
-    for pdb in tqdm(pdb_files, desc="Processing mmCIF files"):
-        logger.debug(pdb)
-        pdb_gz_path = config.mmcif_files_dir / f"{pdb}.cif.gz"
-        with gzip.open(pdb_gz_path, 'rb') as f_in:
-            with open(config.mmcif_files_dir / f"{pdb}.cif", 'wb') as f_out:
-                f_out.write(f_in.read())
+    mmcif_files = index_mmcif_files(config.mmcif_files_dir)
+    missing = [pdb for pdb in pdb_files if pdb not in mmcif_files]
+    if missing:
+        raise FileNotFoundError(f"No mmCIF file found in {config.mmcif_files_dir} for: {missing}")
 
-        pdb_gz_path.unlink()
+    results = ordered_map(partial(categorize_structure, sugar_names=sugar_names),
+                          [mmcif_files[pdb] for pdb in pdb_files], workers, desc="Processing mmCIF files", chunksize=16)
 
-        monosacharides = []
-        oligosacharides = []
+    ligands = {}  # all ligands from all structures
+    glycosylated = {}  # all glycosylated residues according to conn category from all structures
+    close_contacts = {}  # all sugar residues from close contacts which are not in conn
 
-        doc = gemmi.cif.read(str(config.mmcif_files_dir / f"{pdb}.cif"))
-        block = doc.sole_block()
-        entities: List[str] = list(block.find_values("_entity.type"))
-        if "branched" in entities:
-            oligo_table = block.find("_pdbx_branch_scheme.", ["pdb_mon_id", "pdb_seq_num", "pdb_asym_id"])
-            oligosacharides = extract_sugars(oligo_table)
+    all_residues = {}  # all sugar residues from all structures
 
-        if "non-polymer" in entities:
-            mono_table = block.find("_pdbx_nonpoly_scheme.", ["pdb_mon_id", "pdb_seq_num", "pdb_strand_id"])
-            monosacharides = extract_sugars(mono_table)
+    # The sum of all residues from ligands, glycosylated and close_contacts
+    # should be equal to number of residues in all_residues
+    # but this does not work for the sum of the pdb structures because
+    # there can be ligand and also glycosylation and close_contact in one structure.
+    # To make sure the script works properly, here are the control lists of pdb structures
+    # for every group, to check whether the sum is right.
 
-        current_all_residues = oligosacharides.copy()
-        current_all_residues.extend(monosacharides)
+    pdb_only_ligands = []
+    pdb_only_glycosylated = []
+    pdb_only_close_contacts = []
 
-        # If no sugar residues were found, skip to the next structure
-        if not current_all_residues:
-            pdb_sugars_in_wrong_category.add(block.name)
-            continue
+    pdb_ligand_glycosylated = []
+    pdb_ligand_close_contacts = []
+    pdb_glycosylated_close_contacts = []
+    pdb_lig_glyc_close = []
+
+    res_gycosyl_residue_not_1 = []
+
+    # Kept in the input order (instead of a set) so the saved files are deterministic
+    pdb_sugars_in_wrong_category: Dict[str, None] = {}
+    pdb_not_anotated_glycosylation: Dict[str, None] = {}
 
-        all_residues[block.name] = current_all_residues
+    # how many residues exists in different conformations
+    overall_conformers = []
 
+    for result in results:
+        overall_conformers.extend(result.conformers)
+        res_gycosyl_residue_not_1.extend(result.gycosyl_residue_not_1)
+        if result.not_anotated_glycosylation:
+            pdb_not_anotated_glycosylation[result.name] = None
+
+        if result.sugars_in_wrong_category:
+            pdb_sugars_in_wrong_category[result.name] = None
+            continue
 
-        # Remove glycosylations and close contacts from mono and oligosaccharides.
-        # Dictionaries are modified in place.
-        current_glycosylated = remove_connections(block, monosacharides, oligosacharides)
-        current_close_contacts = remove_close_contacts(block, monosacharides, oligosacharides)
+        all_residues[result.name] = result.all_residues
 
-        # What is left in mono and oligosaccharides are only ligands
-        current_ligands = monosacharides.copy()
-        current_ligands.extend(oligosacharides)
+        current_ligands = result.ligands
+        current_glycosylated = result.glycosylated
+        current_close_contacts = result.close_contacts
 
         # Store residues from the current structure to the appropirate groups
         if current_ligands:
-            ligands[block.name] = current_ligands
+            ligands[result.name] = current_ligands
         if current_glycosylated:
-            glycosylated[block.name] = current_glycosylated
+            glycosylated[result.name] = current_glycosylated
         if current_close_contacts:
-            close_contacts[block.name] = current_close_contacts
+            close_contacts[result.name] = current_close_contacts
 
         if current_ligands and not current_glycosylated and not current_close_contacts:
-            pdb_only_ligands.append(block.name)
+            pdb_only_ligands.append(result.name)
         if current_glycosylated and not current_ligands and not current_close_contacts:
-            pdb_only_glycosylated.append(block.name)
+            pdb_only_glycosylated.append(result.name)
         if current_close_contacts and not current_ligands and not current_glycosylated:
-            pdb_only_close_contacts.append(block.name)
+            pdb_only_close_contacts.append(result.name)
 
         if current_ligands and current_glycosylated and not current_close_contacts:
-            pdb_ligand_glycosylated.append(block.name)
+            pdb_ligand_glycosylated.append(result.name)
         if current_glycosylated and current_close_contacts and not current_ligands:
-            pdb_glycosylated_close_contacts.append(block.name)
+            pdb_glycosylated_close_contacts.append(result.name)
         if current_close_contacts and current_ligands and not current_glycosylated:
-            pdb_ligand_close_contacts.append(block.name)
+            pdb_ligand_close_contacts.append(result.name)
         if current_ligands and current_glycosylated and current_close_contacts:
-            pdb_lig_glyc_close.append(block.name)
+            pdb_lig_glyc_close.append(result.name)
 
     # Save everything
     save_category(ligands, "ligands", config)
@@ -325,8 +424,8 @@ def categorize(config: Config) -> None:
     save_category(pdb_ligand_close_contacts, "pdb_ligand_close_contacts", config)
     save_category(pdb_glycosylated_close_contacts, "pdb_glycosylated_close_contacts", config)
     save_category(pdb_lig_glyc_close, "pdb_lig_glyc_close", config)
-    save_category(pdb_sugars_in_wrong_category, "pdb_sugars_in_wrong_category", config)
-    save_category(pdb_not_anotated_glycosylation, "pdb_not_anotated_glycosylation", config)
+    save_category(list(pdb_sugars_in_wrong_category), "pdb_sugars_in_wrong_category", config)
+    save_category(list(pdb_not_anotated_glycosylation), "pdb_not_anotated_glycosylation", config)
 
     # Print counts of everything
     logger.info(f"Number of residues with multiple conformations: {len(overall_conformers)}")
@@ -15,10 +15,10 @@ from typing import Union
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.cluster.hierarchy as sch
-import scipy.spatial.distance as ssd
 from logger import logger, setup_logger
 
 from configuration import Config
+from utils.condensed_matrix import condensed_index, load_rmsd_matrix, square_size
 
 
 def perform_data_clustering(sugar: str, number: int, method: str, 
@@ -41,10 +41,12 @@ def perform_data_clustering(sugar: str, number: int, method: str,
     logger.info(f"Clustering data from {align_method}")
     config.dendrograms_dir.mkdir(exist_ok=True, parents=True)
 
-    data = np.load(config.clusters_dir / align_method / f"{sugar}_all_pairs_rmsd_{align_method}.npy")
+    # Condensed form of the matrix, memory-mapped
+    D = load_rmsd_matrix(config.clusters_dir / align_method, sugar, align_method)
+    n = square_size(D)
 
-    # Create densed form of the matrix
-    D = ssd.squareform(data)
+    def rmsd(i: int, j: int) -> float:
+        return 0.0 if i == j else float(D[condensed_index(n, i, j)])
 
     # Calculate the linkage matrix using given cluster_method
     Z1 = sch.linkage(D, method=method)
@@ -97,7 +99,7 @@ def perform_data_clustering(sugar: str, number: int, method: str,
         for i in structures:
             sum = 0
             for j in structures:
-                sum += data[i, j]
+                sum += rmsd(i, j)
                 if sum < lowest_rmsd_sum:
                     lowest_rmsd_sum = sum
                     representative_structure = i
@@ -109,7 +111,7 @@ def perform_data_clustering(sugar: str, number: int, method: str,
     for cluster, structure in representatives.items():
         sum = 0
         for _, structure2 in representatives.items():
-            sum += data[structure, structure2]
+            sum += rmsd(structure, structure2)
             average_rmsds[cluster].append(sum/number)
 
     with open(config.clusters_dir / align_method / f"{number}_{method}_average_rmsds.csv",
@@ -9,12 +9,11 @@ Credits: Original concept by Daniela Repelová, modifications by Kateřina Nazar
 from argparse import ArgumentParser
 
 import process_handlers.modified_tanglegram
-import numpy as np
 import scipy.cluster.hierarchy as sph
-import scipy.spatial.distance as spd
 from logger import logger, setup_logger
 
 from configuration import Config
+from utils.condensed_matrix import load_rmsd_matrix
 
 
 def create_tanglegram(sugar: str, number: int, method: str, config: Config, perform_align: bool) -> None:
@@ -35,12 +34,9 @@ def create_tanglegram(sugar: str, number: int, method: str, config: Config, perf
     logger.info("Creating tanglegram")
     config.tanglegrams_dir.mkdir(exist_ok=True, parents=True)
 
-    data_super = np.load(config.clusters_dir / "super" / f"{sugar}_all_pairs_rmsd_super.npy")
-    data_align = np.load(config.clusters_dir / "align" / f"{sugar}_all_pairs_rmsd_align.npy")
-
-    # Create densed form of the matrix
-    D_super = spd.squareform(data_super)
-    D_align = spd.squareform(data_align)
+    # Condensed form of the matrices, memory-mapped
+    D_super = load_rmsd_matrix(config.clusters_dir / "super", sugar, "super")
+    D_align = load_rmsd_matrix(config.clusters_dir / "align", sugar, "align")
 
     # Compute the linkage matrix using given cluster_method
     Z_super = sph.linkage(D_super, method=method)
@@ -6,6 +6,7 @@ import subprocess
 
 from logger import logger
 from configuration import Config
+from utils.directory_inventory import DirectoryInventory
 
 class DataSourceHandler(ABC):
     """
@@ -72,6 +73,7 @@ class LocalDataHandler(DataSourceHandler):
     def create_sym_links(self, file_list: List[str], src_dir: Path, dest_dir: Path) -> None:
         """
         Create symbolic links in <dest_dir> for each file in file_list, pointing to the files in <src_dir>.
+        Both directories are listed once, instead of checking every file on disk.
 
         :param file_list: List of files to link
         :param src_dir: Source directory of files to link
@@ -80,15 +82,18 @@ class LocalDataHandler(DataSourceHandler):
 
         dest_dir.mkdir(parents=True, exist_ok=True)
 
+        src_files = DirectoryInventory(src_dir)
+        dest_files = DirectoryInventory(dest_dir)
+
         for file_name in file_list:
             src_file = src_dir / file_name
             dest_link = dest_dir / file_name
 
-            if not src_file.exists():
+            if not src_files.exists(file_name):
                 logger.warning(f"Source file does not exist: {src_file}")
                 continue
 
-            if dest_link.exists() or dest_link.is_symlink():
+            if file_name in dest_files:
                 dest_link.unlink()
 
             dest_link.symlink_to(src_file)
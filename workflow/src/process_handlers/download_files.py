@@ -7,41 +7,59 @@ Credits: Original concept by Daniela Repelová, modifications by Kateřina Nazar
 
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 import json
-from os import listdir
 import pandas as pd
 from pathlib import Path
-from time import sleep
 from typing import List, Set
 
-import gemmi
 import requests
+from tqdm import tqdm
 from logger import logger, setup_logger
 
 from configuration import Config
 
 from . import data_source_tools
+from utils.ccd_index import ccd_release, index_ccd
+from utils.directory_inventory import DirectoryInventory
+from utils.download_cache import download_cached
+from utils.http_session import create_session
+from utils.materialize import materialize
+from utils.parallel_download import download_all
 from utils.unzip_file import unzip_single_file
 
 
-def get_components_file(config: Config) -> None:
+CCD_COMPONENTS_URL = "https://files.wwpdb.org/pub/pdb/data/monomers/components.cif.gz"
+PDBE_API_URL = "https://www.ebi.ac.uk/pdbe/api"
+LOOKUP_WORKERS = 8
+DOWNLOAD_WORKERS = 8
+REQUESTS_PER_SECOND = 10
+
+
+def get_components_file(config: Config, url: str = CCD_COMPONENTS_URL) -> None:
     """
-    Download components.cif.gz from CCD (Chemical Component Dictionary).
+    Get components.cif.gz from CCD (Chemical Component Dictionary). The file is downloaded
+    to data_dir/cache/downloads only if it changed since the last download (see download_cached),
+    the cached copy is then linked into the components directory.
 
     :param config: Config object
+    :param url: URL of the components file
     """
 
     logger.info("Downloading components file")
 
-    response = requests.get(f"https://files.wwpdb.org/pub/pdb/data/monomers/components.cif.gz")
+    cache_dir = config.user_cfg.data_dir / "cache" / "downloads"
+    with create_session() as session:
+        downloaded = download_cached(session, url, cache_dir, "components.cif.gz")
+    logger.info("Components file downloaded" if downloaded else "Cached components file is up to date")
 
-    with open((config.components_dir / "components.cif.gz"), "wb") as f:
-        f.write(response.content)
+    materialize(cache_dir / "components.cif.gz", config.components_dir / "components.cif.gz")
 
 
 def get_sugars_from_ccd(config: Config) -> List[str]:
     """
     Get a list of all sugar abbreviations that appear in PDB database.
+    The CCD index is cached per CCD release (see index_ccd), so the components file is scanned only once.
 
     :param config: Config object
     :return: List of sugar abbreviations
@@ -49,37 +67,76 @@ def get_sugars_from_ccd(config: Config) -> List[str]:
 
     logger.info("Extracting sugar abbreviations")
 
-    doc = gemmi.cif.read(str(config.components_dir / "components.cif.gz"))
-    logger.debug("Components loaded as doc")
-    sugar_names = set()
-    for block in doc:
-        logger.debug("Processing gemmi block")
-        comp_type = block.get_mmcif_category("_chem_comp.")["type"][0]
-        if "saccharide" in comp_type.lower():
-            logger.debug("Sugar found as compound type")
-            sugar_names.add(block.name)
+    sugar_names, _ = index_ccd(config.components_dir / "components.cif.gz", config.user_cfg.data_dir / "cache" / "ccd")
 
     with (config.run_data_dir / "sugar_names.json").open("w") as f:
-        json.dump(list(sugar_names), f, indent=4)
+        json.dump(sugar_names, f, indent=4)
 
-    return list(sugar_names)
+    return sugar_names
 
 
-def get_pdb_ids_with_sugars(config: Config, sugar_names: List[str]) -> Set[str]:
+def fetch_compound_in_pdb(session: requests.Session, sugar: str, cache_dir: Path, base_url: str = PDBE_API_URL, timeout: float = 30) -> dict:
+    """
+    Get structures containing the sugar from PDBe API. Response is cached in <cache_dir>
+    as <sugar>.json and the cached response is used if present.
+
+    :param session: Session to send the request with
+    :param sugar: Sugar abbreviation
+    :param cache_dir: Directory with cached responses
+    :param base_url: Base URL of PDBe API
+    :param timeout: Timeout of the request in seconds
+    :return: Response of PDBe API, structures are listed under the sugar abbreviation
+    :raises requests.HTTPError: If the request did not succeed, not even after retries
+    """
+
+    cache_file = cache_dir / f"{sugar}.json"
+    if cache_file.exists():
+        with open(cache_file, "r") as f:
+            return json.load(f)
+
+    response = session.get(f"{base_url}/pdb/compound/in_pdb/{sugar}", timeout=timeout)
+    # PDBe API responds with 404 for compounds that are not present in any structure
+    if response.status_code == 404:
+        structures = {}
+    else:
+        response.raise_for_status()
+        structures = response.json()
+
+    # Written to temporary file first, so interrupted run does not leave incomplete response in the cache
+    tmp_file = cache_dir / f"{sugar}.json.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(structures, f)
+    tmp_file.replace(cache_file)
+
+    return structures
+
+
+def get_pdb_ids_with_sugars(config: Config, sugar_names: List[str], workers: int = LOOKUP_WORKERS, base_url: str = PDBE_API_URL) -> Set[str]:
     """
     Get a set of PDB IDs for all structures containing any of the sugars.
 
+    PDBe API is queried by <workers> threads sharing one session. Responses are cached
+    in data_dir/cache/pdbe_in_pdb/<CCD release>, so re-runs with the same CCD release do not query the API again.
+
     :param config: Config object
     :param sugar_names: List of sugar abbreviations
+    :param workers: Number of concurrent requests
+    :param base_url: Base URL of PDBe API
     :return: Set of PDB IDs of structures containing the sugars
     """
 
+    cache_dir = config.user_cfg.data_dir / "cache" / "pdbe_in_pdb" / ccd_release(config.components_dir / "components.cif.gz")
+    cache_dir.mkdir(exist_ok=True, parents=True)
+
+    workers = max(1, workers)
+    with create_session(pool_size=workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        responses = list(tqdm(executor.map(lambda sugar: fetch_compound_in_pdb(session, sugar, cache_dir, base_url), sugar_names),
+                              total=len(sugar_names), desc="Getting structures with sugars"))
+
     pdb_ids = set()
     counts_structures_with_sugar = {} 
     sugars_not_present_in_any_structure = []
-    for sugar in sugar_names:
-        response = requests.get(f"https://www.ebi.ac.uk/pdbe/api/pdb/compound/in_pdb/{sugar}")
-        structures = response.json()
+    for sugar, structures in zip(sugar_names, responses):
         if not structures.get(sugar):
             sugars_not_present_in_any_structure.append(sugar)
             continue
@@ -127,8 +184,8 @@ def get_ids_missing_files(json_file: Path, validation_files: Path) -> List[str]:
     # Load json with needed structures
     with open(json_file, "r", encoding="utf8") as f:
         all_structures: list[str] = json.load(f)
-    # Get a list of downloaded files
-    file_names: list[str] = [f.split(".")[0] for f in listdir(validation_files)]
+    # Get a set of downloaded files
+    file_names = DirectoryInventory(validation_files).stems()
     # Intersect to get a list a files needed to download
     missing_files = [f for f in all_structures if f not in file_names]
     logger.info(f"The following files are missing {missing_files}")
@@ -136,34 +193,48 @@ def get_ids_missing_files(json_file: Path, validation_files: Path) -> List[str]:
     return missing_files
 
 
-def download_missing_files(config: Config, missing_files: List[str]) -> None:
+def download_missing_files(config: Config, pdb_ids: Set[str], workers: int = DOWNLOAD_WORKERS,
+                           requests_per_second: float = REQUESTS_PER_SECOND) -> List[str]:
     """
-    Download files that did not download in the first iteration.
+    Download files of the structures that are missing after the download from the data source
+    (e.g. not present in the mirror), named the same as the files from the data source.
+
+    Files are downloaded concurrently, with the number of requests to each host limited (see download_all).
+    Finished downloads are recorded in download_manifest.jsonl in the run data directory,
+    so an interrupted run can be resumed where it left off.
 
     :param config: Config object
-    :param missing_files: List of IDs of missing strutures
+    :param pdb_ids: IDs of all structures to work with
+    :param workers: Number of concurrent downloads
+    :param requests_per_second: Maximal number of requests per second to one host
+    :return: List of IDs of strutures with files that could not be downloaded
     """
 
-    timeout = 2
-    n = 0
-    while len(missing_files) != 0: 
-        for i, pdb in enumerate(missing_files):
-            try:
-                response = requests.get(f"https://files.rcsb.org/download/{pdb}.cif", timeout=10)
-                open((config.mmcif_files_dir / f"{pdb}.cif"), "wb").write(response.content) 
+    mmcif_files = DirectoryInventory(config.mmcif_files_dir).stems()
+    validation_files = DirectoryInventory(config.validation_files_dir).stems()
+
+    downloads = []
+    for pdb in sorted(pdb_ids):
+        if pdb not in mmcif_files:
+            downloads.append((f"https://files.rcsb.org/download/{pdb}.cif.gz", config.mmcif_files_dir / f"{pdb}.cif.gz"))
+        if f"{pdb}_validation" not in validation_files:
+            # The archive is organized by the middle two characters of the lower case ID
+            pdb_lower = pdb.lower()
+            downloads.append((f"https://files.rcsb.org/pub/pdb/validation_reports/{pdb_lower[1:3]}/{pdb_lower}/{pdb_lower}_validation.xml.gz",
+                              config.validation_files_dir / f"{pdb}_validation.xml.gz"))
+
+    if not downloads:
+        return []
+
+    logger.info(f"Downloading {len(downloads)} files missing in the data source")
+    with create_session(pool_size=workers) as session:
+        failed = download_all(session, downloads, config.run_data_dir / "download_manifest.jsonl", workers, requests_per_second, desc="Downloading missing files")
 
-                validation_data = requests.get(f"https://www.ebi.ac.uk/pdbe/entry-files/download/{pdb}_validation.xml", timeout=10)
-                open((config.validation_files_dir / f"{pdb}.xml"), "wb").write(validation_data.content)
-                missing_files.pop(i)
-            except Exception as e:
-                logger.info(f"An Error occured: {e}")
-                continue
+    failed_ids = list(dict.fromkeys(dest_path.name.split(".")[0].replace("_validation", "") for _, dest_path in failed))
+    if failed_ids:
+        logger.error(f"Files of these structures could not be downloaded: {failed_ids}")
 
-            n += 1
-            if n == 50:
-                n = 0
-                logger.info(f"Pausing for {timeout} seconds. Iteration {i+1}")
-                sleep(timeout)
+    return failed_ids
 
 
 def check_downloaded_files(json_file: Path, validation_files: Path, mmcif_files: Path) -> bool:
@@ -179,8 +250,8 @@ def check_downloaded_files(json_file: Path, validation_files: Path, mmcif_files:
     found_error = False
     with open(json_file, "r") as f:
         all_structures: set[str] = set(json.load(f))
-    validation_names: set[str] = set([f.split(".")[0] for f in listdir(validation_files)])
-    mmcif_names: set[str] = set([f.split(".")[0] for f in listdir(mmcif_files)])
+    validation_names = DirectoryInventory(validation_files).stems()
+    mmcif_names = DirectoryInventory(mmcif_files).stems()
     if all_structures != validation_names:
         logger.info("Error in validation files")
         logger.info(f"Missing validation files {all_structures - validation_names} {len(all_structures - validation_names)}")
@@ -192,7 +263,16 @@ def check_downloaded_files(json_file: Path, validation_files: Path, mmcif_files:
     return found_error
 
 
-def download_files(config: Config, test_mode: bool) -> None:
+def download_files(config: Config, test_mode: bool, download_missing: bool = False) -> None:
+    """
+    Get IDs of the structures with sugars and their mmCIF and validation files from the data source.
+
+    :param config: Config object
+    :param test_mode: Whether only the structures listed in the config are used
+    :param download_missing: Whether files missing in the data source are downloaded from RCSB (see download_missing_files);
+                             structures whose files could not be downloaded are left out of the run
+    """
+
     config.run_data_dir.mkdir(exist_ok=True, parents=True)
     config.user_cfg.results_dir.mkdir(exist_ok=True, parents=True)
     config.mmcif_files_dir.mkdir(exist_ok=True, parents=True)
@@ -238,11 +318,21 @@ def download_files(config: Config, test_mode: bool) -> None:
     source.download_structures(config, pdb_ids, config.mmcif_files_dir)
     source.download_validation_files(config, pdb_ids, config.validation_files_dir)
 
+    if download_missing:
+        failed_ids = download_missing_files(config, pdb_ids)
+        if failed_ids:
+            # Structures without their files are left out of the following steps
+            logger.warning(f"Leaving out {len(failed_ids)} structures with files that could not be downloaded")
+            pdb_ids.difference_update(failed_ids)
+            with (config.run_data_dir / "pdb_ids_intersection_pq_ccd.json").open("w") as f:
+                json.dump(list(pdb_ids), f, indent=4)
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
 
     parser.add_argument("-t", "--test_mode", action="store_true", help="Weather to run the whole process in a test mode")
+    parser.add_argument("--download_missing", action="store_true", help="Download files missing in the data source from RCSB")
 
     args = parser.parse_args()
 
@@ -250,4 +340,4 @@ if __name__ == "__main__":
 
     setup_logger(config.log_path)
 
-    download_files(config, args.test_mode)
+    download_files(config, args.test_mode, args.download_missing)
@@ -7,79 +7,106 @@ Credits: Original concept by Daniela Repelová, modifications by Kateřina Nazar
 
 
 import csv
+from functools import partial
 import gzip
 import json
+import math
+from pathlib import Path
+import shutil
+from typing import Dict, List, Optional, Set, Tuple
 
-from bs4 import BeautifulSoup, NavigableString
-from tqdm import tqdm
+from lxml import etree
 from logger import logger, setup_logger
 
 from configuration import Config
-from utils.hide_altloc import find_residue_any_altloc, remove_altloc_from_id
+from utils.parallel import ordered_map
+from utils.residue_index import build_residue_type_index, residue_key
 
 
-def extract_rscc_and_resolution(config: Config) -> None:
-    """
-    Extract overall resolution of structures and RSCC values for each of their residues (if said value exists).
+SHARDS_PER_WORKER = 4
 
-    :param config: Config object
+
+def read_validation_report(path: Path, wanted: Set[Tuple[str, str, str]]) -> Tuple[Optional[str], Dict[Tuple[str, str, str], Optional[str]]]:
+    """
+    Read the overall resolution and RSCC of the wanted residues from a gzipped validation report
+    in a single streaming pass. Parsed elements are discarded right away, and the parsing stops
+    as soon as the resolution and all wanted residues are found.
+
+    :param path: Path to the *_validation.xml.gz file
+    :param wanted: Keys (resnum, chain, resname) of the residues to find
+    :return: Resolution (None if there is no Entry element, empty if it has no resolution)
+             and RSCC (None if missing) of the found residues, the first occurrence of each residue is used
     """
 
-    config.validation_dir.mkdir(exist_ok=True, parents=True)
+    resolution = None
+    rscc: Dict[Tuple[str, str, str], Optional[str]] = {}
+    remaining = set(wanted)
 
-    logger.info("Extracting RSCC and resolution")
+    with gzip.open(path, "rb") as f:
+        for _, element in etree.iterparse(f, events=("end",), tag=("Entry", "ModelledSubgroup")):
+            if element.tag == "Entry":
+                resolution = element.get("PDB-resolution", "")
+                if not resolution:
+                    break
+            else:
+                key = (element.get("resnum"), element.get("chain"), element.get("resname"))
+                if key in remaining:
+                    rscc[key] = element.get("rscc")
+                    remaining.remove(key)
 
-    with open(config.categorization_dir / "all_residues.json", "r", encoding="utf8") as f:
-        all_residues = json.load(f)
-    with open(config.categorization_dir / "modified_ligands.json", "r", encoding="utf8") as f:
-        modified_ligands = json.load(f)
-    with open(config.categorization_dir / "glycosylated.json", "r", encoding="utf8") as f:
-        glycosylated = json.load(f)
-    with open(config.categorization_dir / "close_contacts.json", "r", encoding="utf8") as f:
-        close_contacts = json.load(f)
+            # Discard the element and the already processed siblings
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
 
-    with open(config.validation_dir / "all_rscc_and_resolution.csv", "w", newline="", encoding="utf8") as f:
-        all_rscc = csv.writer(f)
+            if resolution is not None and not remaining:
+                break
+
+    return resolution, rscc
 
-        no_resolution = set()
-        no_residue_info = set()
-        no_rscc = set()
 
-        modified_ids_no_altloc = [remove_altloc_from_id(pdb_id) for pdb_id in modified_ligands]
-        all_rscc.writerow(["pdb", "resolution", "name", "num", "chain", "rscc", "type"])
-        for structure, residues in tqdm(all_residues.items(), desc="Extracting RSCC and resolution"):
+def extract_shard(shard: Tuple[int, List[Tuple[str, List[Dict]]]], shards_dir: Path, validation_files_dir: Path,
+                  residue_types: Dict[Tuple[str, str, str, str], str]) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Extract resolution and RSCC values of residues of one shard of structures into a separate .csv file.
+
+    :param shard: Index of the shard and its structures with their residues
+    :param shards_dir: Directory to save the shard .csv file
+    :param validation_files_dir: Directory with validation reports
+    :param residue_types: Type of residues keyed by (structure, name, num, chain)
+    :return: Structures with no resolution, residues with no info and residues with no RSCC
+    """
+
+    index, structures = shard
+
+    no_resolution = []
+    no_residue_info = []
+    no_rscc = []
+
+    with open(shards_dir / f"{index}.csv", "w", newline="", encoding="utf8") as f:
+        all_rscc = csv.writer(f)
+        for structure, residues in structures:
             file = f"{structure.lower()}_validation.xml.gz"
             logger.debug(f"Parsing {file}")
-            with gzip.open(config.validation_files_dir / file, "rt") as file_xml:
-                d = file_xml.read()
-            data = BeautifulSoup(d, "xml")
-            structure_info = data.find("Entry")
-            if structure_info is None or isinstance(structure_info, NavigableString):
+            wanted = {(residue["num"], residue["chain"], residue["name"]) for residue in residues}
+            resolution, residues_rscc = read_validation_report(validation_files_dir / file, wanted)
+            if resolution is None:
                 continue
-            resolution = structure_info.get("PDB-resolution")
             if not resolution:
-                no_resolution.add(structure)
+                no_resolution.append(structure)
                 continue
             for residue in residues:
-                residue_info = data.find("ModelledSubgroup", attrs={"resnum": residue["num"], "chain": residue["chain"], "resname": residue["name"]})
-                if not residue_info:
-                    no_residue_info.add(f"{structure}_{residue}")
+                key = (residue["num"], residue["chain"], residue["name"])
+                if key not in residues_rscc:
+                    no_residue_info.append(f"{structure}_{residue}")
                     continue
 
-                if residue_info is None or isinstance(residue_info, NavigableString):
-                    continue
-                rscc = residue_info.get("rscc")
+                rscc = residues_rscc[key]
                 if not rscc:
-                    no_rscc.add(f"{structure}_{residue}")
+                    no_rscc.append(f"{structure}_{residue}")
                     continue
 
-                res_type = None
-                if structure in modified_ids_no_altloc and find_residue_any_altloc(modified_ligands, structure, residue):
-                        res_type = "ligand"
-                if structure in glycosylated and residue in glycosylated[structure]:
-                        res_type = "glycosylated"
-                if structure in close_contacts and residue in close_contacts[structure]:
-                        res_type = "close"
+                res_type = residue_types.get((structure, *residue_key(residue)))
                 # assert res_type is not None, "Residue should be one of the following type: ligand, glycosylated, close contact" 
 
                 # Structure can have unsupported altloc, therefore is not in any category
@@ -88,6 +115,62 @@ def extract_rscc_and_resolution(config: Config) -> None:
                 row = [str(structure), str(resolution), str(residue["name"]), residue["num"], residue["chain"], str(rscc), res_type]
                 all_rscc.writerow(row)
 
+    return no_resolution, no_residue_info, no_rscc
+
+
+def extract_rscc_and_resolution(config: Config, workers: int = 1) -> None:
+    """
+    Extract overall resolution of structures and RSCC values for each of their residues (if said value exists).
+
+    Structures are split into shards, which are processed by worker processes, each writing its own .csv file.
+    The shards are concatenated in their order, so the result does not depend on the number of workers.
+
+    :param config: Config object
+    :param workers: Number of worker processes
+    """
+
+    config.validation_dir.mkdir(exist_ok=True, parents=True)
+
+    logger.info("Extracting RSCC and resolution")
+
+    with open(config.categorization_dir / "all_residues.json", "r", encoding="utf8") as f:
+        all_residues: Dict[str, List[Dict]] = json.load(f)
+    with open(config.categorization_dir / "modified_ligands.json", "r", encoding="utf8") as f:
+        modified_ligands = json.load(f)
+    with open(config.categorization_dir / "glycosylated.json", "r", encoding="utf8") as f:
+        glycosylated = json.load(f)
+    with open(config.categorization_dir / "close_contacts.json", "r", encoding="utf8") as f:
+        close_contacts = json.load(f)
+
+    residue_types = build_residue_type_index(modified_ligands, glycosylated, close_contacts)
+
+    shards_dir = config.validation_dir / "shards"
+    shards_dir.mkdir(exist_ok=True, parents=True)
+
+    structures = list(all_residues.items())
+    shard_size = max(1, math.ceil(len(structures) / (workers * SHARDS_PER_WORKER)))
+    shards = list(enumerate(structures[i:i + shard_size] for i in range(0, len(structures), shard_size)))
+
+    results = ordered_map(partial(extract_shard, shards_dir=shards_dir, validation_files_dir=config.validation_files_dir, residue_types=residue_types),
+                          shards, workers, desc="Extracting RSCC and resolution")
+
+    with open(config.validation_dir / "all_rscc_and_resolution.csv", "w", newline="", encoding="utf8") as f:
+        csv.writer(f).writerow(["pdb", "resolution", "name", "num", "chain", "rscc", "type"])
+        for index, _ in shards:
+            shard_path = shards_dir / f"{index}.csv"
+            with open(shard_path, "r", newline="", encoding="utf8") as shard_file:
+                shutil.copyfileobj(shard_file, f)
+            shard_path.unlink()
+    shards_dir.rmdir()
+
+    # Kept in the order of structures (instead of a set) so the saved files are deterministic
+    no_resolution: Dict[str, None] = {}
+    no_residue_info: Dict[str, None] = {}
+    no_rscc: Dict[str, None] = {}
+    for shard_no_resolution, shard_no_residue_info, shard_no_rscc in results:
+        no_resolution.update(dict.fromkeys(shard_no_resolution))
+        no_residue_info.update(dict.fromkeys(shard_no_residue_info))
+        no_rscc.update(dict.fromkeys(shard_no_rscc))
 
     with open(config.validation_dir / "pdb_no_resolution.json", "w", encoding="utf8") as f:
         json.dump(list(no_resolution), f, indent=4)
@@ -11,10 +11,11 @@ from collections import defaultdict
 from csv import DictReader
 import json
 from logger import logger, setup_logger
-from typing import Dict
+from typing import Dict, Set, Tuple
 
 from configuration import Config
 from utils.hide_altloc import remove_altloc_from_id
+from utils.residue_index import residue_key
 
 
 def count_num_residues(res_in_whole_struct: Dict) -> int:
@@ -50,14 +51,14 @@ def filter_ligands(max_resolution: float, min_rscc: float, max_rmsd: float, conf
     # Available and we want to continue just with those with resolution
     good_structures = set()
     # Get individual resiudes which have bad rscc or rmsd
-    delete_residues = defaultdict(list)
+    delete_residues: Dict[str, Set[Tuple[str, str, str]]] = defaultdict(set)
     with open(config.validation_dir / "merged_rscc_rmsd.csv", "r", encoding="utf8") as f:
         rscc_rmsd = DictReader(f)
         for row in rscc_rmsd:
             if float(row["resolution"]) <= max_resolution and row["type"] == "ligand":
                 good_structures.add(row["pdb"])
             if row["type"] == "ligand" and (float(row["rmsd"]) > max_rmsd or float(row["rscc"]) < min_rscc):
-                delete_residues[row["pdb"]].append({"name": row["name"], "num" : row["num"], "chain": row["chain"]}) 
+                delete_residues[row["pdb"]].add((row["name"], row["num"], row["chain"]))
 
     # Delete those structures which are not in good_structures
     delete_structures = set([pdb for pdb in modified_ligands.keys() if remove_altloc_from_id(pdb) not in good_structures])
@@ -69,11 +70,9 @@ def filter_ligands(max_resolution: float, min_rscc: float, max_rmsd: float, conf
     delete_empty_structures = set()
     for pdb, residues in modified_ligands.items():
         if remove_altloc_from_id(pdb) in delete_residues:
-            for residue in delete_residues[remove_altloc_from_id(pdb)]:
-                try:
-                    residues.remove(residue)
-                except ValueError:
-                    pass # Some residues to delete might already not be there due to altloc split
+            # Some residues to delete might already not be there due to altloc split
+            to_delete = delete_residues[remove_altloc_from_id(pdb)]
+            residues[:] = [residue for residue in residues if residue_key(residue) not in to_delete]
 
             if len(residues) == 0:
                 delete_empty_structures.add(pdb)
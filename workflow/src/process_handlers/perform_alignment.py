@@ -8,19 +8,26 @@ Credits: Original concept by Daniela Repelová, modifications by Kateřina Nazar
 
 from argparse import ArgumentParser
 import csv
+from functools import partial
 import itertools
 import json
-import os
+import math
+import multiprocessing
 from pathlib import Path
-import re
-from typing import Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 import numpy as np
 from logger import logger, setup_logger
 
 from configuration import Config
+from utils.checksum import file_checksum
+from utils.condensed_matrix import condensed_index, condensed_matrix_path, create_condensed_matrix
+from utils.directory_inventory import DirectoryInventory
+from utils.parallel import map_isolating_crashes
+from utils.rmsd_pair_store import RmsdPairStore
 
 from pymol import cmd, sys
+from .rmsd_engine import rmsd_of_pairs, parse_sugar_id, parse_surroundings, residue_codes, superpose_on_reference
 
 
 def select_sugar(filename: str) -> Tuple[str, str]:
@@ -31,15 +38,7 @@ def select_sugar(filename: str) -> Tuple[str, str]:
     :return: Name of the sugar and name of the PyMOL selection
     """
 
-    try:
-        reg = re.compile(r"_([A-Z]{3})_(\d+)_([A-Za-z0-9]+)(?:_[A-Za-z0-9]+)?$")
-        res = reg.search(filename)
-        res, num, chain = res.groups() # type: ignore
-    except:
-        raise ValueError(f"Unexpected PDB file name: {filename}")
-
-    if len(chain) > 1:
-        chain = chain[0]
+    res, num, chain = parse_sugar_id(filename)
 
     sugar = f"/{filename}//{chain}/{res}`{num}"
     selection_name = "sugar"
@@ -107,123 +106,600 @@ def refine_binding_sites(sugar: str, min_residues: int, config: Config) -> Path:
     return filtered_surroundings
 
 
-def all_against_all_alignment(sugar: str, structures_folder: Path, perform_align: bool, save_path: Path, config: Config) -> None:
+class RmsdResults():
+    """
+    Collect RMSD values of pairs of surroundings for each alignment method
+    and save them as .csv file and memory-mapped condensed distance matrix (.npy).
+
+    If a pair store is given, pairs already calculated in previous runs are taken
+    from the store and newly calculated pairs are added to it.
+    """
+
+    def __init__(self, sugar: str, n: int, methods: List[str], config: Config, pair_store: Optional[RmsdPairStore] = None, dtype: str = "float32") -> None:
+        self.sugar = sugar
+        self.n = n
+        self.pair_store = pair_store
+        self.hashes: Dict[str, str] = {}
+        self.stored_pairs = 0
+        self.results_paths: Dict[str, Path] = {}
+        self.matrices: Dict[str, np.ndarray] = {}
+        self.files = {}
+        self.writers = {}
+
+        for method in methods:
+            results_path = config.clusters_dir / method
+            results_path.mkdir(parents=True, exist_ok=True)
+            self.results_paths[method] = results_path
+            self.matrices[method] = create_condensed_matrix(condensed_matrix_path(results_path, sugar, method), n, dtype)
+            self.files[method] = open(results_path / f"{sugar}_all_pairs_rmsd_{method}.csv", "w", newline="")
+            self.writers[method] = csv.writer(self.files[method])
+            self.writers[method].writerow(["structure1", "structure2", "rmsd"])
+
+
+    def structure_hash(self, structures_folder: Path, structure: str) -> str:
+        """
+        Get content hash of the structure, each structure is hashed only once.
+
+        :param structures_folder: Path to refined binding sites
+        :param structure: File name of the structure
+        :return: Content hash of the structure
+        """
+
+        filename = Path(structure).stem
+        if filename not in self.hashes:
+            self.hashes[filename] = file_checksum(structures_folder / structure)
+
+        return self.hashes[filename]
+
+
+    def pairs_to_compute(self, structures_folder: Path, structures: List[str], tile: Tuple[range, range]) -> List[Tuple[str, str]]:
+        """
+        Get pairs of one tile of the pair matrix whose RMSD has to be calculated. Pairs found in the pair store
+        (for all methods) are recorded right away. Only the pairs of the tile are looked up in the store.
+
+        :param structures_folder: Path to refined binding sites
+        :param structures: File names of all structures
+        :param tile: Rows and columns of the tile (see split_into_tiles)
+        :return: Pairs of structure file names to calculate
+        """
+
+        pairs = list(tile_pairs(structures, tile))
+        if self.pair_store is None:
+            return pairs
+
+        rows, columns = tile
+        row_hashes = [self.structure_hash(structures_folder, structures[row]) for row in rows]
+        column_hashes = [self.structure_hash(structures_folder, structures[column]) for column in columns]
+        stored = {method: self.pair_store.lookup(method, row_hashes, column_hashes) for method in self.matrices}
+
+        to_compute = []
+        for (structure1, structure2) in pairs:
+            filename1 = Path(structure1).stem
+            filename2 = Path(structure2).stem
+            key = tuple(sorted((self.hashes[filename1], self.hashes[filename2])))
+            if not all(key in stored[method] for method in self.matrices):
+                to_compute.append((structure1, structure2))
+                continue
+            for method in self.matrices:
+                self.record(method, filename1, filename2, stored[method][key])
+        self.stored_pairs += len(pairs) - len(to_compute)
+
+        return to_compute
+
+
+    def record(self, method: str, filename1: str, filename2: str, rms: float) -> None:
+        """
+        Write RMSD of one pair of surroundings to the .csv file and the condensed distance matrix.
+
+        :param method: Alignment method the RMSD was calculated with
+        :param filename1: Name of the first surrounding file (without suffix)
+        :param filename2: Name of the second surrounding file (without suffix)
+        :param rms: The RMSD value
+        """
+
+        id1 = int(filename1.split("_")[0])
+        id2 = int(filename2.split("_")[0])
+        self.writers[method].writerow([filename1, filename2, rms])
+        self.matrices[method][condensed_index(self.n, id1, id2)] = rms
+
+
+    def add(self, method: str, filename1: str, filename2: str, rms: float) -> None:
+        """
+        Record newly calculated RMSD of one pair of surroundings.
+
+        :param method: Alignment method the RMSD was calculated with
+        :param filename1: Name of the first surrounding file (without suffix)
+        :param filename2: Name of the second surrounding file (without suffix)
+        :param rms: The RMSD value
+        """
+
+        self.record(method, filename1, filename2, rms)
+        if self.pair_store is not None:
+            self.pair_store.add(method, self.hashes[filename1], self.hashes[filename2], rms)
+
+
+    def save(self) -> None:
+        """
+        Close the .csv files and the pair store and flush the distance matrices.
+        """
+
+        for method in self.results_paths:
+            self.files[method].close()
+            self.matrices[method].flush()
+
+        if self.pair_store is not None:
+            logger.info(f"Took {self.stored_pairs} pairs from the pair store")
+            self.pair_store.close()
+
+
+def save_something_wrong(something_wrong: List[Tuple[str, str]], config: Config) -> None:
+    """
+    Save pairs of surroundings with which something went wrong.
+
+    :param something_wrong: Pairs of surrounding file names
+    :param config: Config object
+    :raises Exception: If <something_wrong> is not empty
+    """
+
+    with open((config.clusters_dir / "something_wrong.json"), "w") as f:
+        json.dump(something_wrong, f, indent=4)
+
+    if something_wrong:
+        raise Exception("Something went wrong not empty")
+
+
+def align_pair(sugar: str, structures_folder: Path, structure1: str, structure2: str, perform_align: bool, save_path: Path) -> Dict[str, float]:
+    """
+    Calculate RMSD (using PyMol rms_cur command) of one pair of structures firstly aligned
+    by their sugar, then aligned by the aminoacids (to find the alignment object - pairs of AA),
+    but without actually moving, so the rms_cur is eventually calculated from their position as is
+    towards the sugar.
+
+    :param sugar: The sugar for which representative surroundings are being defined
+    :param structures_folder: Path to refined binding sites
+    :param structure1: File name of the first structure
+    :param structure2: File name of the second structure
+    :param perform_align: If PyMOL align command should be used as well
+    :param save_path: Path to store .cif files fetched by PyMOL
+    :return: RMSD value for each of the used PyMOL commands
+    """
+
+    rmsd_values = {}
+
+    cmd.delete("all")
+    cmd.load(f"{structures_folder}/{structure1}")
+    cmd.load(f"{structures_folder}/{structure2}")
+
+    cmd.fetch(sugar, path=str(save_path))
+
+    filename1 = Path(structure1).stem
+    filename2 = Path(structure2).stem
+
+    try:
+        _, _, _, res1, num1, chain1 = filename1.split("_")
+    except ValueError:
+        _, _, _, res1, num1, chain1, _ = filename1.split("_")
+    try:
+        _, _, _, res2, num2, chain2 = filename2.split("_")
+    except ValueError:
+        _, _, _, res2, num2, chain2, _ = filename2.split("_")
+    # Some structures have chains named eg. AaA but when loaded to PyMol
+    # the the chain is reffered to just as A.
+    if len(chain1) > 1:
+        chain1 = chain1[0]
+    if len(chain2) > 1:
+        chain2 = chain2[0] 
+
+    sugar1 = f"/{filename1}//{chain1}/{res1}`{num1}"
+    sugar2 = f"/{filename2}//{chain2}/{res2}`{num2}"
+
+    cmd.select("original_sugar1", sugar1)
+    cmd.select("original_sugar2", sugar2)
+    cmd.select("polymer1", f"polymer and not {filename2}")
+    cmd.select("polymer2", f"polymer and not {filename1}")
+
+    cmd.align("original_sugar1", sugar)
+    cmd.align("original_sugar2", sugar)
+
+    cmd.super("polymer1", "polymer2", transform=0, cycles=0, object="sup") 
+    rmsd_values["super"] = float(cmd.rms_cur("polymer1 & sup", "polymer2 & sup", matchmaker=-1))
+
+    if perform_align:
+        cmd.align("polymer1", "polymer2", transform=0, cycles=0, object="aln")
+        rmsd_values["align"] = float(cmd.rms_cur("polymer1 & aln", "polymer2 & aln", matchmaker=-1))
+
+    cmd.delete("all") 
+
+    return rmsd_values
+
+
+class PreloadedStructures():
+    """
+    PyMOL session with the reference sugar, into which each structure is loaded and aligned by its sugar
+    onto the reference sugar (moving the whole structure) the first time it is needed. Structures stay loaded
+    until they are released by retain, so the session can be reused by consecutive tiles sharing structures
+    while holding only the structures of the current tile (selections of PyMOL commands get slower
+    with every loaded object).
+    """
+
+    def __init__(self, sugar: str, structures_folder: Path, save_path: Path) -> None:
+        """
+        :param sugar: The sugar for which representative surroundings are being defined
+        :param structures_folder: Path to refined binding sites
+        :param save_path: Path to store .cif files fetched by PyMOL
+        """
+
+        self.sugar = sugar
+        self.structures_folder = structures_folder
+        self.loaded: Set[str] = set()
+        self.errors: Dict[str, str] = {}
+
+        cmd.delete("all")
+        cmd.fetch(sugar, path=str(save_path))
+
+
+    def load(self, structure: str) -> None:
+        """
+        Load the structure and align it by its sugar, unless it is already loaded.
+
+        :param structure: File name of the structure
+        :raises Exception: If the structure could not be loaded or aligned (now or before)
+        """
+
+        if structure in self.errors:
+            raise Exception(self.errors[structure])
+        if structure in self.loaded:
+            return
+
+        filename = Path(structure).stem
+        try:
+            cmd.load(f"{self.structures_folder}/{structure}")
+            res, num, chain = parse_sugar_id(filename)
+            cmd.align(f"/{filename}//{chain}/{res}`{num}", self.sugar)
+        except Exception as e:
+            self.errors[structure] = str(e)
+            raise
+        self.loaded.add(structure)
+
+
+    def retain(self, structures: Set[str]) -> None:
+        """
+        Delete all loaded structures except <structures>.
+
+        :param structures: File names of the structures to keep loaded
+        """
+
+        for structure in self.loaded - structures:
+            cmd.delete(Path(structure).stem)
+        self.loaded &= structures
+
+
+    def close(self) -> None:
+        """
+        Delete everything from the PyMOL session.
+        """
+
+        cmd.delete("all")
+
+
+def align_preloaded_pair(structure1: str, structure2: str, perform_align: bool) -> Dict[str, float]:
+    """
+    Calculate RMSD (using PyMol rms_cur command) of one pair of preloaded structures, already aligned
+    by their sugar, aligned by the aminoacids without actually moving.
+
+    :param structure1: File name of the first structure
+    :param structure2: File name of the second structure
+    :param perform_align: If PyMOL align command should be used as well
+    :return: RMSD value for each of the used PyMOL commands
+    """
+
+    rmsd_values = {}
+
+    cmd.select("polymer1", f"polymer and {Path(structure1).stem}")
+    cmd.select("polymer2", f"polymer and {Path(structure2).stem}")
+
+    cmd.super("polymer1", "polymer2", transform=0, cycles=0, object="sup")
+    rmsd_values["super"] = float(cmd.rms_cur("polymer1 & sup", "polymer2 & sup", matchmaker=-1))
+    cmd.delete("sup")
+
+    if perform_align:
+        cmd.align("polymer1", "polymer2", transform=0, cycles=0, object="aln")
+        rmsd_values["align"] = float(cmd.rms_cur("polymer1 & aln", "polymer2 & aln", matchmaker=-1))
+        cmd.delete("aln")
+
+    return rmsd_values
+
+
+def align_tile(sugar: str, structures_folder: Path, pairs: List[Tuple[str, str]], perform_align: bool, save_path: Path, preload: bool = False,
+               preloaded: Optional[PreloadedStructures] = None) -> Tuple[List[Tuple[str, str, Dict[str, float]]], List[Tuple[str, str, str]]]:
+    """
+    Align all pairs of one tile of the pair matrix. May run in a separate worker process,
+    therefore it does not log and returns the errors instead.
+
+    :param sugar: The sugar for which representative surroundings are being defined
+    :param structures_folder: Path to refined binding sites
+    :param pairs: Pairs of structure file names to align
+    :param perform_align: If PyMOL align command should be used as well
+    :param save_path: Path to store .cif files fetched by PyMOL
+    :param preload: Whether to load and align each structure by its sugar only once
+    :param preloaded: Session shared with the previous tiles, structures of this tile loaded for them are reused
+                      and the other ones released; a session only for this tile is used if None
+    :return: RMSD values of aligned pairs and pairs with which something went wrong with the error
+    """
+
+    aligned = []
+    failed = []
+
+    session = preloaded
+    if preload and session is None:
+        session = PreloadedStructures(sugar, structures_folder, save_path)
+    if session is not None:
+        session.retain({structure for pair in pairs for structure in pair})
+
+    for (structure1, structure2) in pairs:
+        try:
+            if session is None:
+                rmsd_values = align_pair(sugar, structures_folder, structure1, structure2, perform_align, save_path)
+            else:
+                session.load(structure1)
+                session.load(structure2)
+                rmsd_values = align_preloaded_pair(structure1, structure2, perform_align)
+            aligned.append((structure1, structure2, rmsd_values))
+        except Exception as e:
+            failed.append((structure1, structure2, str(e)))
+
+    if session is not None and preloaded is None:
+        session.close()
+
+    return aligned, failed
+
+
+def verify_preload(sugar: str, structures_folder: Path, structures: List[str], perform_align: bool, save_path: Path, sample: int,
+                   tolerance: float = 1e-3) -> None:
+    """
+    Check that RMSD of preloaded structures is the same as RMSD of structures aligned pair by pair,
+    on all pairs of the first <sample> structures.
+
+    :param sugar: The sugar for which representative surroundings are being defined
+    :param structures_folder: Path to refined binding sites
+    :param structures: File names of all structures
+    :param perform_align: If PyMOL align command should be used as well
+    :param save_path: Path to store .cif files fetched by PyMOL
+    :param sample: Number of structures to check
+    :param tolerance: Maximal allowed difference of RMSD values
+    :raises Exception: If RMSD of any pair differs
+    """
+
+    pairs = list(itertools.combinations(structures[:sample], 2))
+    logger.info(f"Verifying RMSD of preloaded structures on {len(pairs)} pairs")
+
+    per_pair, _ = align_tile(sugar, structures_folder, pairs, perform_align, save_path)
+    preloaded, _ = align_tile(sugar, structures_folder, pairs, perform_align, save_path, preload=True)
+    preloaded_values = {(structure1, structure2): rmsd_values for structure1, structure2, rmsd_values in preloaded}
+
+    mismatches = []
+    for structure1, structure2, rmsd_values in per_pair:
+        for method, rms in rmsd_values.items():
+            other = preloaded_values.get((structure1, structure2), {}).get(method)
+            if other is None or abs(other - rms) > tolerance:
+                mismatches.append((structure1, structure2, method, rms, other))
+
+    if mismatches:
+        for structure1, structure2, method, rms, other in mismatches:
+            logger.error(f"RMSD ({method}) of {structure1} and {structure2} is {rms} pair by pair, but {other} preloaded")
+        raise Exception(f"RMSD of {len(mismatches)} pairs differs when structures are preloaded")
+
+    logger.info("RMSD of preloaded structures is the same as pair by pair")
+
+
+# Each PyMOL command of a preloaded pair selects from all loaded structures, so tiles aligned with preloaded
+# structures are kept small; see scripts/alignment/benchmark_preload.py
+PRELOAD_BLOCK_SIZE = 10
+
+
+def split_into_tiles(n: int, workers: int, max_block_size: int = 100) -> List[Tuple[range, range]]:
+    """
+    Partition the upper triangle of the pair matrix of <n> structures into square tiles, so that
+    there are about four tiles per worker and no tile spans more than <max_block_size>
+    structures on a side. Tiles are given only by their rows and columns, their pairs are generated
+    when the tile is processed (see tile_pairs), so pairs of all tiles are never held at once.
+
+    :param n: Number of structures
+    :param workers: Number of worker processes
+    :param max_block_size: Maximum number of structures on one side of a tile
+    :return: Rows and columns of each tile, row block by row block
+    """
+
+    # k row blocks give k * (k + 1) / 2 tiles of the upper triangle
+    blocks_count = max(1, math.ceil((math.sqrt(1 + 32 * workers) - 1) / 2), math.ceil(n / max_block_size))
+    block_size = max(1, math.ceil(n / blocks_count))
+    blocks = [range(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+    return [(rows, columns) for i, rows in enumerate(blocks) for columns in blocks[i:]]
+
+
+def tile_pairs(structures: List[str], tile: Tuple[range, range]) -> Iterator[Tuple[str, str]]:
+    """
+    Generate pairs of one tile of the upper triangle of the pair matrix.
+
+    :param structures: Structure file names
+    :param tile: Rows and columns of the tile
+    :return: Pairs of structure file names
+    """
+
+    rows, columns = tile
+    for row in rows:
+        for column in columns:
+            if row < column:
+                yield structures[row], structures[column]
+
+
+def all_against_all_alignment(sugar: str, structures_folder: Path, perform_align: bool, save_path: Path, config: Config, workers: int = 1, preload: bool = False, pair_store: Optional[RmsdPairStore] = None, dtype: str = "float32",
+                              verify_sample: int = 0) -> None:
     """
     Calculates all against all RMSD (using PyMol rms_cur command) of all structures firstly aligned
     by their sugar, then aligned by the aminoacids (to find the alignment object - pairs of AA),
     but without actually moving, so the rms_cur is eventually calculated from their position as is
-    towards the sugar. Results are saved in a form of distance matrix (.npy) and also as .csv file.
+    towards the sugar. Results are saved in a form of condensed distance matrix (.npy) and also as .csv file.
+
+    Structures are aligned by tiles of the pair matrix. With preload, every structure is loaded and aligned
+    by its sugar only once per tile and only the structures of the current tile are loaded, tiles span at most
+    PRELOAD_BLOCK_SIZE structures on a side. Tiles are taken row block by row block, so with one worker
+    the structures of the rows are kept loaded for the next tile.
+    With more than one worker the tiles are aligned in separate PyMOL processes. If a worker process crashes, only the tile it was aligning fails
+    (see map_isolating_crashes) and all of its pairs are considered to have gone wrong.
 
     :param sugar: The sugar for which representative surroundings are being defined
     :param structures_folder: Path to refined binding sites
     :param perform_align: If PyMOL align command was used 
     :param save_path: Path to store .cif files fetched by PyMOL
     :param config: Config object
+    :param workers: Number of worker processes
+    :param preload: Whether to load and align each structure by its sugar only once
+    :param pair_store: Store of pairs calculated in previous runs; defaults to None
+    :param dtype: Data type of the RMSD matrices
+    :param verify_sample: Number of structures to verify preloading on (see verify_preload), no verification if 0
     """
 
     logger.info("Performing alignment")
 
-    super_results_path = config.clusters_dir / "super"
-    super_results_path.mkdir(parents=True, exist_ok=True)
-
-    n = len(os.listdir(structures_folder))
-    super_rmsd_values = np.zeros((n, n))
-    align_rmsd_values = np.zeros((n, n))
+    structures = DirectoryInventory(structures_folder)
+    n = len(structures)
+    results = RmsdResults(sugar, n, ["super", "align"] if perform_align else ["super"], config, pair_store, dtype)
 
     something_wrong = []
 
-    align_writer = None
-    align_results_path = None
-    align_file = None
-    if perform_align:
-        align_results_path = config.clusters_dir / "align"
-        align_results_path.mkdir(parents=True, exist_ok=True)
-
-        align_file = open(align_results_path / f"{sugar}_all_pairs_rmsd_align.csv", "w", newline="")
-        align_writer = csv.writer(align_file)
-        align_writer.writerow(["structure1", "structure2", "rmsd"])
-
-    with open(super_results_path / f"{sugar}_all_pairs_rmsd_super.csv", "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["structure1", "structure2", "rmsd"])
-        all_structures = os.listdir(structures_folder)
-        for (structure1, structure2) in itertools.combinations(all_structures, 2):
-            try:
-                cmd.delete("all")
-                cmd.load(f"{structures_folder}/{structure1}")
-                cmd.load(f"{structures_folder}/{structure2}")
-
-                cmd.fetch(sugar, path=str(save_path))
-
-                filename1 = Path(structure1).stem
-                filename2 = Path(structure2).stem
-
-                try:
-                    id1, _, _, res1, num1, chain1 = filename1.split("_")
-                except ValueError:
-                    id1, _, _, res1, num1, chain1, _ = filename1.split("_")
-                try:
-                    id2, _, _, res2, num2, chain2 = filename2.split("_")
-                except ValueError:
-                    id2, _, _, res2, num2, chain2, _ = filename2.split("_")
-                # Some structures have chains named eg. AaA but when loaded to PyMol
-                # the the chain is reffered to just as A.
-                if len(chain1) > 1:
-                    chain1 = chain1[0]
-                if len(chain2) > 1:
-                    chain2 = chain2[0] 
-
-                sugar1 = f"/{filename1}//{chain1}/{res1}`{num1}"
-                sugar2 = f"/{filename2}//{chain2}/{res2}`{num2}"
-
-                cmd.select("original_sugar1", sugar1)
-                cmd.select("original_sugar2", sugar2)
-                cmd.select("polymer1", f"polymer and not {filename2}")
-                cmd.select("polymer2", f"polymer and not {filename1}")
-
-                cmd.align("original_sugar1", sugar)
-                cmd.align("original_sugar2", sugar)
-
-                cmd.super("polymer1", "polymer2", transform=0, cycles=0, object="sup") 
-                rms = float(cmd.rms_cur("polymer1 & sup", "polymer2 & sup", matchmaker=-1))
-
-                writer.writerow([filename1, filename2, rms])
-                super_rmsd_values[int(id1), int(id2)] = rms 
-                super_rmsd_values[int(id2), int(id1)] = rms
-
-                if perform_align:
-                    assert align_writer is not None, "If perform_align is true, align_writer has to exist"
-                    cmd.align("polymer1", "polymer2", transform=0, cycles=0, object="aln")
-                    rms = float(cmd.rms_cur("polymer1 & aln", "polymer2 & aln", matchmaker=-1))
-                    align_writer.writerow([filename1, filename2, rms])
-                    align_rmsd_values[int(id1), int(id2)] = rms 
-                    align_rmsd_values[int(id2), int(id1)] = rms
-
-                cmd.delete("all") 
-            except Exception as e:
-                # Save pairs with which something went wrong
-                something_wrong.append((structure1, structure2))
-                logger.error(f"Something went wrong: {e}")
-
-    if align_file is not None and align_results_path is not None:
-        align_file.close()
-        np.save(align_results_path / f"{sugar}_all_pairs_rmsd_align.npy", align_rmsd_values)
-
-    np.save(super_results_path / f"{sugar}_all_pairs_rmsd_super.npy", super_rmsd_values)
-    with open((config.clusters_dir / "something_wrong.json"), "w") as f:
-        json.dump(something_wrong, f, indent=4)
+    def record_tile(aligned: List[Tuple[str, str, Dict[str, float]]], failed: List[Tuple[str, str, str]]) -> None:
+        for structure1, structure2, rmsd_values in aligned:
+            for method, rms in rmsd_values.items():
+                results.add(method, Path(structure1).stem, Path(structure2).stem, rms)
+        for structure1, structure2, error in failed:
+            # Save pairs with which something went wrong
+            something_wrong.append((structure1, structure2))
+            logger.error(f"Something went wrong: {error}")
+
+    all_structures = list(structures)
+    if preload and verify_sample > 0:
+        verify_preload(sugar, structures_folder, all_structures, perform_align, save_path, verify_sample)
+
+    if workers <= 1:
+        tiles = split_into_tiles(n, 1, PRELOAD_BLOCK_SIZE if preload else 100)
+        logger.info(f"Aligning {len(tiles)} tiles{' with preloaded structures' if preload else ''}")
+        # One session for all tiles, structures shared by consecutive tiles are not loaded again
+        preloaded = PreloadedStructures(sugar, structures_folder, save_path) if preload else None
+        for tile in tiles:
+            pairs = results.pairs_to_compute(structures_folder, all_structures, tile)
+            if pairs:
+                record_tile(*align_tile(sugar, structures_folder, pairs, perform_align, save_path, preload, preloaded))
+        if preloaded is not None:
+            preloaded.close()
+    else:
+        # Fetch the sugar before the workers start, so they do not download it concurrently
+        cmd.fetch(sugar, path=str(save_path))
+        cmd.delete("all")
 
-    if something_wrong:
-        raise Exception("Something went wrong not empty")
+        # Largest tiles first, pairs of a tile are generated only when it is about to be submitted
+        tiles = sorted(split_into_tiles(n, workers, PRELOAD_BLOCK_SIZE if preload else 100), key=lambda tile: len(tile[0]) * len(tile[1]), reverse=True)
+        tiles_pairs = (pairs for pairs in (results.pairs_to_compute(structures_folder, all_structures, tile) for tile in tiles) if pairs)
+        logger.info(f"Aligning {len(tiles)} tiles using {workers} workers")
+        align = partial(align_tile, sugar, structures_folder, perform_align=perform_align, save_path=save_path, preload=preload)
+        # A crashed worker fails only its own tile, the other unfinished tiles are run again
+        for tile, result, error in map_isolating_crashes(align, tiles_pairs, workers, mp_context=multiprocessing.get_context("spawn")):
+            if error is None:
+                record_tile(*result)
+            else:
+                # Save all pairs of the tile with which something went wrong
+                something_wrong.extend(tile)
+                logger.error(f"Something went wrong with tile of {len(tile)} pairs: {error}")
+
+    results.save()
+    save_something_wrong(something_wrong, config)
+
+
+def load_reference_sugar(sugar: str, save_path: Path) -> Dict[str, np.ndarray]:
+    """
+    Fetch the reference sugar using PyMOL and get coordinates of its heavy atoms.
 
+    :param sugar: The sugar for which representative surroundings are being defined
+    :param save_path: Path to store .cif files fetched by PyMOL
+    :return: Atom names and coordinates of the reference sugar
+    """
+
+    cmd.delete("all")
+    cmd.fetch(sugar, path=str(save_path))
+    reference = {atom.name: np.array(atom.coord) for atom in cmd.get_model(f"{sugar} and not hydro").atom}
+    cmd.delete("all")
+
+    return reference
 
-def perform_alignment(sugar: str, perform_align: bool, config: Config, min_residues) -> None:
+
+def numpy_all_against_all_alignment(sugar: str, structures_folder: Path, perform_align: bool, save_path: Path, config: Config, pair_store: Optional[RmsdPairStore] = None, dtype: str = "float32",
+                                    max_block_size: int = 500) -> None:
+    """
+    Calculates all against all RMSD of all structures in-process with NumPy, an approximation
+    of the PyMOL alignment (see rmsd_one_to_many). Every structure is parsed
+    once and superposed by its sugar onto the reference sugar once (Kabsch), then RMSD of residues
+    paired in their position as is towards the sugar is calculated for all pairs at once.
+    Results are saved the same way as by all_against_all_alignment.
+
+    :param sugar: The sugar for which representative surroundings are being defined
+    :param structures_folder: Path to refined binding sites
+    :param perform_align: If align-like (sequence dependent) residue pairing should be used as well
+    :param save_path: Path to store .cif files fetched by PyMOL
+    :param config: Config object
+    :param pair_store: Store of pairs calculated in previous runs; defaults to None
+    :param dtype: Data type of the RMSD matrices
+    :param max_block_size: Maximum number of structures on one side of a tile of pairs calculated at once
+    """
+
+    logger.info("Performing alignment using NumPy engine")
+
+    all_structures = sorted((path.name for path in structures_folder.glob("*.pdb")), key=lambda name: int(name.split("_")[0]))
+    results = RmsdResults(sugar, len(all_structures), ["super", "align"] if perform_align else ["super"], config, pair_store, dtype)
+
+    surroundings, failed = parse_surroundings([structures_folder / structure for structure in all_structures])
+    if surroundings:
+        failed.update(superpose_on_reference(surroundings, load_reference_sugar(sugar, save_path)))
+    for name, reason in failed.items():
+        logger.error(f"Something went wrong with {name}: {reason}")
+    surroundings = [surrounding for surrounding in surroundings if surrounding.name not in failed]
+    positions = {f"{surrounding.name}.pdb": i for i, surrounding in enumerate(surroundings)}
+    codes = residue_codes(surroundings)
+
+    something_wrong = []
+    # Pairs are calculated tile by tile, so pairs of all tiles are never held at once
+    for tile in split_into_tiles(len(all_structures), 1, max_block_size):
+        pairs = results.pairs_to_compute(structures_folder, all_structures, tile)
+        something_wrong.extend((structure1, structure2) for (structure1, structure2) in pairs
+                               if Path(structure1).stem in failed or Path(structure2).stem in failed)
+        pairs = [(structure1, structure2) for (structure1, structure2) in pairs if structure1 in positions and structure2 in positions]
+
+        for method, match_names in [("super", False), ("align", True)]:
+            if method not in results.matrices:
+                continue
+            rmsd = rmsd_of_pairs(surroundings, [(positions[structure1], positions[structure2]) for (structure1, structure2) in pairs], match_names, codes=codes)
+            for (structure1, structure2), rms in zip(pairs, rmsd):
+                if np.isnan(rms):
+                    something_wrong.append((structure1, structure2))
+                    logger.error(f"Something went wrong: no atoms paired in {method} of {structure1} and {structure2}")
+                    continue
+                results.add(method, Path(structure1).stem, Path(structure2).stem, float(rms))
+
+    results.save()
+    save_something_wrong(something_wrong, config)
+
+
+def perform_alignment(sugar: str, perform_align: bool, config: Config, min_residues, engine: str = "pymol", workers: int = 1, preload: bool = False, incremental: bool = False, rmsd_dtype: str = "float32", verify_preload: int = 0) -> None:
     filtered_surroundings_folder = refine_binding_sites(sugar, min_residues, config)
     sys.stdout.flush()
 
     save_path = config.sugars_dir
     save_path.mkdir(exist_ok=True, parents=True)
-    all_against_all_alignment(sugar, filtered_surroundings_folder, perform_align, save_path, config)
+    pair_store = RmsdPairStore(config.rmsd_pair_store_path, engine) if incremental else None
+    if engine == "numpy":
+        numpy_all_against_all_alignment(sugar, filtered_surroundings_folder, perform_align, save_path, config, pair_store, rmsd_dtype)
+    else:
+        all_against_all_alignment(sugar, filtered_surroundings_folder, perform_align, save_path, config, workers, preload, pair_store, rmsd_dtype, verify_preload)
 
 
 if __name__ == "__main__":
@@ -234,6 +710,12 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--sugar", help="Three letter code of sugar", type=str, required=True)
     parser.add_argument("-a", "--perform_align", action="store_true", help="Whether to perform calculation of RMSD using the PyMOL align command as well")
     parser.add_argument("--min_residues", help="Minimum number of residues required in a surrounding", type=int, default=5)
+    parser.add_argument("--engine", help="Engine used to calculate all against all RMSD; numpy pairs residues as mutual nearest CA neighbours, which only approximates PyMOL super/align and gives different values (see scripts/alignment/compare_engines.py)", type=str, choices=["pymol", "numpy"], default="pymol")
+    parser.add_argument("--workers", help="Number of PyMOL worker processes used for alignment", type=int, default=1)
+    parser.add_argument("--preload", action="store_true", help="Whether to load and align each surrounding by its sugar only once per tile of pairs")
+    parser.add_argument("--verify_preload", help="Number of surroundings to compare preloaded and pair by pair RMSD on before the alignment", type=int, default=0)
+    parser.add_argument("--incremental", action="store_true", help="Whether to reuse RMSD of pairs of unchanged surroundings from previous runs")
+    parser.add_argument("--rmsd_dtype", help="Data type of the stored RMSD matrices", type=str, choices=["float32", "float64"], default="float32")
 
     args = parser.parse_args()
 
@@ -242,8 +724,7 @@ if __name__ == "__main__":
     setup_logger(config.log_path)
 
     try:
-        perform_alignment(args.sugar, args.perform_align, config, args.min_residues)
+        perform_alignment(args.sugar, args.perform_align, config, args.min_residues, args.engine, args.workers, args.preload, args.incremental, args.rmsd_dtype, args.verify_preload)
     except Exception as e:
         logger.error(f"Exception caught: {e}")
         raise e
-
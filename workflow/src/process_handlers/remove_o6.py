@@ -13,6 +13,7 @@ from logger import setup_logger
 
 from configuration import Config
 from utils.hide_altloc import get_possible_altloc_file_names
+from utils.mmcif_files import index_mmcif_files, open_mmcif_file
 
 
 def get_pdb_ids_with_rscc(config: Config) -> None:
@@ -40,10 +41,13 @@ def remove_o6(config: Config) -> None:
 
     with open(config.validation_dir / "pdbs_with_rscc_and_resolution.json", "r", encoding="utf8") as f:
         pdb_ids_of_interest = json.load(f)
+    modified_mmcif_files = index_mmcif_files(config.modified_mmcif_files_dir)
     for pdb in pdb_ids_of_interest:
         for file_name in get_possible_altloc_file_names(pdb.lower()):
+            if file_name not in modified_mmcif_files:
+                continue
             try:
-                with (config.modified_mmcif_files_dir / f"{file_name}.cif").open() as f:
+                with open_mmcif_file(modified_mmcif_files[file_name]) as f:
                     file = f.readlines()
                 with (config.no_o6_mmcif_dir / f"{file_name}.cif").open("w") as f:
                     for line in file:
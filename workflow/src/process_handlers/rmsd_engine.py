@@ -0,0 +1,294 @@
+"""
+Script Name: rmsd_engine.py
+Description: Vectorized all against all RMSD of sugar surroundings computed with NumPy,
+             an in-process alternative to the per-pair PyMOL alignment.
+Author: Kateřina Nazarčuková
+"""
+
+
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+import itertools
+from pathlib import Path
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+HYDROGENS = {"H", "D"}
+
+SUGAR_ID_REGEX = re.compile(r"_([A-Z]{3})_(\d+)_([A-Za-z0-9]+)(?:_[A-Za-z0-9]+)?$")
+
+
+@dataclass
+class Surrounding:
+    """
+    Surrounding parsed into coordinate arrays.
+
+    Residue atoms are stored in a (residues, atom names, 3) array indexed by
+    a vocabulary of atom names shared by all surroundings, missing atoms are NaN.
+    """
+
+    name: str
+    index: int
+    sugar_atoms: Dict[str, np.ndarray]
+    residue_names: List[str]
+    anchors: np.ndarray
+    atoms: np.ndarray
+
+
+def parse_sugar_id(filename: str) -> Tuple[str, str, str]:
+    """
+    Get the name, number and chain of the sugar from the surrounding file name.
+
+    :param filename: Name of the surrounding file (without suffix)
+    :return: Name, number and chain of the sugar residue
+    :raises ValueError: If the file name does not follow the surrounding naming
+    """
+
+    res = SUGAR_ID_REGEX.search(filename)
+    if res is None:
+        raise ValueError(f"Unexpected PDB file name: {filename}")
+    name, num, chain = res.groups()
+
+    # Some structures have chains named eg. AaA but in PDB format
+    # the chain is reffered to just as A.
+    return name, num, chain[0]
+
+
+def read_pdb_atoms(path_to_file: Path) -> List[Tuple[str, str, str, str, np.ndarray]]:
+    """
+    Read heavy atoms of the first model of a PDB file.
+
+    :param path_to_file: Path to the PDB file
+    :return: List of (residue name, residue number, chain, atom name, coordinates)
+    """
+
+    atoms = []
+    with open(path_to_file, "r") as f:
+        for line in f:
+            record = line[:6]
+            if record.startswith("ENDMDL"):
+                break
+            if record not in ("ATOM  ", "HETATM"):
+                continue
+            element = line[76:78].strip() or line[12:14].strip().lstrip("0123456789")
+            if element.upper() in HYDROGENS:
+                continue
+            coords = np.array([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+            atoms.append((line[17:20].strip(), line[22:27].strip(), line[21], line[12:16].strip(), coords))
+
+    return atoms
+
+
+def parse_surroundings(paths: List[Path]) -> Tuple[List[Surrounding], Dict[str, str]]:
+    """
+    Parse filtered surroundings into coordinate arrays with a shared atom name vocabulary.
+
+    :param paths: Paths to the filtered surroundings named <idx>_<surrounding name>.pdb
+    :return: Parsed surroundings and surroundings that could not be parsed with the reason
+    """
+
+    parsed: List[Tuple[str, int, Dict[str, np.ndarray], List[Tuple[str, Dict[str, np.ndarray]]]]] = []
+    failed: Dict[str, str] = {}
+    vocabulary: Dict[str, int] = {}
+
+    for path in paths:
+        try:
+            sugar_name, sugar_num, sugar_chain = parse_sugar_id(path.stem)
+            sugar_atoms: Dict[str, np.ndarray] = {}
+            residues: Dict[Tuple[str, str, str], Dict[str, np.ndarray]] = {}
+            for res_name, res_num, chain, atom_name, coords in read_pdb_atoms(path):
+                if (res_name, res_num, chain) == (sugar_name, sugar_num, sugar_chain):
+                    sugar_atoms.setdefault(atom_name, coords)
+                    continue
+                residues.setdefault((chain, res_num, res_name), {}).setdefault(atom_name, coords)
+                vocabulary.setdefault(atom_name, len(vocabulary))
+
+            if not sugar_atoms:
+                raise ValueError(f"Sugar {sugar_name} {sugar_num} {sugar_chain} not found")
+            if not residues:
+                raise ValueError("No polymer residues found")
+            parsed.append((path.stem, int(path.stem.split("_")[0]), sugar_atoms, [(key[2], atoms) for key, atoms in residues.items()]))
+        except ValueError as e:
+            failed[path.stem] = str(e)
+
+    surroundings = []
+    for name, index, sugar_atoms, residues in parsed:
+        atoms = np.full((len(residues), len(vocabulary), 3), np.nan)
+        anchors = np.empty((len(residues), 3))
+        for i, (_, residue_atoms) in enumerate(residues):
+            for atom_name, coords in residue_atoms.items():
+                atoms[i, vocabulary[atom_name]] = coords
+            anchor = residue_atoms.get("CA")
+            anchors[i] = anchor if anchor is not None else np.mean(list(residue_atoms.values()), axis=0)
+        surroundings.append(Surrounding(name, index, sugar_atoms, [res_name for res_name, _ in residues], anchors, atoms))
+
+    return surroundings, failed
+
+
+def kabsch(mobile: np.ndarray, target: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the rotation and translation minimizing RMSD of <mobile> onto <target>.
+
+    :param mobile: Coordinates to be moved (n, 3)
+    :param target: Reference coordinates (n, 3)
+    :return: Rotation matrix and translation vector, apply as coords @ rotation.T + translation
+    """
+
+    mobile_center = mobile.mean(axis=0)
+    target_center = target.mean(axis=0)
+    h = (mobile - mobile_center).T @ (target - target_center)
+    u, _, vt = np.linalg.svd(h)
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1.0, 1.0, d]) @ u.T
+
+    return rotation, target_center - mobile_center @ rotation.T
+
+
+def superpose_on_reference(surroundings: List[Surrounding], reference: Dict[str, np.ndarray], min_atoms: int = 3) -> Dict[str, str]:
+    """
+    Move every surrounding (in place) so that its sugar is superposed onto the reference sugar.
+
+    Sugar atoms are paired by their names.
+
+    :param surroundings: Parsed surroundings
+    :param reference: Atom names and coordinates of the reference sugar
+    :param min_atoms: Minimal number of paired sugar atoms
+    :return: Surroundings that could not be superposed with the reason
+    """
+
+    failed: Dict[str, str] = {}
+    for surrounding in surroundings:
+        common = [name for name in surrounding.sugar_atoms if name in reference]
+        if len(common) < min_atoms:
+            failed[surrounding.name] = f"Only {len(common)} sugar atoms paired with the reference"
+            continue
+        rotation, translation = kabsch(np.array([surrounding.sugar_atoms[name] for name in common]),
+                                       np.array([reference[name] for name in common]))
+        surrounding.anchors = surrounding.anchors @ rotation.T + translation
+        surrounding.atoms = surrounding.atoms @ rotation.T + translation
+
+    return failed
+
+
+def pad_surroundings(surroundings: List[Surrounding], residue_codes: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stack a block of surroundings into padded arrays, padding is NaN (coordinates) and -1 (residue codes).
+    Only blocks being compared are padded, so the padded copies never hold all the surroundings at once.
+
+    :param surroundings: Surroundings to stack
+    :param residue_codes: Residue codes of each of the surroundings
+    :return: Anchors (n, r, 3), atoms (n, r, a, 3) and residue codes (n, r)
+    """
+
+    max_residues = max(len(s.residue_names) for s in surroundings)
+    n_atom_names = surroundings[0].atoms.shape[1]
+
+    anchors = np.full((len(surroundings), max_residues, 3), np.nan)
+    atoms = np.full((len(surroundings), max_residues, n_atom_names, 3), np.nan)
+    codes = np.full((len(surroundings), max_residues), -1)
+    for i, (surrounding, surrounding_codes) in enumerate(zip(surroundings, residue_codes)):
+        r = len(surrounding.residue_names)
+        anchors[i, :r] = surrounding.anchors
+        atoms[i, :r] = surrounding.atoms
+        codes[i, :r] = surrounding_codes
+
+    return anchors, atoms, codes
+
+
+def rmsd_one_to_many(query: Surrounding, query_codes: np.ndarray, anchors: np.ndarray, atoms: np.ndarray, codes: np.ndarray, match_names: bool) -> np.ndarray:
+    """
+    Calculate RMSD of one surrounding against a block of padded surroundings, as they are positioned.
+
+    Residues are paired as mutual nearest neighbours by their CA atoms (sequence independent, in place
+    of PyMOL super), optionally only residues with identical names (sequence dependent, in place of PyMOL align).
+    RMSD is calculated from all atoms with the same name in paired residues. This is only an approximation
+    of PyMOL, which pairs residues by a structural alignment, and the values differ from those of PyMOL
+    (see scripts/alignment/compare_engines.py).
+
+    :param query: The surrounding to compare
+    :param query_codes: Residue codes of the query (r,)
+    :param anchors: Padded anchors of the block (b, r, 3)
+    :param atoms: Padded atoms of the block (b, r, a, 3)
+    :param codes: Padded residue codes of the block (b, r)
+    :param match_names: Whether only residues with the same name can be paired
+    :return: RMSD values (b,), NaN if no atoms could be paired
+    """
+
+    block = np.arange(anchors.shape[0])[:, None]
+    query_residues = np.arange(len(query_codes))
+
+    distances = np.linalg.norm(query.anchors[None, :, None, :] - anchors[:, None, :, :], axis=-1)
+    invalid = np.isnan(distances)
+    if match_names:
+        invalid |= query_codes[None, :, None] != codes[:, None, :]
+    distances = np.where(invalid, np.inf, distances)
+
+    nearest = np.argmin(distances, axis=2)  # (b, r_query)
+    nearest_back = np.argmin(distances, axis=1)  # (b, r)
+    paired = (nearest_back[block, nearest] == query_residues[None, :]) & np.isfinite(distances[block, query_residues[None, :], nearest])
+
+    squared = np.sum((query.atoms[None, :, :, :] - atoms[block, nearest]) ** 2, axis=-1)  # (b, r_query, a)
+    valid = ~np.isnan(squared) & paired[:, :, None]
+    counts = valid.sum(axis=(1, 2))
+    sums = np.where(valid, squared, 0.0).sum(axis=(1, 2))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.sqrt(sums / counts)
+
+
+def residue_codes(surroundings: List[Surrounding]) -> List[np.ndarray]:
+    """
+    Encode residue names of the surroundings as integers shared by all surroundings.
+
+    :param surroundings: Parsed surroundings
+    :return: Residue codes of each of the surroundings
+    """
+
+    codes: Dict[str, int] = {}
+    for surrounding in surroundings:
+        for name in surrounding.residue_names:
+            codes.setdefault(name, len(codes))
+
+    return [np.array([codes[name] for name in surrounding.residue_names], dtype=int) for surrounding in surroundings]
+
+
+def rmsd_of_pairs(surroundings: List[Surrounding], pairs: List[Tuple[int, int]], match_names: bool, block_size: int = 1024,
+                  codes: Optional[List[np.ndarray]] = None) -> np.ndarray:
+    """
+    Calculate RMSD of the given pairs of surroundings, as they are positioned.
+
+    Pairs are grouped by the surrounding that appears in more of them, so that e.g. pairs of a few
+    new surroundings with all the others are calculated as a few one to many comparisons.
+
+    :param surroundings: Surroundings superposed by their sugars
+    :param pairs: Pairs of positions in <surroundings>
+    :param match_names: Whether only residues with the same name can be paired
+    :param block_size: Number of surroundings compared against one surrounding at once
+    :param codes: Residue codes of the surroundings (see residue_codes), calculated if not given
+    :return: RMSD values in the order of <pairs>
+    """
+
+    rmsd = np.full(len(pairs), np.nan)
+    if not pairs:
+        return rmsd
+
+    if codes is None:
+        codes = residue_codes(surroundings)
+
+    occurrences = Counter(itertools.chain.from_iterable(pairs))
+    groups: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+    for k, (i, j) in enumerate(pairs):
+        query, target = (i, j) if occurrences[i] >= occurrences[j] else (j, i)
+        groups[query].append((target, k))
+
+    for i, targets in groups.items():
+        for start in range(0, len(targets), block_size):
+            indices = [target for target, _ in targets[start:start + block_size]]
+            anchors, atoms, block_codes = pad_surroundings([surroundings[t] for t in indices], [codes[t] for t in indices])
+            values = rmsd_one_to_many(surroundings[i], codes[i], anchors, atoms, block_codes, match_names)
+            rmsd[[k for _, k in targets[start:start + block_size]]] = values
+
+    return rmsd
@@ -12,35 +12,28 @@ from platform import system
 from subprocess import Popen, PIPE
 from zipfile import ZipFile
 
-import gemmi
 import pandas as pd
 import requests
 from logger import logger, setup_logger
 
 from configuration import Config
+from utils.ccd_index import index_ccd
+from utils.materialize import materialize
 from utils.unzip_file import unzip_all
 
 
 def remove_nonsugar_residues(config: Config) -> None:
     """
-    Remove all the non-sugar residues from the model mmCIF file.
+    Create the model mmCIF file with only the sugar residues. The file is taken from
+    the CCD index, which is cached per CCD release (see index_ccd).
 
     :param config: Config object
     """
 
     logger.info("Creating model file")
 
-    doc = gemmi.cif.read(str(config.components_dir / "components.cif.gz"))
-    for i in range(len(doc) - 1, -1, -1):
-        comp_type = doc[i].find_value('_chem_comp.type')
-        if "saccharide" not in comp_type.lower():
-            del doc[i]
-
-    options = gemmi.cif.WriteOptions()
-    options.misuse_hash = True
-    options.align_pairs = 48
-    options.align_loops = 20
-    doc.write_file(str(config.components_dir / "components_sugars_only.cif"), options)
+    _, sugars_only_file = index_ccd(config.components_dir / "components.cif.gz", config.user_cfg.data_dir / "cache" / "ccd")
+    materialize(sugars_only_file, config.components_dir / "components_sugars_only.cif")
 
 
 def download_mv(config: Config) -> None:
@@ -7,14 +7,16 @@ Credits: Original concept by Daniela Repelová, modifications by Kateřina Nazar
 
 
 from argparse import ArgumentParser
+from collections import defaultdict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import json
-from typing import List, Dict
-import os
+from typing import List, Dict, Set, Tuple
 from pathlib import Path
 from platform import system
+from queue import Queue
 import shutil
 from subprocess import Popen, PIPE
-from tempfile import TemporaryDirectory
 import zipfile
 
 import requests
@@ -22,6 +24,10 @@ from tqdm import tqdm
 from logger import logger, setup_logger
 
 from configuration import Config
+from utils.materialize import materialize
+from utils.mmcif_files import index_mmcif_files, mmcif_stem
+from utils.parallel import ordered_map
+from process_handlers.ambient_residues import extract_surroundings
 from utils.unzip_file import unzip_all
 
 
@@ -45,95 +51,212 @@ def download_pq(config: Config) -> None:
     unzip_all(config.user_cfg.pq_dir / "PatternQuery.zip", config.user_cfg.pq_dir / "PatternQuery")
 
 
-def create_pq_config(config: Config, structure: str, residues: List[Dict[str, str]], sugar: str) -> List[str]:
+def query_residues(structure: str, residues: List[Dict[str, str]], sugars: List[str]) -> List[Tuple[str, Dict[str, str]]]:
     """
-    Create config file for the given structure.
+    Get residues of interest of the given structure with their query IDs.
 
-    Every stucture can contain 0 - n residues of interest specified by <sugar>.
-    If the current structure does not contain any residue of sugar of interest, empty list is returned - so the program can jump to the next structure.
-    If at least one residue of interest is present:
-    For every residue a separate query is needed. Therefore one config file with 1-n queries is created per structure.
-    Then it is saved and a list of all query names is returnd.
-    Name is in a form <pdb>_<name>_<num>_<chain>_*<case_sensitive_tag>*.pdb
+    Every stucture can contain 0 - n residues of interest specified by <sugars>.
+    For every residue a separate query is needed, if no residue of interest is present, empty list is returned.
+    Query ID is in a form <pdb>_<name>_<num>_<chain>_*<case_sensitive_tag>*
 
     :param structure: PDB ID of structure
     :param residues: Ligand residues of the given structure
-    :param sugar: The sugar that the representative surrounding is defined for
-    :return: List of query IDs
+    :param sugars: The sugars that the representative surroundings are defined for
+    :return: List of query IDs with their residues
     """
-    
-    pq_config = {
-        "InputFolders": [
-            str(config.pq_run_dir / "structures"),
-        ],
-        "Queries": [],
-        "StatisticsOnly": False,
-        "MaxParallelism": 2
-    }
-    query_names = []
+
+    queries = []
 
     # PQ queries are not case sensitive but there an be structures that contain
     # two chains with the same letter but one is upper case and the other lower
     # case. In that case e.g. residues "GLC 1 M" and "GLC 1 m" would have the same
     # query for PQ. Therefore, tag "_2" is added to such queries.
-    case_sensitive_check = []
+    case_sensitive_check: Set[Tuple[str, str, str]] = set()
     for residue in residues:
-        if residue["name"] == sugar:
-            case = f"{residue['num']}_{residue['chain']}"
-            if case.upper() in case_sensitive_check or case.lower() in case_sensitive_check:
+        if residue["name"] in sugars:
+            case = (residue["name"], residue["num"], residue["chain"].lower())
+            if case in case_sensitive_check:
                 query_id = f"{structure}_{residue['name']}_{residue['num']}_{residue['chain']}_2"
             else:
-                case_sensitive_check.append(case)
+                case_sensitive_check.add(case)
                 query_id = f"{structure}_{residue['name']}_{residue['num']}_{residue['chain']}"
-            query_names.append(query_id)
-            query_str = f"ResidueIds('{residue['num']} {residue['chain']}').AmbientResidues(5)"
-            pq_config["Queries"].append({"Id": query_id, "QueryString": query_str})
+            queries.append((query_id, residue))
+
+    return queries
+
+
+def create_queries(residues: List[Tuple[str, Dict[str, str]]]) -> List[Dict[str, str]]:
+    """
+    Create PQ queries for the given residues.
+
+    :param residues: List of query IDs with their residues
+    :return: List of queries with their IDs
+    """
+
+    return [{"Id": query_id, "QueryString": f"ResidueIds('{residue['num']} {residue['chain']}').AmbientResidues(5)"}
+            for query_id, residue in residues]
+
+
+def create_pq_config(run_dir: Path, queries: List[Dict[str, str]], max_parallelism: int = 2) -> None:
+    """
+    Create config file with the given queries, which are run over all structures in the PQ input folder.
 
-    if query_names:
-        # Create respective config file for current structure, with queries for every ligand of sugar of interest in that structure
-        with open(config.pq_run_dir / "pq_config.json", "w") as f:
-            json.dump(pq_config, f, indent=4)
+    :param run_dir: Working directory of the PQ run, with the structures folder
+    :param queries: List of queries with their IDs
+    :param max_parallelism: Number of threads used by PQ
+    """
 
-    return query_names
+    pq_config = {
+        "InputFolders": [
+            str(run_dir / "structures"),
+        ],
+        "Queries": queries,
+        "StatisticsOnly": False,
+        "MaxParallelism": max_parallelism
+    }
 
+    with open(run_dir / "pq_config.json", "w") as f:
+        json.dump(pq_config, f, indent=4)
 
-def extract_results(target: Path, zip_result_folder: Path, query_names: List[str]) -> None:
+
+def pattern_structure(member: str) -> str:
     """
-    Unzip the results and rename and move each sugar surrounding (pattern) to single common folder.
+    Get the structure a pattern was found in from its name in the results, <query>/patterns/<structure>_<serial>.pdb.
+
+    :param member: Name of the pattern in the zipped results
+    :return: Name of the structure (lower case)
+    """
+
+    # The structure name might keep the .cif suffix of a gzipped input file
+    return mmcif_stem(Path(Path(member).stem.rsplit("_", 1)[0])).lower()
+
+
+def extract_results(zip_result_folder: Path, query_names: List[Tuple[str, str, Path]]) -> None:
+    """
+    Read each sugar surrounding (pattern) from the zipped results and save it under the name of its query
+    to the common folder of its sugar. Only the pattern members are read, nothing else is extracted from the zip.
 
     Results are present in the zip folder, where every query has its own subfolder with the name
     same as was its query name: <pdb>_<name>_<num>_<chain>_*<key_sensitive_tag>*.pdb.
-    Each query is expected to have only one pattern found.
+    Queries are run over all structures of the batch, so the patterns of each query are split by the structure
+    they were found in and only those found in the structure the query was created for are taken.
+    Each query is expected to have only one pattern found in its structure.
 
-    :param target: The common folder to which resulting surroundings are moved
     :param zip_result_folder: Path to zip folder containing PQ results
-    :param query_names: List of query IDs
+    :param query_names: List of query IDs with the structure they were created for and the folder to save the surrounding to
     """
 
     logger.info("Extracting results")
 
-    with TemporaryDirectory() as temp_dir:
-        with zipfile.ZipFile(zip_result_folder, "r") as zip_ref:
-            zip_ref.extractall(temp_dir)
-            for query_name in query_names: 
-                results_path = Path(temp_dir) / query_name / "patterns"
-                if not results_path.exists():
-                    pq_couldnt_find_pattern.append(query_name)
-                    continue
-                # It is expected to have only one pattern found for one query, but checking just in case
-                if len(os.listdir(results_path)) > 1:
-                    #global END_FLAG
-                    #END_FLAG = True
-                    #return
-                    more_than_one_pattern.append(query_name)
-                    continue
-                for file in results_path.iterdir():
-                    Path(file).rename(results_path / f"{query_name}.pdb")  # Rename the pattern so it is distinguishable
-                src = results_path / f"{query_name}.pdb"
-                shutil.move(str(src), str(target))
-
-
-def run_pq(sugar: str, config: Config, is_unix: bool) -> None:
+    with zipfile.ZipFile(zip_result_folder, "r") as zip_ref:
+        # Pattern members of each query and structure: <query>/patterns/<structure>_<serial>.pdb
+        patterns: Dict[Tuple[str, str], List[str]] = defaultdict(list)
+        for member in zip_ref.namelist():
+            parts = member.split("/")
+            if len(parts) == 3 and parts[1] == "patterns" and parts[2].endswith(".pdb"):
+                patterns[(parts[0], pattern_structure(member))].append(member)
+
+        for query_name, structure, target in query_names:
+            members = patterns[(query_name, structure.lower())]
+            if not members:
+                pq_couldnt_find_pattern.append(query_name)
+                continue
+            # It is expected to have only one pattern found for one query, but checking just in case
+            if len(members) > 1:
+                #global END_FLAG
+                #END_FLAG = True
+                #return
+                more_than_one_pattern.append(query_name)
+                continue
+            # Save the pattern under the query name so it is distinguishable
+            with zip_ref.open(members[0]) as src, open(target / f"{query_name}.pdb", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+
+def run_pq_process(run_dir: Path, pq_dir: Path, is_unix: bool) -> None:
+    """
+    Run PQ with the current config file over the structures in the PQ input folder.
+
+    :param run_dir: Working directory of the PQ run
+    :param pq_dir: Directory with PatternQuery
+    :param is_unix: Whether the program runs on Unix (PQ is run using mono)
+    """
+
+    cmd = [f"{'mono ' if is_unix is True else ''}"
+           f"{pq_dir}/WebChemistry.Queries.Service.exe "
+           f"{run_dir}/results "
+           f"{run_dir}/pq_config.json"]
+
+
+    with Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True, text=True) as pq_proc:
+        assert pq_proc.stdout is not None, "stdout is set to PIPE in Popen" 
+        for line in pq_proc.stdout:
+            logger.info(f"STDOUT: {line.strip()}")
+        assert pq_proc.stderr is not None, "stderr is set to PIPE in Popen" 
+        for line in pq_proc.stderr:
+            logger.error(f"STDERR: {line.strip()}")
+
+    if pq_proc.returncode != 0:
+        logger.error(f"PQ process exited with code {pq_proc.returncode}")
+    else:
+        logger.info("PQ process completed successfully")
+
+
+def process_batch(batch: List[Tuple[str, List[Tuple[str, Dict[str, str]]]]], run_dir: Path, pq_dir: Path, mmcif_files: Dict[str, Path],
+                  targets: Dict[str, Path], is_unix: bool, max_parallelism: int) -> None:
+    """
+    Run PQ once for one batch of structures in the given working directory, with the queries of all structures
+    of the batch, and move the found surroundings to the raw surroundings folders of their sugars.
+
+    :param batch: Structures with their residues of interest and query IDs
+    :param run_dir: Working directory of the PQ run, with structures and results folders
+    :param pq_dir: Directory with PatternQuery
+    :param mmcif_files: Modified mmCIF files (.cif or .cif.gz) keyed by structure
+    :param targets: Raw surroundings folders keyed by sugar
+    :param is_unix: Whether the program runs on Unix (PQ is run using mono)
+    :param max_parallelism: Number of threads used by PQ
+    """
+
+    # Link current structures to ./structures dir which is used as source by PQ, gzipped files are read by PQ as they are.
+    links = []
+    for structure, _ in batch:
+        links.append(run_dir / "structures" / mmcif_files[structure].name)
+        materialize(mmcif_files[structure], links[-1])
+    create_pq_config(run_dir, [query for _, residues in batch for query in create_queries(residues)], max_parallelism)
+
+    try:
+        run_pq_process(run_dir, pq_dir, is_unix)
+
+        zip_result_folder = run_dir / "results" / "result/result.zip"
+        if not zip_result_folder.exists():
+            result_folder_not_created.extend(structure for structure, _ in batch)
+        else:
+            extract_results(zip_result_folder, [(query_id, structure, targets[residue["name"]]) for structure, residues in batch for query_id, residue in residues])
+            # Delete the result folder so the new one can be created
+            shutil.rmtree(run_dir / "results" / "result")
+    finally:
+        # Delete the current structures from ./structures so the new ones can be linked there
+        for link in links:
+            link.unlink()
+
+
+def run_pq_batches(config: Config, to_search: List[Tuple[str, List[Tuple[str, Dict[str, str]]]]], mmcif_files: Dict[str, Path],
+                   targets: Dict[str, Path], is_unix: bool, batch_size: int = 1, workers: int = 1, cpus: int = 2) -> None:
+    """
+    Find the surroundings using PQ. Structures are processed in batches, PQ is run once per batch with queries
+    of all structures in the batch, so its startup is shared by the whole batch. Batches are run by <workers> concurrent PQ processes, each in its own
+    working directory, and the CPU budget is split among them.
+
+    :param config: Config object
+    :param to_search: Structures with their residues of interest and query IDs
+    :param mmcif_files: Modified mmCIF files (.cif or .cif.gz) keyed by structure
+    :param targets: Raw surroundings folders keyed by sugar
+    :param is_unix: Whether the program runs on Unix (PQ is run using mono)
+    :param batch_size: Number of structures processed by one PQ run
+    :param workers: Number of concurrent PQ processes
+    :param cpus: Total number of CPUs used by all PQ processes
+    """
+
     (config.user_cfg.pq_dir).mkdir(exist_ok=True, parents=True)
     pq_base = config.user_cfg.pq_dir
     matches = sorted([p for p in pq_base.glob("PatternQuery*") if p.is_dir()])
@@ -141,67 +264,92 @@ def run_pq(sugar: str, config: Config, is_unix: bool) -> None:
     if not pq_dir.exists() or (pq_dir.is_dir() and not any(pq_dir.iterdir())):
         raise Exception(f"Missing requirement: PatternQuery. Not found in {pq_dir}")
 
-    (config.pq_run_dir / "structures").mkdir(exist_ok=True, parents=True)
-    (config.pq_run_dir / "results").mkdir(exist_ok=True, parents=True)
-
-
-    with open(config.categorization_dir / "filtered_modified_ligands.json", "r") as f:
-        ligands: dict = json.load(f)
-
-    target_dir = config.raw_surroundings_dir
-    target_dir.mkdir(exist_ok=True, parents=True)
+    workers = max(1, workers)
+    # Working directories of the workers, a worker takes one for each batch and returns it afterwards
+    run_dirs: Queue = Queue()
+    for i in range(workers):
+        run_dir = config.pq_run_dir / f"worker_{i}"
+        (run_dir / "structures").mkdir(exist_ok=True, parents=True)
+        (run_dir / "results").mkdir(exist_ok=True, parents=True)
+        run_dirs.put(run_dir)
+    max_parallelism = max(1, cpus // workers)
 
     logger.info("Creating PatternQuerry configs")
 
+    def run_batch(batch: List[Tuple[str, List[Tuple[str, Dict[str, str]]]]]) -> None:
+        run_dir = run_dirs.get()
+        try:
+            process_batch(batch, run_dir, pq_dir, mmcif_files, targets, is_unix, max_parallelism)
+        finally:
+            run_dirs.put(run_dir)
 
-    for structure, residues in tqdm(ligands.items(), desc="Running PQ for each ligand"):
-        prefix, pdb_id = structure.split("_", 1)
-        structure = f"{prefix}_{pdb_id.lower()}"
-        query_names = create_pq_config(config, structure, residues, sugar)
-        if not query_names:
-            continue
-        for file in sorted(config.modified_mmcif_files_dir.glob("*.cif")):
-            # Copy current structure to ./structures dir which is used as source by PQ.
-            if structure in file.name:
+    batches = [to_search[i:i + batch_size] for i in range(0, len(to_search), max(1, batch_size))]
+    logger.info(f"Running {len(batches)} batches using {workers} PQ workers with MaxParallelism {max_parallelism}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(tqdm(executor.map(run_batch, batches), total=len(batches), desc="Running PQ for batches of ligands"))
 
 
-                src = file
-                dst = config.pq_run_dir / "structures" / file.name
-                shutil.copyfile(src, dst)
+def run_pq(sugar: str, config: Config, is_unix: bool, batch_size: int = 1, workers: int = 1, cpus: int = 2, backend: str = "pq") -> None:
+    """
+    Find the surroundings (residues within 5 A) of all ligands of the sugar, either using PQ
+    or in-process using gemmi, both save the surroundings under the same names.
+
+    :param sugar: The sugar that the representative surrounding is defined for
+    :param config: Config object
+    :param is_unix: Whether the program runs on Unix (PQ is run using mono)
+    :param batch_size: Number of structures processed by one PQ run
+    :param workers: Number of concurrent PQ processes or gemmi worker processes
+    :param cpus: Total number of CPUs used by all PQ processes
+    :param backend: Tool used to find the surroundings, pq or gemmi
+    """
 
+    run_pq_for_sugars([sugar], {sugar: config}, is_unix, batch_size, workers, cpus, backend)
 
-                # Run PQ
-                cmd = [f"{'mono ' if is_unix is True else ''}"
-                       f"{pq_dir}/WebChemistry.Queries.Service.exe "
-                       f"{config.pq_run_dir}/results "
-                       f"{config.pq_run_dir}/pq_config.json"]
 
+def run_pq_for_sugars(sugars: List[str], configs: Dict[str, Config], is_unix: bool, batch_size: int = 1, workers: int = 1, cpus: int = 2,
+                      backend: str = "pq") -> None:
+    """
+    Find the surroundings of all ligands of all the sugars in a single pass over the structures,
+    every structure is searched (and read) only once with the residues of all the sugars.
+    Surroundings are saved to the raw surroundings folder of their sugar.
+
+    The data run paths and the PQ working directory are taken from the config of the first sugar.
+
+    :param sugars: The sugars that the representative surroundings are defined for
+    :param configs: Config objects keyed by sugar
+    :param is_unix: Whether the program runs on Unix (PQ is run using mono)
+    :param batch_size: Number of structures processed by one PQ run
+    :param workers: Number of concurrent PQ processes or gemmi worker processes
+    :param cpus: Total number of CPUs used by all PQ processes
+    :param backend: Tool used to find the surroundings, pq or gemmi
+    """
 
-                with Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True, text=True) as pq_proc:
-                    assert pq_proc.stdout is not None, "stdout is set to PIPE in Popen" 
-                    for line in pq_proc.stdout:
-                        logger.info(f"STDOUT: {line.strip()}")
-                    assert pq_proc.stderr is not None, "stderr is set to PIPE in Popen" 
-                    for line in pq_proc.stderr:
-                        logger.error(f"STDERR: {line.strip()}")
+    config = configs[sugars[0]]
 
-                if pq_proc.returncode != 0:
-                    logger.error(f"PQ process exited with code {pq_proc.returncode}")
-                else:
-                    logger.info("PQ process completed successfully")
+    with open(config.categorization_dir / "filtered_modified_ligands.json", "r") as f:
+        ligands: dict = json.load(f)
 
-                zip_result_folder = config.pq_run_dir / "results" / "result/result.zip"
-                if not zip_result_folder.exists():
-                    result_folder_not_created.append(structure)
-                    # Delete the current structure from ./structures directory and continue to the next structure
-                    Path(config.pq_run_dir / "structures" / file.name).unlink()
-                    continue
+    targets = {sugar: configs[sugar].raw_surroundings_dir for sugar in sugars}
+    for target in targets.values():
+        target.mkdir(exist_ok=True, parents=True)
 
-                extract_results(target_dir, zip_result_folder, query_names)
+    # Structures with at least one residue of interest, with their query IDs
+    modified_mmcif_files = index_mmcif_files(config.modified_mmcif_files_dir)
+    to_search: List[Tuple[str, List[Tuple[str, Dict[str, str]]]]] = []
+    for structure, residues in ligands.items():
+        prefix, pdb_id = structure.split("_", 1)
+        structure = f"{prefix}_{pdb_id.lower()}"
+        residues_of_interest = query_residues(structure, residues, sugars)
+        if residues_of_interest and structure in modified_mmcif_files:
+            to_search.append((structure, residues_of_interest))
 
-                # Delete the result folder and also the current structure from ./structures so the new one can be copied there
-                (config.pq_run_dir / "structures" / f"{structure}.cif").unlink()
-                shutil.rmtree(config.pq_run_dir / "results" / "result")
+    if backend == "gemmi":
+        items = [(modified_mmcif_files[structure], residues) for structure, residues in to_search]
+        results = ordered_map(partial(extract_surroundings, targets=targets), items, workers, desc="Extracting surroundings of ligands")
+        for not_found in results:
+            pq_couldnt_find_pattern.extend(not_found)
+    else:
+        run_pq_batches(config, to_search, modified_mmcif_files, targets, is_unix, batch_size, workers, cpus)
 
 
     if more_than_one_pattern:
@@ -217,14 +365,21 @@ def run_pq(sugar: str, config: Config, is_unix: bool) -> None:
 if __name__ == "__main__":
     parser = ArgumentParser()
 
-    parser.add_argument("-s", "--sugar", help="Three letter code of sugar", type=str, required=True)
+    parser.add_argument("-t", "--test_mode", action="store_true",
+                        help="Weather to run the whole process in a test mode")
+    parser.add_argument("-s", "--sugar", help="Three letter code of sugar, more sugars are extracted in a single pass", type=str, nargs="+", required=True)
+
+    parser.add_argument("--pq_batch_size", help="Number of structures processed by one PatternQuery run", type=int, default=1)
+    parser.add_argument("--pq_workers", help="Number of concurrent PatternQuery processes", type=int, default=1)
+    parser.add_argument("--pq_cpus", help="Total number of CPUs used by all PatternQuery processes", type=int, default=2)
+    parser.add_argument("--surroundings_backend", help="Tool used to find the surroundings of ligands", type=str, choices=["pq", "gemmi"], default="pq")
 
     args = parser.parse_args()
 
-    config = Config.load("config.json", args.sugar, True, args)
+    configs = {sugar: Config.load("config.json", sugar, True, args) for sugar in args.sugar}
 
-    setup_logger(config.log_path)
+    setup_logger(configs[args.sugar[0]].log_path)
 
     is_unix = system() != "Windows"
 
-    run_pq(args.sugar, config, is_unix)
+    run_pq_for_sugars(args.sugar, configs, is_unix, args.pq_batch_size, args.pq_workers, args.pq_cpus, args.surroundings_backend)
@@ -26,17 +26,19 @@ from process_handlers.create_tanglegram import create_tanglegram
 from process_handlers.structure_motif_search import structure_motif_search
 
 
-def main(test_mode: bool, sugar: str, config: Config, is_unix: bool, perform_align: bool, perform_clustering: bool, number: int, method: str, min_residues: int, max_residues: int, make_dendrogram: bool, store_result_path: Union[Path, None], color_threshold: Union[float, None] = None) -> None:
+def main(test_mode: bool, sugar: str, config: Config, is_unix: bool, perform_align: bool, perform_clustering: bool, number: int, method: str, min_residues: int, max_residues: int, make_dendrogram: bool, store_result_path: Union[Path, None], color_threshold: Union[float, None] = None, engine: str = "pymol", workers: int = 1, preload: bool = False, incremental: bool = False, rmsd_dtype: str = "float32", pq_batch_size: int = 1, pq_workers: int = 1, pq_cpus: int = 2, surroundings_backend: str = "pq", skip_surroundings: bool = False, verify_preload: int = 0) -> None:
     logger.info(f"Running 2nd program with data from {config.run_data_dir.stem} directory")
 
     with tqdm(total=6 if perform_clustering else 3) as pbar: 
-        pbar.set_description("Running PatternQuery")
-        run_pq(sugar, config, is_unix)
+        # Surroundings of more sugars can be extracted beforehand in a single pass by run_pq.py
+        if not skip_surroundings:
+            pbar.set_description("Running PatternQuery")
+            run_pq(sugar, config, is_unix, pq_batch_size, pq_workers, pq_cpus, surroundings_backend)
         pbar.update(1)
 
         try:
             pbar.set_description("Performing alignment")
-            run_pymol_subprocess("process_handlers.perform_alignment", ["-t" if test_mode else "", "-s", sugar, "-a" if perform_align else "", "--min_residues", str(min_residues)])
+            run_pymol_subprocess("process_handlers.perform_alignment", ["-t" if test_mode else "", "-s", sugar, "-a" if perform_align else "", "--min_residues", str(min_residues), "--engine", engine, "--workers", str(workers), "--preload" if preload else "", "--incremental" if incremental else "", "--rmsd_dtype", rmsd_dtype, "--verify_preload", str(verify_preload)])
             pbar.update(1)
         except Exception as e:
             logger.error(f"Exception caught: {e}")
@@ -80,6 +82,17 @@ if __name__ == "__main__":
     parser.add_argument("--color_threshold", type=float, help="Color threshold for dendrogram (default: None)")
     parser.add_argument("--keep_current_run", help="Don't end the current run (won't delete .current_run file)", action="store_true")
     parser.add_argument("--store_result_path", type=Path, help="Where to write result file path")
+    parser.add_argument("--engine", help="Engine used to calculate all against all RMSD; numpy pairs residues as mutual nearest CA neighbours, which only approximates PyMOL super/align and gives different values (see scripts/alignment/compare_engines.py)", type=str, choices=["pymol", "numpy"], default="pymol")
+    parser.add_argument("--workers", help="Number of PyMOL worker processes used for alignment", type=int, default=1)
+    parser.add_argument("--preload", action="store_true", help="Whether to load and align each surrounding by its sugar only once per tile of pairs")
+    parser.add_argument("--verify_preload", help="Number of surroundings to compare preloaded and pair by pair RMSD on before the alignment", type=int, default=0)
+    parser.add_argument("--incremental", action="store_true", help="Whether to reuse RMSD of pairs of unchanged surroundings from previous runs")
+    parser.add_argument("--pq_batch_size", help="Number of structures processed by one PatternQuery run", type=int, default=1)
+    parser.add_argument("--pq_workers", help="Number of concurrent PatternQuery processes", type=int, default=1)
+    parser.add_argument("--pq_cpus", help="Total number of CPUs used by all PatternQuery processes", type=int, default=2)
+    parser.add_argument("--surroundings_backend", help="Tool used to find the surroundings of ligands", type=str, choices=["pq", "gemmi"], default="pq")
+    parser.add_argument("--skip_surroundings", action="store_true", help="Whether to use surroundings already extracted in the current run (e.g. by run_pq.py for more sugars at once)")
+    parser.add_argument("--rmsd_dtype", help="Data type of the stored RMSD matrices", type=str, choices=["float32", "float64"], default="float32")
 
     args = parser.parse_args()
 
@@ -99,7 +112,7 @@ if __name__ == "__main__":
     is_unix = system() != "Windows"
 
     with logging_redirect_tqdm():
-        main(args.test_mode, args.sugar, config, is_unix, args.perform_align, args.perform_clustering, args.number, args.method, args.min_residues, args.max_residues, args.make_dendrogram, args.store_result_path, args.color_threshold)
+        main(args.test_mode, args.sugar, config, is_unix, args.perform_align, args.perform_clustering, args.number, args.method, args.min_residues, args.max_residues, args.make_dendrogram, args.store_result_path, args.color_threshold, args.engine, args.workers, args.preload, args.incremental, args.rmsd_dtype, args.pq_batch_size, args.pq_workers, args.pq_cpus, args.surroundings_backend, args.skip_surroundings, args.verify_preload)
 
         if not args.keep_current_run:
             config.clear_current_run()
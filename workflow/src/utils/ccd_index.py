@@ -0,0 +1,111 @@
+import gzip
+import json
+from pathlib import Path
+from typing import IO, List, Optional, Tuple
+
+import gemmi
+
+from utils.checksum import file_checksum
+
+
+SUGAR_NAMES_FILE = "sugar_names.json"
+SUGARS_ONLY_FILE = "components_sugars_only.cif"
+
+
+def ccd_release(components_file: Path) -> str:
+    """
+    Get identifier of the CCD release, the checksum of the components file.
+
+    :param components_file: Path to components.cif.gz
+    :return: Identifier of the CCD release
+    """
+
+    return file_checksum(components_file)[:16]
+
+
+def chem_comp_type(lines: List[bytes]) -> str:
+    """
+    Get _chem_comp.type of the CCD block. The value is read directly from the tag line,
+    the block is parsed by gemmi only if the value is not on the same line.
+
+    :param lines: Lines of the block
+    :return: Type of the chemical component
+    """
+
+    for line in lines:
+        parts = line.split(None, 1)
+        if not parts or parts[0] != b"_chem_comp.type":
+            continue
+        value = parts[1].strip().decode() if len(parts) > 1 else ""
+        if value[:1] in ("'", '"') and value[-1:] == value[:1] and len(value) > 1:
+            return value[1:-1]
+        if value:
+            return value
+        break
+
+    block = gemmi.cif.read_string(b"".join(lines).decode()).sole_block()
+
+    return gemmi.cif.as_string(block.find_value("_chem_comp.type") or "")
+
+
+def scan_saccharides(components_file: Path, sugars_only: IO[bytes]) -> List[str]:
+    """
+    Scan the components file once, line by line, without building the whole document.
+    Text of the saccharide blocks is written to <sugars_only> unchanged.
+
+    :param components_file: Path to components.cif.gz
+    :param sugars_only: Binary file the saccharide blocks are written to
+    :return: Names of the saccharide blocks in the order of the file
+    """
+
+    sugar_names = []
+
+    def flush(name: Optional[str], lines: List[bytes]) -> None:
+        if name is not None and "saccharide" in chem_comp_type(lines).lower():
+            sugar_names.append(name)
+            sugars_only.writelines(lines)
+
+    name = None
+    lines: List[bytes] = []
+    with gzip.open(components_file, "rb") as f:
+        for line in f:
+            if line.startswith(b"data_"):
+                flush(name, lines)
+                name = line[len(b"data_"):].strip().decode()
+                lines = []
+            lines.append(line)
+    flush(name, lines)
+
+    return sugar_names
+
+
+def index_ccd(components_file: Path, cache_root: Path) -> Tuple[List[str], Path]:
+    """
+    Get names of the saccharides in CCD and the file with only their blocks. Both are cached in
+    <cache_root>/<CCD release>, so the components file is scanned only once per release.
+
+    :param components_file: Path to components.cif.gz
+    :param cache_root: Directory with cached indices of all CCD releases
+    :return: Names of the saccharides and path to the mmCIF file with only the saccharide blocks
+    """
+
+    cache_dir = cache_root / ccd_release(components_file)
+    names_file = cache_dir / SUGAR_NAMES_FILE
+    sugars_only_file = cache_dir / SUGARS_ONLY_FILE
+
+    if not (names_file.exists() and sugars_only_file.exists()):
+        cache_dir.mkdir(exist_ok=True, parents=True)
+        # Written to temporary files first, so interrupted scan does not leave incomplete index in the cache
+        tmp_sugars_only = cache_dir / f"{SUGARS_ONLY_FILE}.tmp"
+        with open(tmp_sugars_only, "wb") as f:
+            sugar_names = scan_saccharides(components_file, f)
+        tmp_names = cache_dir / f"{SUGAR_NAMES_FILE}.tmp"
+        with open(tmp_names, "w") as f:
+            json.dump(sugar_names, f, indent=4)
+        tmp_sugars_only.replace(sugars_only_file)
+        tmp_names.replace(names_file)
+
+    with open(names_file, "r") as f:
+        sugar_names = json.load(f)
+
+    return sugar_names, sugars_only_file
@@ -0,0 +1,20 @@
+import hashlib
+from pathlib import Path
+
+
+def file_checksum(path: Path, algorithm: str = "sha256", chunk_size: int = 1 << 20) -> str:
+    """
+    Calculate checksum of the file, the file is read in chunks.
+
+    :param path: Path to the file
+    :param algorithm: Name of the hashlib algorithm
+    :param chunk_size: Number of bytes read at once
+    :return: Hexadecimal digest of the file
+    """
+
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
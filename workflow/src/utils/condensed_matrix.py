@@ -0,0 +1,77 @@
+import math
+from pathlib import Path
+
+import numpy as np
+
+
+def condensed_index(n: int, i: int, j: int) -> int:
+    """
+    Get index of the pair (i, j) in the condensed (upper triangle) form of a symmetric n x n matrix,
+    same as used by scipy.spatial.distance.squareform.
+
+    :param n: Size of the square matrix
+    :param i: Row of the square matrix
+    :param j: Column of the square matrix, different from <i>
+    :return: Index in the condensed matrix
+    """
+
+    if i > j:
+        i, j = j, i
+
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def square_size(condensed: np.ndarray) -> int:
+    """
+    Get size of the square matrix from its condensed form.
+
+    :param condensed: Condensed matrix
+    :return: Size of the square matrix
+    """
+
+    return int(round((1 + math.sqrt(1 + 8 * len(condensed))) / 2))
+
+
+def condensed_matrix_path(results_path: Path, sugar: str, method: str) -> Path:
+    """
+    Get path to the condensed RMSD matrix of the given alignment method.
+
+    :param results_path: Directory with results of the alignment method
+    :param sugar: The sugar for which representative surroundings are being defined
+    :param method: Alignment method
+    :return: Path to the .npy file
+    """
+
+    return results_path / f"{sugar}_all_pairs_rmsd_{method}_condensed.npy"
+
+
+def create_condensed_matrix(path: Path, n: int, dtype: str = "float32") -> np.memmap:
+    """
+    Create memory-mapped .npy file for condensed form of symmetric n x n matrix filled with zeros.
+
+    :param path: Path to the .npy file
+    :param n: Size of the square matrix
+    :param dtype: Data type of the values
+    :return: Writable memory-mapped condensed matrix
+    """
+
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(n * (n - 1) // 2,))
+
+
+def load_rmsd_matrix(results_path: Path, sugar: str, method: str) -> np.ndarray:
+    """
+    Load condensed RMSD matrix of the given alignment method as read only memory map.
+    Results of older runs, saved as square matrix, are converted to condensed form.
+
+    :param results_path: Directory with results of the alignment method
+    :param sugar: The sugar for which representative surroundings are being defined
+    :param method: Alignment method
+    :return: Condensed RMSD matrix
+    """
+
+    path = condensed_matrix_path(results_path, sugar, method)
+    if path.exists():
+        return np.load(path, mmap_mode="r")
+
+    square = np.load(results_path / f"{sugar}_all_pairs_rmsd_{method}.npy")
+    return square[np.triu_indices(len(square), k=1)]
@@ -0,0 +1,64 @@
+import os
+from pathlib import Path
+from typing import Dict, Iterator, Set
+
+
+class DirectoryInventory():
+    """
+    Names of the files in a directory, listed once and queried as a set.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        """
+        :param directory: Directory to list
+        """
+
+        self.directory = directory
+        self._entries: Dict[str, os.DirEntry] = {}
+        self.refresh()
+
+
+    def refresh(self) -> None:
+        """
+        List the directory again, e.g. after files were created or removed in it.
+        """
+
+        with os.scandir(self.directory) as entries:
+            self._entries = {entry.name: entry for entry in entries}
+
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._entries
+
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+    def stems(self) -> Set[str]:
+        """
+        :return: Names of all files in the directory up to the first dot (e.g. 1abc for 1abc.cif.gz)
+        """
+
+        return {name.split(".")[0] for name in self._entries}
+
+
+    def exists(self, name: str) -> bool:
+        """
+        Check the file is in the directory and, if it is a symbolic link, that its target exists.
+        Only symbolic links are checked on disk.
+
+        :param name: Name of the file
+        :return: True if the file exists; False otherwise
+        """
+
+        if name not in self._entries:
+            return False
+        if not self._entries[name].is_symlink():
+            return True
+
+        return (self.directory / name).exists()
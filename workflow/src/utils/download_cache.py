@@ -0,0 +1,73 @@
+import json
+from pathlib import Path
+import threading
+from typing import Dict
+
+import requests
+
+
+CHUNK_SIZE = 1 << 20
+
+
+def stream_to_file(response: requests.Response, dest_path: Path) -> None:
+    """
+    Write body of the streamed response to <dest_path> in chunks. The body is written
+    to a temporary file first and renamed afterwards, so <dest_path> is never left incomplete.
+
+    :param response: Response of a request sent with stream=True
+    :param dest_path: Path to the file to create
+    """
+
+    # Name unique to the thread, the same file may be requested concurrently
+    tmp_path = dest_path.with_name(f"{dest_path.name}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+        tmp_path.replace(dest_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def download_cached(session: requests.Session, url: str, cache_dir: Path, file_name: str, timeout: float = 60) -> bool:
+    """
+    Download <url> to <cache_dir>/<file_name> unless the cached copy is up to date.
+
+    ETag and Last-Modified of the cached copy are stored next to it (<file_name>.meta.json) and sent
+    as a conditional request, so nothing is transferred if the file did not change. The body is streamed
+    to a temporary file in chunks and renamed afterwards, the cached copy is never left incomplete.
+
+    :param session: Session to send the request with
+    :param url: URL of the file
+    :param cache_dir: Directory with cached downloads
+    :param file_name: Name of the cached copy
+    :param timeout: Timeout of the connection and of reading each chunk in seconds
+    :return: True if the file was downloaded, False if the cached copy was up to date
+    :raises requests.HTTPError: If the request did not succeed
+    """
+
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    cached_file = cache_dir / file_name
+    meta_file = cache_dir / f"{file_name}.meta.json"
+
+    headers: Dict[str, str] = {}
+    if cached_file.exists() and meta_file.exists():
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+
+        stream_to_file(response, cached_file)
+
+        with open(meta_file, "w") as f:
+            json.dump({"url": url, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}, f, indent=4)
+
+    return True
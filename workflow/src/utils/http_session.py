@@ -0,0 +1,33 @@
+from typing import Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Responses worth retrying, the server is overloaded or temporarily unavailable
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def create_session(pool_size: int = 10, retries: int = 5, backoff_factor: float = 0.5,
+                   retry_statuses: Tuple[int, ...] = RETRY_STATUSES) -> requests.Session:
+    """
+    Create session with a keep-alive connection pool, that retries failed requests with exponential backoff
+    (Retry-After header of the server is respected). The session can be shared by threads.
+
+    :param pool_size: Maximal number of connections kept open per host, should be at least the number of threads
+    :param retries: Maximal number of retries of one request
+    :param backoff_factor: Base of the delay between retries in seconds, doubled after every retry
+    :param retry_statuses: Response statuses which are retried
+    :return: Configured session
+    """
+
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=retry_statuses,
+                  allowed_methods=["HEAD", "GET"], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
@@ -0,0 +1,71 @@
+import os
+from pathlib import Path
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+# ioctl request to share the data blocks of two files (Linux, e.g. btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def reflink(src_path: Path, dest_path: Path) -> None:
+    """
+    Create copy-on-write clone of <src_path> at <dest_path>.
+
+    :param src_path: Path to the source file
+    :param dest_path: Path to the clone
+    :raises OSError: If the platform or the filesystem does not support reflinks
+    """
+
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+
+    with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dest.close()
+            dest_path.unlink()
+            raise
+
+
+def materialize(src_path: Path, dest_path: Path) -> str:
+    """
+    Make the contents of <src_path> available at <dest_path> without copying the data if possible.
+    Hardlink is preferred, then reflink, then symlink, the file is copied only as the last resort.
+    An existing <dest_path> is replaced.
+
+    The result must be treated as read only, changes of a linked file change the source as well.
+
+    :param src_path: Path to the source file
+    :param dest_path: Path to make the file available at
+    :return: The method that was used (hardlink, reflink, symlink or copy)
+    """
+
+    if dest_path.exists() or dest_path.is_symlink():
+        dest_path.unlink()
+
+    try:
+        os.link(src_path, dest_path)
+        return "hardlink"
+    except OSError:
+        pass
+
+    try:
+        reflink(src_path, dest_path)
+        return "reflink"
+    except OSError:
+        pass
+
+    try:
+        os.symlink(src_path.resolve(), dest_path)
+        return "symlink"
+    except OSError:
+        pass
+
+    shutil.copy2(src_path, dest_path)
+    return "copy"
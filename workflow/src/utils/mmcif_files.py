@@ -0,0 +1,99 @@
+import gzip
+from pathlib import Path
+from typing import Dict, List, TextIO
+
+from utils.directory_inventory import DirectoryInventory
+from utils.materialize import materialize
+
+
+MMCIF_SUFFIXES = (".cif", ".cif.gz")
+
+
+def mmcif_stem(path: Path) -> str:
+    """
+    Get name of the mmCIF file without the .cif or .cif.gz suffix.
+
+    :param path: Path to the mmCIF file
+    :return: Name of the file without suffix
+    """
+
+    name = path.name
+    for suffix in sorted(MMCIF_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+
+    return path.stem
+
+
+def index_mmcif_files(directory: Path) -> Dict[str, Path]:
+    """
+    Index mmCIF files in <directory>, both plain and gzipped, by their name without suffix.
+    The directory is listed only once. If a structure is present in both forms, the plain file is preferred.
+
+    :param directory: Directory with mmCIF files
+    :return: Paths to the mmCIF files keyed by the file name without suffix (e.g. 1abc or 0_1abc)
+    """
+
+    gzipped: Dict[str, Path] = {}
+    plain: Dict[str, Path] = {}
+    for name in DirectoryInventory(directory):
+        if name.endswith(".cif.gz"):
+            gzipped[name[:-len(".cif.gz")]] = directory / name
+        elif name.endswith(".cif"):
+            plain[name[:-len(".cif")]] = directory / name
+
+    files = {**gzipped, **plain}
+
+    return {stem: files[stem] for stem in sorted(files)}
+
+
+def list_mmcif_files(directory: Path) -> List[Path]:
+    """
+    List mmCIF files in <directory>, both plain and gzipped. If a structure
+    is present in both forms, the plain file is preferred.
+
+    :param directory: Directory with mmCIF files
+    :return: Sorted paths to the mmCIF files, one per structure
+    """
+
+    return list(index_mmcif_files(directory).values())
+
+
+def link_mmcif_file(src_path: Path, dest_dir: Path, stem: str) -> Path:
+    """
+    Make plain or gzipped <src_path> available in <dest_dir> as <stem> with the same suffix.
+    Gzipped file is not decompressed, the readers of the directory (gemmi, PQ, MotiveValidator) read it as is,
+    so the file is linked rather than copied if possible (see materialize).
+    A file of the structure with the other suffix, e.g. from a previous run, is removed,
+    so it does not take precedence in index_mmcif_files.
+
+    :param src_path: Path to the .cif or .cif.gz file
+    :param dest_dir: Directory to make the file available in
+    :param stem: Name of the file in <dest_dir> without suffix
+    :return: Path to the file in <dest_dir>
+    """
+
+    suffix = ".cif.gz" if src_path.name.endswith(".cif.gz") else ".cif"
+    for other_suffix in MMCIF_SUFFIXES:
+        other_path = dest_dir / f"{stem}{other_suffix}"
+        if other_suffix != suffix and (other_path.exists() or other_path.is_symlink()):
+            other_path.unlink()
+
+    dest_path = dest_dir / f"{stem}{suffix}"
+    materialize(src_path, dest_path)
+
+    return dest_path
+
+
+def open_mmcif_file(path: Path) -> TextIO:
+    """
+    Open plain or gzipped mmCIF file for reading as text.
+
+    :param path: Path to the .cif or .cif.gz file
+    :return: Opened file
+    """
+
+    if path.name.endswith(".gz"):
+        return gzip.open(path, "rt")
+
+    return path.open()
@@ -0,0 +1,110 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from tqdm import tqdm
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def ordered_map(function: Callable[[T], R], items: Sequence[T], workers: int = 1, desc: Optional[str] = None, chunksize: int = 1) -> List[R]:
+    """
+    Apply <function> to all items, in a process pool if more than one worker is requested.
+    Results are returned in the order of <items>, so merging them is deterministic.
+
+    :param function: Picklable (module level) function to apply
+    :param items: Items to process
+    :param workers: Number of worker processes, items are processed serially if 1 or less
+    :param desc: Description of the progress bar
+    :param chunksize: Number of items sent to a worker at once
+    :return: Results in the order of <items>
+    """
+
+    if workers <= 1:
+        return [function(item) for item in tqdm(items, desc=desc)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(tqdm(executor.map(function, items, chunksize=chunksize), total=len(items), desc=desc))
+
+
+def _map_until_broken(function: Callable[[T], R], items: Iterator[T], workers: int, max_pending: int, mp_context,
+                      unfinished: List[T]) -> Iterator[Tuple[T, Optional[R], Optional[Exception]]]:
+    """
+    Apply <function> to items in one process pool, until the items run out or a worker process crashes.
+    Items that were submitted but not finished when the pool broke are appended to <unfinished>.
+    """
+
+    pending: Dict[Future, T] = {}
+    broken = False
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        while True:
+            while not broken and len(pending) < max_pending:
+                item = next(items, None)
+                if item is None:
+                    break
+                try:
+                    pending[executor.submit(function, item)] = item
+                except BrokenProcessPool:
+                    unfinished.append(item)
+                    broken = True
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    yield item, future.result(), None
+                except BrokenProcessPool:
+                    unfinished.append(item)
+                    broken = True
+                except Exception as e:
+                    yield item, None, e
+
+
+def _map_isolated(function: Callable[[T], R], items: List[T], workers: int, mp_context) -> Iterator[Tuple[T, Optional[R], Optional[Exception]]]:
+    """
+    Apply <function> to every item in its own worker process, <workers> items at once.
+    """
+
+    def run_isolated(item: T) -> R:
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+            return executor.submit(function, item).result()
+
+    with ThreadPoolExecutor(max_workers=workers) as threads:
+        futures = {threads.submit(run_isolated, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
+def map_isolating_crashes(function: Callable[[T], R], items: Iterable[T], workers: int, max_pending: Optional[int] = None,
+                          mp_context=None) -> Iterator[Tuple[T, Optional[R], Optional[Exception]]]:
+    """
+    Apply <function> to items in a process pool and yield each item with its result or error as it finishes.
+
+    Items are taken from <items> lazily, at most <max_pending> are submitted at once. If a worker
+    process crashes (e.g. segfault or OOM kill), the pool breaks and all its unfinished items would fail.
+    Instead, the unfinished items are run again, each in its own process, so only the item that
+    crashed fails (with BrokenProcessPool), and the remaining items continue in a new pool.
+
+    :param function: Picklable (module level) function to apply
+    :param items: Items to process, must not contain None
+    :param workers: Number of worker processes
+    :param max_pending: Maximal number of submitted unfinished items; defaults to twice the number of workers
+    :param mp_context: Multiprocessing context of the worker processes; defaults to the default context
+    :return: Items with their result and None, or None and the error, in the order they finish
+    """
+
+    iterator = iter(items)
+    max_pending = max_pending or 2 * workers
+    while True:
+        unfinished: List[T] = []
+        yield from _map_until_broken(function, iterator, workers, max_pending, mp_context, unfinished)
+        if not unfinished:
+            return
+        yield from _map_isolated(function, unfinished, workers, mp_context)
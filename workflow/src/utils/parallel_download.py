@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import requests
+from tqdm import tqdm
+from logger import logger
+
+from utils.download_cache import stream_to_file
+
+
+class RateLimiter():
+    """
+    Limit the number of requests sent to each host per second, shared by all threads.
+    """
+
+    def __init__(self, requests_per_second: float) -> None:
+        """
+        :param requests_per_second: Maximal number of requests per second to one host, unlimited if 0 or less
+        """
+
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.next_slot: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+
+    def wait(self, url: str) -> None:
+        """
+        Block until a request to the host of <url> can be sent.
+
+        :param url: URL of the request
+        """
+
+        if not self.interval:
+            return
+
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        time.sleep(slot - now)
+
+
+class DownloadManifest():
+    """
+    Record of finished downloads, appended to a file after every download, so an interrupted
+    run can be resumed without downloading the finished files again.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """
+        :param path: Path to the manifest file (one JSON record per line), created if missing
+        """
+
+        self.path = path
+        self.done: Set[str] = set()
+        self.lock = threading.Lock()
+
+        if path.exists():
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last record may be incomplete if the run was killed while writing it
+                        continue
+                    self.done.add(record["dest"])
+
+
+    def is_done(self, dest_path: Path) -> bool:
+        """
+        Check whether <dest_path> was downloaded by this or a previous run.
+
+        :param dest_path: Path to the downloaded file
+        :return: True if the download is recorded and the file exists; False otherwise
+        """
+
+        return str(dest_path) in self.done and dest_path.exists()
+
+
+    def mark_done(self, url: str, dest_path: Path) -> None:
+        """
+        Record finished download.
+
+        :param url: URL of the downloaded file
+        :param dest_path: Path to the downloaded file
+        """
+
+        with self.lock:
+            self.done.add(str(dest_path))
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"url": url, "dest": str(dest_path)}) + "\n")
+
+
+def download_file(session: requests.Session, url: str, dest_path: Path, limiter: RateLimiter, timeout: float = 60) -> None:
+    """
+    Download <url> to <dest_path>, streamed in chunks to a temporary file that is renamed afterwards.
+
+    :param session: Session to send the request with
+    :param url: URL of the file
+    :param dest_path: Path to save the file to
+    :param limiter: Rate limiter of the hosts
+    :param timeout: Timeout of the connection and of reading each chunk in seconds
+    :raises requests.HTTPError: If the request did not succeed
+    """
+
+    limiter.wait(url)
+    with session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        stream_to_file(response, dest_path)
+
+
+def download_all(session: requests.Session, downloads: List[Tuple[str, Path]], manifest_path: Path, workers: int = 8,
+                 requests_per_second: float = 10, desc: Optional[str] = None) -> List[Tuple[str, Path]]:
+    """
+    Download all files by <workers> threads sharing one session. Downloads recorded in the manifest
+    by a previous run are skipped, so an interrupted run resumes where it left off.
+    The error of every failed download is logged.
+
+    :param session: Session to send the requests with, its connection pool should fit <workers> connections
+    :param downloads: URLs of the files with paths to save them to
+    :param manifest_path: Path to the manifest of finished downloads
+    :param workers: Number of concurrent downloads
+    :param requests_per_second: Maximal number of requests per second to one host, unlimited if 0 or less
+    :param desc: Description of the progress bar
+    :return: Downloads that failed
+    """
+
+    manifest = DownloadManifest(manifest_path)
+    limiter = RateLimiter(requests_per_second)
+    pending = [(url, dest_path) for url, dest_path in downloads if not manifest.is_done(dest_path)]
+
+    def download(item: Tuple[str, Path]) -> bool:
+        url, dest_path = item
+        try:
+            download_file(session, url, dest_path, limiter)
+        except (requests.RequestException, OSError) as e:
+            logger.error(f"Download of {url} failed: {e}")
+            return False
+        manifest.mark_done(url, dest_path)
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(tqdm(executor.map(download, pending), total=len(pending), desc=desc))
+
+    return [item for item, succeeded in zip(pending, results) if not succeeded]
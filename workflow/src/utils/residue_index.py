@@ -0,0 +1,37 @@
+from typing import Dict, List, Tuple
+
+from utils.hide_altloc import remove_altloc_from_id
+
+
+def residue_key(residue: Dict[str, str]) -> Tuple[str, str, str]:
+    """
+    Get hashable key of the residue.
+
+    :param residue: Residue with name, num and chain
+    :return: Tuple of name, num and chain
+    """
+
+    return residue["name"], residue["num"], residue["chain"]
+
+
+def build_residue_type_index(modified_ligands: Dict[str, List[Dict]], glycosylated: Dict[str, List[Dict]],
+                             close_contacts: Dict[str, List[Dict]]) -> Dict[Tuple[str, str, str, str], str]:
+    """
+    Build index of residue types from the categorization. If a residue is in more categories,
+    close contact takes precedence over glycosylated, which takes precedence over ligand.
+
+    :param modified_ligands: Ligands of structures after separation of alternative conformations (any altloc counts)
+    :param glycosylated: Glycosylated residues
+    :param close_contacts: Residues in close contacts
+    :return: Type (ligand, glycosylated or close) keyed by (structure, name, num, chain)
+    """
+
+    index: Dict[Tuple[str, str, str, str], str] = {}
+    for category, res_type in [(modified_ligands, "ligand"), (glycosylated, "glycosylated"), (close_contacts, "close")]:
+        for structure, residues in category.items():
+            if res_type == "ligand":
+                structure = remove_altloc_from_id(structure)
+            for residue in residues:
+                index[(structure, *residue_key(residue))] = res_type
+
+    return index
@@ -0,0 +1,74 @@
+from pathlib import Path
+import sqlite3
+from typing import Dict, List, Tuple
+
+
+class RmsdPairStore():
+    """
+    Persistent store of RMSD values of surrounding pairs, shared by runs of the same sugar.
+    Pairs are keyed by the content hashes of both surrounding files, so the values stay valid
+    even when the surroundings get a different index in a new run.
+    """
+
+    def __init__(self, path: Path, engine: str) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.engine = engine
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pairs ("
+            "engine TEXT, method TEXT, hash1 TEXT, hash2 TEXT, rmsd REAL, "
+            "PRIMARY KEY (engine, method, hash1, hash2))"
+        )
+
+
+    def lookup(self, method: str, hashes1: List[str], hashes2: List[str]) -> Dict[Tuple[str, str], float]:
+        """
+        Get stored pairs of one block of the pair matrix, pairs of a surrounding from <hashes1>
+        with a surrounding from <hashes2>. Only the pairs of the block are loaded from the store.
+
+        :param method: Alignment method the RMSD was calculated with
+        :param hashes1: Content hashes of the surroundings of the rows of the block
+        :param hashes2: Content hashes of the surroundings of the columns of the block
+        :return: RMSD values keyed by sorted pair of hashes
+        """
+
+        for table, hashes in [("wanted1", hashes1), ("wanted2", hashes2)]:
+            self.connection.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (hash TEXT PRIMARY KEY)")
+            self.connection.execute(f"DELETE FROM {table}")
+            self.connection.executemany(f"INSERT OR IGNORE INTO {table} VALUES (?)", [(h,) for h in hashes])
+        # Hashes of a pair are stored sorted, so either of them can be from the rows
+        rows = self.connection.execute(
+            "SELECT hash1, hash2, rmsd FROM pairs "
+            "JOIN wanted1 AS w1 ON pairs.hash1 = w1.hash JOIN wanted2 AS w2 ON pairs.hash2 = w2.hash "
+            "WHERE engine = ? AND method = ? "
+            "UNION "
+            "SELECT hash1, hash2, rmsd FROM pairs "
+            "JOIN wanted2 AS w2 ON pairs.hash1 = w2.hash JOIN wanted1 AS w1 ON pairs.hash2 = w1.hash "
+            "WHERE engine = ? AND method = ?",
+            (self.engine, method, self.engine, method)
+        )
+
+        return {(hash1, hash2): rmsd for hash1, hash2, rmsd in rows}
+
+
+    def add(self, method: str, hash1: str, hash2: str, rmsd: float) -> None:
+        """
+        Store RMSD value of one pair of surroundings.
+
+        :param method: Alignment method the RMSD was calculated with
+        :param hash1: Content hash of the first surrounding
+        :param hash2: Content hash of the second surrounding
+        :param rmsd: The RMSD value
+        """
+
+        hash1, hash2 = sorted((hash1, hash2))
+        self.connection.execute("INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?)", (self.engine, method, hash1, hash2, rmsd))
+
+
+    def close(self) -> None:
+        """
+        Commit the stored pairs and close the store.
+        """
+
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,57 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import sys
+from pathlib import Path
+import threading
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from logger import setup_logger
+
+
+@pytest.fixture(scope="session", autouse=True)
+def logger_setup(tmp_path_factory):
+    setup_logger(tmp_path_factory.mktemp("logs") / "tests.log")
+
+
+@pytest.fixture
+def http_server():
+    """
+    Start a local HTTP server in a thread. The server is created by calling the fixture with a function
+    that gets the request path and headers and returns the status, response headers and body;
+    the URL of the server and the list of requested paths are returned.
+    """
+
+    servers = []
+
+    def start(respond):
+        requested = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                requested.append(self.path)
+                status, headers, body = respond(self.path, self.headers)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+        return f"http://127.0.0.1:{server.server_address[1]}", requested
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import gemmi
+import pytest
+
+from process_handlers.ambient_residues import extract_surroundings, find_residue
+
+
+DATA = Path(__file__).resolve().parent / "data" / "ambient"
+# Structures and patterns captured from actual PQ runs by scripts/pq/capture_pq_fixtures.py
+PQ_DATA = Path(__file__).resolve().parent / "data" / "pq"
+PQ_PATTERNS = sorted((PQ_DATA / "patterns").glob("*.pdb"))
+
+
+def residue_set(path: Path):
+    structure = gemmi.read_structure(str(path))
+    return {(chain.name, residue.name, str(residue.seqid)) for chain in structure[0] for residue in chain}
+
+
+def test_find_residue_matches_insertion_code():
+    model = gemmi.read_structure(str(DATA / "0_1abc.cif"))[0]
+
+    chain_idx, residue_idx = find_residue(model, {"name": "NAG", "num": "12", "chain": "B"})
+    assert str(model[chain_idx][residue_idx].seqid) == "12"
+
+    chain_idx, residue_idx = find_residue(model, {"name": "NAG", "num": "12A", "chain": "B"})
+    assert str(model[chain_idx][residue_idx].seqid) == "12A"
+
+    with pytest.raises(ValueError):
+        find_residue(model, {"name": "NAG", "num": "12B", "chain": "B"})
+
+
+@pytest.mark.parametrize("query_id", ["0_1abc_NAG_12_B", "0_1abc_NAG_12A_B"])
+def test_surrounding_matches_hand_written_residue_set(tmp_path, query_id):
+    num = query_id.split("_")[3]
+    queries = [(query_id, {"name": "NAG", "num": num, "chain": "B"})]
+
+    not_found = extract_surroundings((DATA / "0_1abc.cif", queries), {"NAG": tmp_path})
+
+    assert not_found == []
+    assert residue_set(tmp_path / f"{query_id}.pdb") == residue_set(DATA / f"{query_id}.pdb")
+
+
+@pytest.mark.skipif(not PQ_PATTERNS, reason="No PQ patterns captured, see scripts/pq/capture_pq_fixtures.py")
+@pytest.mark.parametrize("pattern", PQ_PATTERNS, ids=[pattern.stem for pattern in PQ_PATTERNS])
+def test_surrounding_matches_captured_pq_pattern(tmp_path, pattern):
+    # Query ID is <prefix>_<pdb>_<name>_<num>_<chain>, queries with the case sensitive tag can't be told apart by PQ
+    parts = pattern.stem.split("_")
+    if len(parts) != 5:
+        pytest.skip("Query with the case sensitive tag")
+    structure = "_".join(parts[:2])
+    source = next(PQ_DATA.joinpath("structures").glob(f"{structure}.cif*"))
+    queries = [(pattern.stem, {"name": parts[2], "num": parts[3], "chain": parts[4]})]
+
+    not_found = extract_surroundings((source, queries), {parts[2]: tmp_path})
+
+    assert not_found == []
+    assert residue_set(tmp_path / pattern.name) == residue_set(pattern)
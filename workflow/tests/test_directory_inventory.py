@@ -0,0 +1,30 @@
+from utils.directory_inventory import DirectoryInventory
+
+
+def test_inventory_lists_directory_once_until_refreshed(tmp_path):
+    (tmp_path / "1abc.cif.gz").touch()
+    inventory = DirectoryInventory(tmp_path)
+
+    (tmp_path / "2abc_validation.xml.gz").touch()
+    (tmp_path / "1abc.cif.gz").unlink()
+    assert "1abc.cif.gz" in inventory
+    assert "2abc_validation.xml.gz" not in inventory
+
+    inventory.refresh()
+    assert "1abc.cif.gz" not in inventory
+    assert sorted(inventory) == ["2abc_validation.xml.gz"]
+    assert inventory.stems() == {"2abc_validation"}
+    assert len(inventory) == 1
+
+
+def test_exists_checks_target_of_symbolic_links(tmp_path):
+    (tmp_path / "file").touch()
+    (tmp_path / "link").symlink_to(tmp_path / "file")
+    (tmp_path / "broken").symlink_to(tmp_path / "missing")
+
+    inventory = DirectoryInventory(tmp_path)
+
+    assert inventory.exists("file")
+    assert inventory.exists("link")
+    assert not inventory.exists("broken")
+    assert not inventory.exists("missing")
@@ -0,0 +1,112 @@
+import gzip
+import json
+from types import SimpleNamespace
+
+from process_handlers import download_files
+from process_handlers.download_files import download_missing_files, fetch_compound_in_pdb, get_pdb_ids_with_sugars
+from utils.http_session import create_session
+
+
+def pdbe_response(failures):
+    """
+    PDBe in_pdb endpoint: sugars starting with N are not in any structure (404), sugars in <failures>
+    are unavailable (503) for the given number of requests.
+    """
+
+    def respond(path, headers):
+        sugar = path.rsplit("/", 1)[1]
+        if failures.get(sugar, 0) > 0:
+            failures[sugar] -= 1
+            return 503, {}, b""
+        if sugar.startswith("N"):
+            return 404, {}, b"{}"
+        body = {sugar: [{"pdb_id": f"{i}{sugar.lower()}"} for i in range(2)]}
+        return 200, {"Content-Type": "application/json"}, json.dumps(body).encode()
+
+    return respond
+
+
+def create_config(tmp_path):
+    config = SimpleNamespace(user_cfg=SimpleNamespace(data_dir=tmp_path / "data"), components_dir=tmp_path / "components",
+                             run_data_dir=tmp_path / "run")
+    config.components_dir.mkdir()
+    config.run_data_dir.mkdir()
+    (config.components_dir / "components.cif.gz").write_bytes(gzip.compress(b"data_GLC\n"))
+
+    return config
+
+
+def test_not_found_is_cached_as_empty(tmp_path, http_server):
+    url, requested = http_server(pdbe_response({}))
+
+    with create_session() as session:
+        assert fetch_compound_in_pdb(session, "NOPE", tmp_path, url) == {}
+        assert fetch_compound_in_pdb(session, "NOPE", tmp_path, url) == {}
+
+    assert requested == ["/pdb/compound/in_pdb/NOPE"]
+    assert json.loads((tmp_path / "NOPE.json").read_text()) == {}
+
+
+def test_unavailable_server_is_retried(tmp_path, http_server):
+    url, requested = http_server(pdbe_response({"GLC": 2}))
+
+    with create_session(backoff_factor=0) as session:
+        structures = fetch_compound_in_pdb(session, "GLC", tmp_path, url)
+
+    assert [d["pdb_id"] for d in structures["GLC"]] == ["0glc", "1glc"]
+    assert len(requested) == 3
+
+
+def test_second_run_uses_cache(tmp_path, http_server):
+    url, requested = http_server(pdbe_response({"MAN": 1}))
+    config = create_config(tmp_path)
+    sugars = ["GLC", "NAG", "MAN"]
+
+    pdb_ids = get_pdb_ids_with_sugars(config, sugars, workers=2, base_url=url)
+    assert pdb_ids == {"0glc", "1glc", "0man", "1man"}
+    assert json.loads((config.run_data_dir / "sugars_not_present_in_any_structure.json").read_text()) == ["NAG"]
+    assert len(requested) == 4
+
+    requested.clear()
+    assert get_pdb_ids_with_sugars(config, sugars, workers=2, base_url=url) == pdb_ids
+    assert requested == []
+
+
+def test_only_files_missing_in_data_source_are_downloaded(tmp_path, monkeypatch):
+    config = SimpleNamespace(mmcif_files_dir=tmp_path / "mmcif", validation_files_dir=tmp_path / "validation", run_data_dir=tmp_path)
+    config.mmcif_files_dir.mkdir()
+    config.validation_files_dir.mkdir()
+    (config.mmcif_files_dir / "1abc.cif.gz").touch()
+    (config.validation_files_dir / "1abc_validation.xml.gz").touch()
+    (config.mmcif_files_dir / "2abc.cif.gz").touch()
+
+    requested = []
+
+    def fake_download_all(session, downloads, manifest_path, workers, requests_per_second, desc=None):
+        requested.extend(downloads)
+        return [download for download in downloads if "3abc" in download[0]]
+
+    monkeypatch.setattr(download_files, "download_all", fake_download_all)
+
+    failed = download_missing_files(config, {"1abc", "2abc", "3abc"})
+
+    assert [dest_path.name for _, dest_path in requested] == ["2abc_validation.xml.gz", "3abc.cif.gz", "3abc_validation.xml.gz"]
+    assert requested[0][0].endswith("/validation_reports/ab/2abc/2abc_validation.xml.gz")
+    assert failed == ["3abc"]
+
+
+def test_structures_with_failed_downloads_are_left_out(tmp_path, monkeypatch):
+    config = SimpleNamespace(run_data_dir=tmp_path / "run", user_cfg=SimpleNamespace(results_dir=tmp_path / "results", pdb_ids_list=["1abc", "2abc"], skip_ids=[]),
+                             mmcif_files_dir=tmp_path / "mmcif", validation_files_dir=tmp_path / "validation", components_dir=tmp_path / "components",
+                             sugar_binding_patterns_dir=tmp_path / "patterns")
+    source = SimpleNamespace(download_structures=lambda *args: None, download_validation_files=lambda *args: None)
+    monkeypatch.setattr(download_files, "get_components_file", lambda config: None)
+    monkeypatch.setattr(download_files, "get_sugars_from_ccd", lambda config: ["NAG"])
+    monkeypatch.setattr(download_files.data_source_tools.DataSourceHandler, "create", classmethod(lambda cls: source))
+    monkeypatch.setattr(download_files, "download_missing_files", lambda config, pdb_ids: ["2abc"])
+
+    download_files.download_files(config, True)
+    assert sorted(json.loads((config.run_data_dir / "pdb_ids_intersection_pq_ccd.json").read_text())) == ["1abc", "2abc"]
+
+    download_files.download_files(config, True, download_missing=True)
+    assert json.loads((config.run_data_dir / "pdb_ids_intersection_pq_ccd.json").read_text()) == ["1abc"]
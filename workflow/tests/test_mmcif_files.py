@@ -0,0 +1,33 @@
+import gzip
+
+from utils.mmcif_files import index_mmcif_files, link_mmcif_file, open_mmcif_file
+
+
+def test_gzipped_file_is_linked_without_decompression(tmp_path):
+    source = tmp_path / "1abc.cif.gz"
+    source.write_bytes(gzip.compress(b"data_1ABC\n"))
+    target = tmp_path / "modified"
+    target.mkdir()
+    # Plain file of the structure from a previous run would take precedence in the index
+    (target / "0_1abc.cif").write_text("data_OLD\n")
+
+    path = link_mmcif_file(source, target, "0_1abc")
+
+    assert path == target / "0_1abc.cif.gz"
+    assert path.read_bytes() == source.read_bytes()
+    assert index_mmcif_files(target) == {"0_1abc": path}
+    with open_mmcif_file(path) as f:
+        assert f.read() == "data_1ABC\n"
+
+
+def test_plain_file_is_linked_as_plain(tmp_path):
+    source = tmp_path / "1abc.cif"
+    source.write_text("data_1ABC\n")
+    target = tmp_path / "modified"
+    target.mkdir()
+
+    path = link_mmcif_file(source, target, "0_1abc")
+
+    assert path == target / "0_1abc.cif"
+    with open_mmcif_file(path) as f:
+        assert f.read() == "data_1ABC\n"
@@ -0,0 +1,30 @@
+import os
+import signal
+
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.parallel import map_isolating_crashes
+
+
+def square_or_crash(item: int) -> int:
+    if item == 3:
+        os.kill(os.getpid(), signal.SIGKILL)
+    if item == 5:
+        raise ValueError("bad item")
+    return item * item
+
+
+def test_map_isolating_crashes_fails_only_crashed_item():
+    results = {item: (result, error) for item, result, error in map_isolating_crashes(square_or_crash, range(12), workers=3)}
+
+    assert sorted(results) == list(range(12))
+    assert isinstance(results[3][1], BrokenProcessPool)
+    assert isinstance(results[5][1], ValueError)
+    for item in set(range(12)) - {3, 5}:
+        assert results[item] == (item * item, None)
+
+
+def test_map_isolating_crashes_without_crash():
+    results = sorted((item, result) for item, result, _ in map_isolating_crashes(abs, [-1, -2, -3], workers=2))
+
+    assert results == [(-3, 3), (-2, 2), (-1, 1)]
@@ -0,0 +1,94 @@
+import logging
+import time
+
+from logger import logger
+from utils.http_session import create_session
+from utils.parallel_download import DownloadManifest, RateLimiter, download_all
+
+
+def file_response(path, headers):
+    if path.startswith("/missing"):
+        return 404, {}, b""
+    return 200, {}, path.encode()
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_download_all_resumes_from_manifest(tmp_path, http_server):
+    url, requested = http_server(file_response)
+    manifest_path = tmp_path / "manifest.jsonl"
+    downloads = [(f"{url}/file{i}", tmp_path / f"file{i}") for i in range(4)]
+
+    # Previous run finished file0 and file1, but file1 was deleted since
+    manifest = DownloadManifest(manifest_path)
+    for download_url, dest_path in downloads[:2]:
+        manifest.mark_done(download_url, dest_path)
+    downloads[0][1].write_bytes(b"/file0")
+    # The last record is incomplete when the run is killed while writing it
+    with open(manifest_path, "a") as f:
+        f.write('{"url": "')
+
+    with create_session(pool_size=2) as session:
+        failed = download_all(session, downloads, manifest_path, workers=2)
+
+    assert failed == []
+    assert sorted(requested) == ["/file1", "/file2", "/file3"]
+    for i in range(4):
+        assert (tmp_path / f"file{i}").read_bytes() == f"/file{i}".encode()
+
+    requested.clear()
+    with create_session(pool_size=2) as session:
+        assert download_all(session, downloads, manifest_path, workers=2) == []
+    assert requested == []
+
+
+def test_download_all_reports_and_logs_failures(tmp_path, http_server):
+    url, requested = http_server(file_response)
+    manifest_path = tmp_path / "manifest.jsonl"
+    downloads = [(f"{url}/file", tmp_path / "file"), (f"{url}/missing", tmp_path / "missing")]
+    handler = ListHandler()
+    logger.addHandler(handler)
+
+    try:
+        with create_session(retries=0) as session:
+            failed = download_all(session, downloads, manifest_path, workers=2)
+    finally:
+        logger.removeHandler(handler)
+
+    assert failed == [(f"{url}/missing", tmp_path / "missing")]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["file", "manifest.jsonl"]
+    assert not DownloadManifest(manifest_path).is_done(tmp_path / "missing")
+    assert len(handler.messages) == 1
+    assert f"{url}/missing" in handler.messages[0] and "404" in handler.messages[0]
+
+
+def test_download_all_limits_requests_per_second(tmp_path, http_server):
+    url, requested = http_server(file_response)
+    downloads = [(f"{url}/file{i}", tmp_path / f"file{i}") for i in range(6)]
+
+    start = time.monotonic()
+    with create_session(pool_size=4) as session:
+        assert download_all(session, downloads, tmp_path / "manifest.jsonl", workers=4, requests_per_second=10) == []
+
+    # Requests are spaced by 0.1 s, the first one is sent immediately
+    assert time.monotonic() - start >= 0.5
+    assert len(requested) == 6
+
+
+def test_rate_limiter_is_per_host():
+    limiter = RateLimiter(requests_per_second=5)
+
+    start = time.monotonic()
+    limiter.wait("http://a.example/1")
+    limiter.wait("http://b.example/1")
+    assert time.monotonic() - start < 0.1
+
+    limiter.wait("http://a.example/2")
+    assert time.monotonic() - start >= 0.2
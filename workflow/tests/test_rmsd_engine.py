@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import squareform
+
+from process_handlers.rmsd_engine import Surrounding, kabsch, rmsd_of_pairs, superpose_on_reference
+from utils.condensed_matrix import condensed_index, square_size
+
+
+ATOM_NAMES = ["N", "CA", "C", "O"]
+
+
+def rotation_matrix(axis, angle):
+    axis = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    x, y, z = axis
+    c, s = math.cos(angle), math.sin(angle)
+
+    return np.array([[c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+                     [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+                     [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)]])
+
+
+def surrounding(name, residues, sugar_atoms=None):
+    """
+    Surrounding with residues given as (name, CA position), other atoms are placed around CA.
+    """
+
+    offsets = np.array([[-1.0, 0.5, 0.0], [0.0, 0.0, 0.0], [1.0, 0.5, 0.0], [1.5, 1.5, 0.0]])
+    atoms = np.array([np.asarray(position, dtype=float) + offsets for _, position in residues])
+
+    return Surrounding(name, int(name.split("_")[0]), sugar_atoms or {}, [res_name for res_name, _ in residues],
+                       atoms[:, 1].copy(), atoms)
+
+
+def test_kabsch_recovers_known_rotation():
+    rng = np.random.default_rng(1)
+    target = rng.normal(size=(10, 3))
+    rotation = rotation_matrix([1, 2, 3], 1.1)
+    mobile = (target - 5.0) @ rotation.T
+
+    found_rotation, translation = kabsch(mobile, target)
+
+    np.testing.assert_allclose(mobile @ found_rotation.T + translation, target, atol=1e-10)
+    np.testing.assert_allclose(found_rotation, rotation.T, atol=1e-10)
+
+
+def test_kabsch_never_returns_reflection():
+    rng = np.random.default_rng(2)
+    target = rng.normal(size=(10, 3))
+    mirrored = target * np.array([-1.0, 1.0, 1.0])
+
+    rotation, translation = kabsch(mirrored, target)
+
+    assert np.linalg.det(rotation) == pytest.approx(1.0)
+    # A mirror image cannot be superposed by a proper rotation
+    assert np.sqrt(np.mean(np.sum((mirrored @ rotation.T + translation - target) ** 2, axis=1))) > 0.1
+
+
+def test_superpose_on_reference_moves_sugar_onto_reference():
+    reference = {"C1": np.array([0.0, 0.0, 0.0]), "C2": np.array([1.5, 0.0, 0.0]), "C3": np.array([2.0, 1.4, 0.0]),
+                 "O5": np.array([0.0, 1.4, 0.5])}
+    rotation = rotation_matrix([0, 0, 1], math.pi / 2)
+    shift = np.array([10.0, -3.0, 2.0])
+    moved = {name: coords @ rotation.T + shift for name, coords in reference.items()}
+    residue_ca = np.array([3.0, 3.0, 3.0])
+    surroundings = [surrounding("0_a_NAG_1_A", [("ALA", residue_ca @ rotation.T + shift)], moved),
+                    surrounding("1_b_NAG_1_A", [("ALA", residue_ca)], {"C1": reference["C1"], "X": reference["C2"]})]
+
+    failed = superpose_on_reference(surroundings, reference)
+
+    assert list(failed) == ["1_b_NAG_1_A"]
+    np.testing.assert_allclose(surroundings[0].anchors[0], residue_ca, atol=1e-10)
+
+
+def test_rmsd_of_identical_and_shifted_surroundings():
+    residues = [("ALA", [0, 0, 0]), ("SER", [6, 0, 0]), ("GLY", [0, 6, 0])]
+    shifted = [(name, np.array(position) + [0.5, 0, 0]) for name, position in residues]
+    surroundings = [surrounding("0_a_NAG_1_A", residues), surrounding("1_b_NAG_1_A", residues),
+                    surrounding("2_c_NAG_1_A", shifted)]
+
+    rmsd = rmsd_of_pairs(surroundings, [(0, 1), (0, 2), (2, 1)], match_names=False)
+
+    np.testing.assert_allclose(rmsd, [0.0, 0.5, 0.5], atol=1e-10)
+
+
+def test_rmsd_ignores_padding_and_missing_atoms():
+    query = surrounding("0_a_NAG_1_A", [("ALA", [0, 0, 0])])
+    larger = surrounding("1_b_NAG_1_A", [("ALA", [0, 0, 1]), ("SER", [8, 0, 0]), ("GLY", [0, 8, 0])])
+    missing_atom = surrounding("2_c_NAG_1_A", [("ALA", [0, 0, 1])])
+    missing_atom.atoms[0, 3] = np.nan
+    # Only the first residue of the larger surrounding is paired, padding of the shorter one is skipped
+    rmsd = rmsd_of_pairs([query, larger, missing_atom], [(0, 1), (1, 0), (0, 2)], match_names=False, block_size=1)
+
+    np.testing.assert_allclose(rmsd, [1.0, 1.0, 1.0], atol=1e-10)
+
+
+def test_match_names_pairs_only_residues_with_the_same_name():
+    query = surrounding("0_a_NAG_1_A", [("ALA", [0, 0, 0])])
+    target = surrounding("1_b_NAG_1_A", [("SER", [0, 0, 0]), ("ALA", [0, 3, 0])])
+    other = surrounding("2_c_NAG_1_A", [("SER", [0, 0, 0])])
+
+    super_like = rmsd_of_pairs([query, target, other], [(0, 1), (0, 2)], match_names=False)
+    align_like = rmsd_of_pairs([query, target, other], [(0, 1), (0, 2)], match_names=True)
+
+    np.testing.assert_allclose(super_like, [0.0, 0.0], atol=1e-10)
+    assert align_like[0] == pytest.approx(3.0)
+    # No residue of the same name, nothing paired
+    assert np.isnan(align_like[1])
+
+
+def test_condensed_index_matches_squareform():
+    n = 7
+    square = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            square[i, j] = square[j, i] = 10 * i + j
+    condensed = squareform(square)
+
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                assert condensed[condensed_index(n, i, j)] == square[i, j]
+    assert square_size(condensed) == n
@@ -0,0 +1,56 @@
+import zipfile
+
+from process_handlers import run_pq
+from process_handlers.run_pq import extract_results, query_residues
+
+
+def test_query_residues_tags_chains_differing_only_in_case():
+    residues = [
+        {"name": "NAG", "num": "1", "chain": "M"},
+        {"name": "NAG", "num": "1", "chain": "m"},
+        {"name": "NAG", "num": "2", "chain": "M"},
+        {"name": "ALA", "num": "1", "chain": "A"},
+    ]
+
+    queries = query_residues("0_1abc", residues, ["NAG"])
+
+    assert [query_id for query_id, _ in queries] == ["0_1abc_NAG_1_M", "0_1abc_NAG_1_m_2", "0_1abc_NAG_2_M"]
+
+
+def test_query_residues_tags_lower_case_chain_first():
+    residues = [
+        {"name": "NAG", "num": "1", "chain": "m"},
+        {"name": "NAG", "num": "1", "chain": "M"},
+    ]
+
+    queries = query_residues("0_1abc", residues, ["NAG"])
+
+    assert [query_id for query_id, _ in queries] == ["0_1abc_NAG_1_m", "0_1abc_NAG_1_M_2"]
+
+
+def test_extract_results_takes_patterns_of_the_query_structure(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_pq, "pq_couldnt_find_pattern", [])
+    monkeypatch.setattr(run_pq, "more_than_one_pattern", [])
+    zip_path = tmp_path / "result.zip"
+    with zipfile.ZipFile(zip_path, "w") as z:
+        # Queries of a batch are run over all its structures
+        z.writestr("0_1abc_NAG_1_A/patterns/0_1abc_0.pdb", "first")
+        z.writestr("0_1abc_NAG_1_A/patterns/0_2abc_0.pdb", "other structure")
+        z.writestr("0_1abc_NAG_1_A/patterns.csv", "")
+        z.writestr("0_1abc_NAG_2_A/patterns/0_1abc_0.pdb", "second")
+        z.writestr("0_1abc_NAG_2_A/patterns/0_1abc_1.pdb", "second")
+        z.writestr("0_2abc_NAG_3_A/patterns/0_1abc_0.pdb", "other structure")
+    target = tmp_path / "raw"
+    target.mkdir()
+
+    extract_results(zip_path, [("0_1abc_NAG_1_A", "0_1abc", target), ("0_1abc_NAG_2_A", "0_1abc", target), ("0_2abc_NAG_3_A", "0_2abc", target)])
+
+    assert sorted(p.name for p in target.iterdir()) == ["0_1abc_NAG_1_A.pdb"]
+    assert (target / "0_1abc_NAG_1_A.pdb").read_text() == "first"
+    assert run_pq.more_than_one_pattern == ["0_1abc_NAG_2_A"]
+    assert run_pq.pq_couldnt_find_pattern == ["0_2abc_NAG_3_A"]
+
+
+def test_pattern_structure_of_gzipped_input():
+    assert run_pq.pattern_structure("0_1abc_NAG_1_A/patterns/0_1ABC_0.pdb") == "0_1abc"
+    assert run_pq.pattern_structure("0_1abc_NAG_1_A/patterns/0_1abc.cif_0.pdb") == "0_1abc"